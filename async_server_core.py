@@ -0,0 +1,188 @@
+import socket
+import asyncio
+import threading
+from framing import FrameBuffer, RECV_SIZE
+from server_core import ChatServer
+from fanout import DRAIN_TIMEOUT
+from session_registry import Session
+
+
+class AsyncConnection:
+    """
+    Socket-like wrapper around an asyncio StreamWriter so the shared ChatServer
+    routing code (broadcast, private_message, remove_client) can keep calling
+    sendall()/close(). Writes are buffered by the transport and never block.
+    """
+    def __init__(self, writer, loop, loop_thread_id):
+        self.writer = writer
+        self.loop = loop
+        self.loop_thread_id = loop_thread_id
+        self.closed = False
+
+    def call(self, func, *args):
+        # Handlers run on the loop thread; stop() and the GUI come from other threads.
+        if self.loop.is_closed():
+            return
+        if threading.get_ident() == self.loop_thread_id:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def sendall(self, data):
+        if self.closed:
+            raise OSError("Connection is closed")
+        self.call(self.writer.write, data)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.call(self.writer.close)
+
+    def shutdown(self, how=socket.SHUT_RDWR):
+        if how == socket.SHUT_WR:
+            self.call(self.writer.write_eof) # FIN after whatever the transport still buffers
+        else:
+            self.close()
+
+
+class AsyncChatServer(ChatServer):
+    """
+    Same protocol as ChatServer (HELLO handshake, then typed envelopes),
+    but every connection is a coroutine on one event loop instead of an OS thread.
+    """
+    def __init__(self, host='0.0.0.0', port=5555, password='admin123', backlog=1024, **kwargs):
+        super().__init__(host=host, port=port, password=password, backlog=backlog, **kwargs)
+        self.loop = None
+        self.loop_thread_id = None
+        self.server = None
+        self.ready = threading.Event()
+
+    # ---------------- START SERVER ----------------
+    def start(self, on_log=None):
+        self.start_log(on_log)
+        if not self.bus:
+            self.bind()
+            self.server_socket.setblocking(False)
+        self.open_history()
+        self.start_metrics()
+        threading.Thread(target=self.run_loop, daemon=True).start()
+        self.ready.wait()
+        if self.bus: # Connections are handed over by the ShardedChatServer
+            self.bus.start(self)
+            self.log.info(f"🟢 Shard {self.bus.shard} started (async engine)")
+        else:
+            self.log.info(f"🟢 Server started on {self.host}:{self.port} (async engine)")
+        if self.federation:
+            self.federation.start(self)
+
+    def run_loop(self):
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread_id = threading.get_ident()
+        asyncio.set_event_loop(self.loop)
+        try:
+            if not self.bus:
+                self.server = self.loop.run_until_complete(
+                    asyncio.start_server(self.serve_client, sock=self.server_socket, backlog=self.backlog))
+            self.ready.set()
+            self.loop.run_forever()
+        finally:
+            self.ready.set()
+            # Let readers and writers still parked on a socket unwind before closing the loop
+            pending = asyncio.all_tasks(self.loop)
+            for task in pending:
+                task.cancel()
+            if pending:
+                self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            self.loop.close()
+
+    # A socket accepted by the hub, with whatever it already read (the HELLO)
+    def adopt_connection(self, conn, addr, initial):
+        asyncio.run_coroutine_threadsafe(self.adopt(conn, initial), self.loop)
+
+    async def adopt(self, conn, initial):
+        reader, writer = await asyncio.open_connection(sock=conn)
+        await self.serve_client(reader, writer, initial)
+
+    # ---------------- HANDLE EACH CLIENT ----------------
+    async def serve_client(self, reader, writer, initial=b""):
+        self.m_connections.inc()
+        addr = writer.get_extra_info('peername')
+        conn = AsyncConnection(writer, self.loop, self.loop_thread_id)
+        client = Session(conn, addr)
+        throttle = self.limits.connection_throttle()
+        buffer = FrameBuffer()
+        data = initial
+        try:
+            while self.running and not conn.closed:
+                if not data:
+                    data = await reader.read(RECV_SIZE)
+                    if not data:
+                        break
+                frames, data = buffer.feed(data), b""
+                for frame in frames:
+                    wait = throttle.delay(len(frame))
+                    if wait:
+                        self.throttled(wait)
+                        await asyncio.sleep(wait) # Nothing is read meanwhile: TCP slows the client down
+                    session = self.process_frame(client, frame)
+                    if session is None:
+                        return
+                    client = session
+                    # One read can hold hundreds of small (compressed) frames: let the
+                    # writers drain what each one fanned out before taking the next
+                    await asyncio.sleep(0)
+
+        except asyncio.CancelledError:
+            pass # Loop shutting down
+        except Exception as e:
+            self.log.warning(f"⚠️ Connection error with {addr} ({client.username or 'Unknown'}): {e}")
+        finally:
+            self.drop_connection(client, conn)
+
+    # ---------------- OUTBOUND QUEUE WRITER ----------------
+    # Drains a client's SendQueue with a coroutine instead of a thread; drain()
+    # applies transport backpressure so a slow reader fills its own queue only.
+    def start_writer(self, session):
+        conn, queue = session.conn, session.send_queue
+        ready = asyncio.Event()
+        queue.wakeup = lambda: conn.call(ready.set)
+        queue.wakeup() # Flush anything queued before the writer existed
+        conn.call(self.loop.create_task, self.drain_queue(conn, queue, ready))
+
+    async def drain_queue(self, conn, queue, ready):
+        try:
+            while True:
+                await ready.wait()
+                ready.clear()
+                while True:
+                    batch = queue.take_batch()
+                    if not batch:
+                        break
+                    conn.writer.writelines(batch)
+                    await conn.writer.drain()
+                if queue.closed:
+                    return
+        except (ConnectionError, OSError) as e:
+            if not queue.closed:
+                self.on_writer_error(conn, e)
+                conn.close()
+
+    # ---------------- STOP SERVER ----------------
+    def stop(self, drain_timeout=DRAIN_TIMEOUT):
+        super().stop(drain_timeout)
+        if self.loop and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def close_listener(self):
+        if not self.server:
+            super().close_listener() # A shard: the socket was never bound
+        elif not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.server.close)
+
+    # drain() also waits for the transport buffer: drain_queue() moves on once
+    # it is below the high-water mark, not when it is empty
+    def unsent(self, session):
+        unsent = super().unsent(session)
+        if unsent or session.detached_at is not None or session.conn.closed:
+            return unsent
+        return 1 if session.conn.writer.transport.get_write_buffer_size() else 0
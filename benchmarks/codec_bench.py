@@ -0,0 +1,125 @@
+"""
+Loopback throughput and latency of every frame codec over real TCP sockets.
+
+    python -m benchmarks.codec_bench [--messages 20000] [--sizes 32,256,4096] [--json out.json]
+
+For each codec and message size a sender thread encrypts, frames and sends
+a burst of messages that a receiver reads and decrypts (messages per second,
+bytes per message on the wire), then sends them one at a time for one-way
+latency from before encryption to after decryption (p50 / p99).
+"""
+import json
+import time
+import socket
+import struct
+import argparse
+import threading
+from framing import FrameReader, pack_frame
+from session_crypto import KeyExchange, CODECS
+
+
+STAMP = struct.Struct("!d")   # Send time, at the front of every payload
+LATENCY_SAMPLES = 2000
+
+
+# ---------------- SETUP ----------------
+def loopback_pair():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    sender = socket.create_connection(listener.getsockname())
+    receiver, _ = listener.accept()
+    listener.close()
+    for sock in (sender, receiver):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sender, receiver
+
+
+def codec_pair(name):
+    server, client = KeyExchange(), KeyExchange()
+    return (server.derive(client.public_key(), "password", "nonce", False, name),
+            client.derive(server.public_key(), "password", "nonce", True, name))
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+# ---------------- ONE RUN ----------------
+def run(name, size, messages):
+    encoder, decoder = codec_pair(name)
+    sender, receiver = loopback_pair()
+    reader = FrameReader(receiver)
+    filler = b"x" * max(0, size - STAMP.size)
+    latencies = []
+    paced = threading.Event()
+    done = threading.Event()
+
+    def receive(count, record):
+        for _ in range(count):
+            plain = decoder.decrypt(reader.read_frame())
+            if record:
+                latencies.append(time.perf_counter() - STAMP.unpack_from(plain)[0])
+                paced.set()
+        done.set()
+
+    # Burst: as fast as the sender can go
+    wire_bytes = 0
+    thread = threading.Thread(target=receive, args=(messages, False))
+    thread.start()
+    start = time.perf_counter()
+    for _ in range(messages):
+        frame = pack_frame(encoder.encrypt(STAMP.pack(time.perf_counter()) + filler))
+        wire_bytes += len(frame)
+        sender.sendall(frame)
+    done.wait()
+    elapsed = time.perf_counter() - start
+    thread.join()
+
+    # Paced: one message in flight, for latency without queueing
+    samples = min(messages, LATENCY_SAMPLES)
+    done.clear()
+    thread = threading.Thread(target=receive, args=(samples, True))
+    thread.start()
+    for _ in range(samples):
+        paced.clear()
+        sender.sendall(pack_frame(encoder.encrypt(STAMP.pack(time.perf_counter()) + filler)))
+        paced.wait()
+    thread.join()
+    sender.close()
+    receiver.close()
+
+    return {
+        "codec": name,
+        "size": size,
+        "msgs_per_s": messages / elapsed,
+        "bytes_per_msg": wire_bytes / messages,
+        "p50_us": percentile(latencies, 0.50) * 1e6,
+        "p99_us": percentile(latencies, 0.99) * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--sizes", default="32,256,4096")
+    parser.add_argument("--codecs", default=",".join(CODECS))
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'codec':<20}{'size':>6}{'msgs/s':>11}{'bytes/msg':>11}{'p50 µs':>9}{'p99 µs':>9}")
+    for size in (int(s) for s in args.sizes.split(",")):
+        for name in args.codecs.split(","):
+            r = run(name, size, args.messages)
+            results.append(r)
+            print(f"{name:<20}{size:>6}{r['msgs_per_s']:>11.0f}{r['bytes_per_msg']:>11.1f}"
+                  f"{r['p50_us']:>9.1f}{r['p99_us']:>9.1f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Wire savings and CPU cost of each compression mode on chat-shaped frames.
+
+    python -m benchmarks.compression_bench [--recipients 20] [--users 50] [--json out.json]
+
+Builds the envelopes the server actually sends (numbered chat lines, private
+messages, presence summaries, USERS rosters, HISTORY_PAGE pages) and
+fans every one out to --recipients connections, as a broadcast would.
+Reports the wire/raw ratio and the compression time per recipient frame.
+"""
+import json
+import time
+import random
+import argparse
+from compression import FrameCompressor, MODES, MIN_COMPRESS, deflate_shared
+from envelope import pack, pack_roster, CHAT, PRIVATE, NOTICE, USERS, HISTORY_PAGE
+
+
+WORDS = ("the meeting is moved to lab three please bring your laptop and notes we start at five "
+         "did anyone see the build results deploy again after lunch thanks I will check it now").split()
+
+
+# ---------------- WORKLOAD ----------------
+def sentence(rng):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 25)))
+
+
+def workload(users, count, seed=1):
+    rng = random.Random(seed)
+    names = [f"user{i:03d}" for i in range(users)]
+    frames = {"chat": [], "private": [], "presence": [], "roster": [], "history": []}
+    seq, ts = 1000, 1792205516.25
+    for _ in range(count):
+        seq += 1
+        frames["chat"].append(pack(CHAT, sentence(rng), rng.choice(names), seq=seq, ts=ts + seq))
+        frames["private"].append(pack(PRIVATE, sentence(rng), rng.choice(names), rng.choice(names), seq, ts + seq))
+        joined = rng.sample(names, rng.randint(1, 4))
+        frames["presence"].append(pack(NOTICE, f"🟢 {', '.join(joined)} joined the chat.", seq=seq, ts=ts + seq))
+    for version in range(count // 10 or 1):
+        frames["roster"].append(pack(USERS, pack_roster(version, names), seq=seq + version, ts=ts + seq))
+    for page in range(count // 50 or 1):
+        messages = [{"seq": seq + i, "ts": ts + i, "kind": "global", "sender": rng.choice(names),
+                     "target": None, "body": sentence(rng)} for i in range(100)]
+        body = json.dumps({"messages": messages, "next": seq + 100}, separators=(',', ':'))
+        frames["history"].append(pack(HISTORY_PAGE, body, seq=seq + page, ts=ts + seq))
+    return frames
+
+
+# ---------------- ONE RUN ----------------
+def run(mode, kind, payloads, recipients, threshold):
+    deflate_shared.cache_clear()
+    compressors = [FrameCompressor(mode, threshold) for _ in range(recipients)]
+    start = time.perf_counter()
+    for payload in payloads:
+        for compressor in compressors:
+            compressor.compress(payload)
+    elapsed = time.perf_counter() - start
+    stats = compressors[0].stats()
+    return {
+        "mode": mode,
+        "kind": kind,
+        "raw_bytes_per_frame": stats["raw_bytes"] / stats["frames"],
+        "wire_bytes_per_frame": stats["wire_bytes"] / stats["frames"],
+        "ratio": stats["ratio"],
+        "us_per_frame": elapsed / (len(payloads) * recipients) * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recipients", type=int, default=20)
+    parser.add_argument("--users", type=int, default=50, help="Names in the roster")
+    parser.add_argument("--count", type=int, default=1000, help="Chat lines per kind")
+    parser.add_argument("--threshold", type=int, default=MIN_COMPRESS)
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    frames = workload(args.users, args.count)
+    results = []
+    print(f"{'mode':<13}{'kind':<10}{'raw B':>9}{'wire B':>9}{'ratio':>8}{'µs/frame':>10}")
+    for kind, payloads in frames.items():
+        for mode in MODES:
+            r = run(mode, kind, payloads, args.recipients, args.threshold)
+            results.append(r)
+            print(f"{mode:<13}{kind:<10}{r['raw_bytes_per_frame']:>9.1f}{r['wire_bytes_per_frame']:>9.1f}"
+                  f"{r['ratio']:>8.3f}{r['us_per_frame']:>10.2f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
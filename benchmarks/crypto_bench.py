@@ -0,0 +1,93 @@
+"""
+Per-message cost of the old shared Fernet key against the per-connection
+codecs, for one message fanned out to N recipients.
+
+    python -m benchmarks.crypto_bench [--recipients 50] [--messages 2000]
+
+The shared key encrypts once per message and shares the token between
+recipients; per-connection codecs seal once per recipient. "decrypt" is
+what one receiver spends. See codec_bench.py for throughput over sockets.
+"""
+import os
+import time
+import argparse
+from cryptography.fernet import Fernet
+from framing import pack_frame
+from session_crypto import KeyExchange
+
+
+SIZES = (32, 256, 4096)
+CIPHERS = ("shared-fernet", "aes-256-gcm", "chacha20-poly1305", "fernet")
+
+
+class FernetCipher:
+    """The old path: one key for everybody, so a single token serves every recipient."""
+    shared = True
+
+    def __init__(self):
+        self.fernet = Fernet(Fernet.generate_key())
+
+    def encrypt(self, data):
+        return self.fernet.encrypt(data)
+
+    def decrypt(self, data):
+        return self.fernet.decrypt(data)
+
+
+# ---------------- SETUP ----------------
+# (server side cipher, client side cipher) for every recipient
+def make_pairs(name, recipients):
+    if name == "shared-fernet":
+        cipher = FernetCipher()
+        return [(cipher, cipher)] * recipients
+    pairs = []
+    for _ in range(recipients):
+        server, client = KeyExchange(), KeyExchange()
+        pairs.append((server.derive(client.public_key(), "password", "nonce", False, name),
+                      client.derive(server.public_key(), "password", "nonce", True, name)))
+    return pairs
+
+
+def fan_out(pairs, payload):
+    if getattr(pairs[0][0], "shared", False):
+        return [pack_frame(pairs[0][0].encrypt(payload))] * len(pairs)
+    return [pack_frame(server.encrypt(payload)) for server, _ in pairs]
+
+
+# ---------------- MEASURE ----------------
+def measure(name, recipients, messages, size):
+    payload = os.urandom(size)
+    pairs = make_pairs(name, recipients)
+
+    start = time.perf_counter()
+    first_frames = [fan_out(pairs, payload)[0] for _ in range(messages)]
+    send_cost = (time.perf_counter() - start) / messages
+
+    receiver = pairs[0][1]
+    start = time.perf_counter()
+    for frame in first_frames: # In order, as they would arrive
+        receiver.decrypt(frame[4:])
+    receive_cost = (time.perf_counter() - start) / messages
+
+    wire = len(first_frames[0])
+    return {"fan_out_us": send_cost * 1e6, "decrypt_us": receive_cost * 1e6,
+            "wire_bytes": wire, "overhead": wire - size}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recipients", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{args.recipients} recipients, {args.messages} messages per size")
+    print(f"{'codec':<20}{'size':>6}{'fan-out µs':>12}{'per rcpt µs':>13}{'decrypt µs':>12}{'wire B':>8}{'overhead B':>12}")
+    for size in SIZES:
+        for name in CIPHERS:
+            r = measure(name, args.recipients, args.messages, size)
+            print(f"{name:<20}{size:>6}{r['fan_out_us']:>12.1f}{r['fan_out_us'] / args.recipients:>13.2f}"
+                  f"{r['decrypt_us']:>12.2f}{r['wire_bytes']:>8}{r['overhead']:>12}")
+
+
+if __name__ == "__main__":
+    main()
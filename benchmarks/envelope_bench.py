@@ -0,0 +1,169 @@
+"""
+Parse and serialize cost of typed envelopes against the old string protocol.
+
+    python -m benchmarks.envelope_bench [--count 20000] [--json out.json]
+
+For each kind of frame (global chat, private, room, presence notice, roster
+delta, and a client request) times, per frame:
+  serialize  building the plaintext the server queues ("<seq>|alice: hi" vs pack())
+  parse      what the receiving side did to find the handler: the client's
+             "<seq>|" split plus the window's startswith() chain, or the
+             server's prefix checks, vs unpack() and one dictionary lookup
+Also reports frame sizes, and checks both on names containing ':', which the
+string protocol routes to the wrong sender or target.
+"""
+import json
+import time
+import argparse
+from envelope import pack, unpack, pack_roster, parse_roster, CHAT, PRIVATE, ROOM_MSG, NOTICE, USER_JOINED, JOIN
+
+
+TS = 1792205516.25
+
+
+# ---------------- THE STRING PROTOCOL (before envelopes) ----------------
+def legacy_client_parse(frame):
+    """Client side: numbered prefix, then the chat window's prefix sniffing."""
+    message = frame.decode('utf-8')
+    seq, numbered, body = message.partition("|")
+    if numbered and seq.isdigit():
+        seq = int(seq)
+        message = body
+    if message.startswith("HISTORY_PAGE:"):
+        return "history", None, message
+    if message.startswith("ROOM:"):
+        _, room, inner = message.split(":", 2)
+        sender, content = inner.split(":", 1)
+        return "room", sender, content
+    if message.startswith(("ROOM_LIST:", "FILE_OFFER:", "📁 ", "✅ ", "❌ ", "RELOGIN:")):
+        return "other", None, message
+    if message.startswith(("USERS:", "USER_JOINED:", "USER_LEFT:")):
+        kind, version, names = message.split(":", 2)
+        return "roster", int(version), names.split(",")
+    if message.startswith("🟢 ") and " joined the chat" in message:
+        return "notice", None, message
+    if message.startswith("🔴 ") and " left the chat" in message:
+        return "notice", None, message
+    if message.startswith("💬 [Private]"):
+        sender, content = message.replace("💬 [Private] ", "", 1).split(":", 1)
+        return "private", sender.strip(), content.strip()
+    sender, content = message.split(":", 1)
+    return "chat", sender.strip(), content.strip()
+
+
+def legacy_server_parse(frame):
+    """Server side: the prefix checks of the old process_frame."""
+    msg = frame.decode('utf-8')
+    if msg.startswith("ACK:"):
+        return "ack", int(msg[4:])
+    if msg in ("BYE", "ROSTER_SYNC", "ROOMS"):
+        return msg, None
+    if msg.startswith("HISTORY:"):
+        return "history", msg.split(":", 2)
+    if msg.startswith("ROOM:"):
+        return "room", msg.split(":", 2)
+    if msg.startswith("JOIN:"):
+        return "join", msg[5:]
+    if msg.startswith("LEAVE:"):
+        return "leave", msg[6:]
+    if msg.startswith(("FILE_OFFER:", "FILE_ACCEPT:", "FILE_ACK:", "FILE_CANCEL:")):
+        return "file", msg
+    if msg.startswith("PRIVATE:"):
+        return "private", msg.split(":", 2)
+    return "chat", msg
+
+
+# ---------------- THE ENVELOPE PROTOCOL ----------------
+HANDLERS = {kind: kind for kind in range(256)} # Stands in for a handler table
+
+
+def envelope_parse(frame):
+    message = unpack(frame)
+    return HANDLERS[message.type], message.sender, message.body
+
+
+def envelope_roster_parse(frame):
+    message = unpack(frame)
+    return HANDLERS[message.type], parse_roster(message.body)
+
+
+# ---------------- WORKLOAD ----------------
+def cases(sender, target):
+    """[(kind, legacy serialize, envelope serialize, legacy parser, envelope parser)]; seq is filled in per call."""
+    text = "did anyone see the build results, deploy again after lunch"
+    roster = [f"user{i:03d}" for i in range(3)]
+    return [
+        ("chat", lambda seq: f"{seq}|{sender}: {text}".encode('utf-8'),
+         lambda seq: pack(CHAT, text, sender, seq=seq, ts=TS), legacy_client_parse, envelope_parse),
+        ("private", lambda seq: f"{seq}|💬 [Private] {sender}: {text}".encode('utf-8'),
+         lambda seq: pack(PRIVATE, text, sender, target, seq, TS), legacy_client_parse, envelope_parse),
+        ("room", lambda seq: f"{seq}|ROOM:lab:{sender}: {text}".encode('utf-8'),
+         lambda seq: pack(ROOM_MSG, text, sender, "lab", seq, TS), legacy_client_parse, envelope_parse),
+        ("notice", lambda seq: f"{seq}|🟢 {sender} joined the chat.".encode('utf-8'),
+         lambda seq: pack(NOTICE, f"🟢 {sender} joined the chat.", seq=seq, ts=TS), legacy_client_parse, envelope_parse),
+        ("roster", lambda seq: f"{seq}|USER_JOINED:{seq}:{','.join(roster)}".encode('utf-8'),
+         lambda seq: pack(USER_JOINED, pack_roster(seq, roster), seq=seq, ts=TS), legacy_client_parse,
+         envelope_roster_parse),
+        ("request", lambda seq: "JOIN:lab".encode('utf-8'),
+         lambda seq: pack(JOIN, target="lab"), legacy_server_parse, envelope_parse),
+    ]
+
+
+def per_call(func, args):
+    start = time.perf_counter()
+    for arg in args:
+        func(arg)
+    return (time.perf_counter() - start) / len(args) * 1e9
+
+
+def run(count):
+    results = []
+    seqs = range(1000, 1000 + count)
+    for kind, legacy_pack, envelope_pack, legacy_parse, envelope_parse in cases("alice", "bob"):
+        legacy_frames = [legacy_pack(seq) for seq in seqs]
+        envelope_frames = [envelope_pack(seq) for seq in seqs]
+        results.append({
+            "kind": kind,
+            "legacy_bytes": len(legacy_frames[0]),
+            "envelope_bytes": len(envelope_frames[0]),
+            "legacy_serialize_ns": per_call(legacy_pack, seqs),
+            "envelope_serialize_ns": per_call(envelope_pack, seqs),
+            "legacy_parse_ns": per_call(legacy_parse, legacy_frames),
+            "envelope_parse_ns": per_call(envelope_parse, envelope_frames),
+        })
+    return results
+
+
+def ambiguity():
+    """Who each protocol says sent a private message from 'ali:ce' to 'b:ob'."""
+    legacy = legacy_client_parse("7|💬 [Private] ali:ce: hi".encode('utf-8'))
+    envelope = unpack(pack(PRIVATE, "hi", "ali:ce", "b:ob", 7, TS))
+    return {"legacy": {"sender": legacy[1], "body": legacy[2]},
+            "envelope": {"sender": envelope.sender, "target": envelope.target, "body": envelope.text},
+            "legacy_request": legacy_server_parse(b"PRIVATE:b:ob:hi")[1]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=20000, help="Frames per kind")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    results = run(args.count)
+    print(f"{'kind':<9}{'bytes':>13}{'serialize ns':>18}{'parse ns':>18}")
+    print(f"{'':<9}{'str / env':>13}{'str / env':>18}{'str / env':>18}")
+    for r in results:
+        print(f"{r['kind']:<9}{r['legacy_bytes']:>6} /{r['envelope_bytes']:>5}"
+              f"{r['legacy_serialize_ns']:>10.0f} /{r['envelope_serialize_ns']:>6.0f}"
+              f"{r['legacy_parse_ns']:>10.0f} /{r['envelope_parse_ns']:>6.0f}")
+    names = ambiguity()
+    print(f"'ali:ce' -> 'b:ob' private: strings read sender {names['legacy']['sender']!r}, "
+          f"envelope reads {names['envelope']['sender']!r} -> {names['envelope']['target']!r}")
+    print(f"PRIVATE:b:ob:hi on the server: strings route to {names['legacy_request'][1]!r}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"results": results, "names": names}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+Cross-node latency of a federation of servers on one machine.
+
+    python -m benchmarks.federation_bench [--nodes 4] [--topology chain] [--pings 500] [--json out.json]
+
+Brings up --nodes servers on consecutive localhost ports, linked as a chain
+(n0 - n1 - n2 ...), a ring (chain plus n_last - n0) or a full mesh, with one
+user on each node and a second one on n0 as the local baseline. The user on
+n0 then sends --pings global messages every --interval-ms and one private
+message to the user on the last node; each receiver records how long every
+ping took to arrive. Reports p50/p99 per node, with its distance in links.
+"""
+import json
+import time
+import argparse
+import threading
+from server_core import create_server, ENGINES
+from client_core import ChatClient
+from federation import Federation
+from rate_limit import RateLimits
+from envelope import CHAT, PRIVATE
+
+
+PASSWORD = "benchmark"
+SECRET = "federation-benchmark"
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else 0.0
+
+
+def topology_links(nodes, topology):
+    """[(dialler, listener)] index pairs."""
+    links = [(i, i - 1) for i in range(1, nodes)]
+    if topology == "ring" and nodes > 2:
+        links.append((nodes - 1, 0))
+    elif topology == "mesh":
+        links = [(i, j) for i in range(nodes) for j in range(i)]
+    return links
+
+
+def distances(nodes, links):
+    """Links crossed from n0 to every node, by breadth-first search."""
+    neighbours = {i: set() for i in range(nodes)}
+    for a, b in links:
+        neighbours[a].add(b)
+        neighbours[b].add(a)
+    hops, frontier = {0: 0}, [0]
+    while frontier:
+        following = []
+        for node in frontier:
+            for neighbour in neighbours[node] - hops.keys():
+                hops[neighbour] = hops[node] + 1
+                following.append(neighbour)
+        frontier = following
+    return hops
+
+
+# ---------------- ONE RUN ----------------
+def run(engine, nodes, topology, pings, interval_ms, port):
+    links = topology_links(nodes, topology)
+    servers = []
+    for i in range(nodes):
+        peers = [("127.0.0.1", port + nodes + j) for a, j in links if a == i]
+        federation = Federation(f"n{i}", SECRET, listen=("127.0.0.1", port + nodes + i), peers=peers)
+        server = create_server(engine, host="127.0.0.1", port=port + i, password=PASSWORD,
+                               history_dir=None, federation=federation,
+                               limits=RateLimits.off()) # One sender pings far above a user's message rate
+        server.start(lambda message: None)
+        servers.append(server)
+
+    # Every link up before anyone logs in
+    deadline = time.monotonic() + 30
+    while sum(len(s.federation.snapshot()) for s in servers) < 2 * len(links):
+        if time.monotonic() > deadline:
+            raise SystemExit("Federation links did not come up")
+        time.sleep(0.05)
+
+    receivers = [("local", 0)] + [(f"n{i}", i) for i in range(1, nodes)]
+    latencies = {name: [] for name, _ in receivers}
+    private = []
+    sender = ChatClient("127.0.0.1", port, PASSWORD, "sender")
+    clients = [sender]
+    if not sender.start():
+        raise SystemExit(f"Could not log in: {sender.last_error_msg}")
+
+    def receive(client, samples):
+        while True:
+            message = client.receive_message()
+            if message is None:
+                return
+            if samples is not None and message.type in (CHAT, PRIVATE) and message.body.startswith(b"ping "):
+                sent = float(message.body[5:])
+                (private if message.type == PRIVATE else samples).append(time.perf_counter() - sent)
+
+    for name, i in receivers:
+        client = ChatClient("127.0.0.1", port + i, PASSWORD, f"user_{name}")
+        if not client.start():
+            raise SystemExit(f"Could not log in: {client.last_error_msg}")
+        clients.append(client)
+        threading.Thread(target=receive, args=(client, latencies[name]), daemon=True).start()
+    threading.Thread(target=receive, args=(sender, None), daemon=True).start() # Keeps its queue drained
+
+    target = f"user_n{nodes - 1}@n{nodes - 1}" if nodes > 1 else "user_local"
+    deadline = time.monotonic() + 10
+    while nodes > 1 and target not in servers[0].remote_users:
+        if time.monotonic() > deadline:
+            raise SystemExit(f"{target} never showed up on n0")
+        time.sleep(0.05)
+
+    for _ in range(pings):
+        sender.send_message(f"ping {time.perf_counter()}")
+        sender.send_message(f"ping {time.perf_counter()}", target=target)
+        time.sleep(interval_ms / 1000)
+    time.sleep(1.0)
+
+    for client in clients:
+        client.disconnect()
+    for server in servers:
+        server.stop()
+
+    hops = distances(nodes, links)
+    result = {"engine": engine, "nodes": nodes, "topology": topology, "pings": pings, "receivers": []}
+    for name, i in receivers:
+        samples = latencies[name]
+        result["receivers"].append({
+            "node": f"n{i}", "receiver": name, "hops": hops.get(i, 0), "received": len(samples),
+            "p50_ms": percentile(samples, 0.50) * 1000, "p99_ms": percentile(samples, 0.99) * 1000,
+        })
+    result["private"] = {"target": target, "received": len(private),
+                         "p50_ms": percentile(private, 0.50) * 1000, "p99_ms": percentile(private, 0.99) * 1000}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nodes", type=int, default=4)
+    parser.add_argument("--topology", choices=("chain", "ring", "mesh"), default="chain")
+    parser.add_argument("--engine", choices=ENGINES, default="thread")
+    parser.add_argument("--pings", type=int, default=500)
+    parser.add_argument("--interval-ms", type=float, default=5)
+    parser.add_argument("--port", type=int, default=5640, help="First of 2 x --nodes consecutive ports")
+    parser.add_argument("--json", help="Also write the result to this file")
+    args = parser.parse_args()
+
+    r = run(args.engine, args.nodes, args.topology, args.pings, args.interval_ms, args.port)
+    print(f"{r['nodes']} nodes, {r['topology']}, {r['engine']} engine, {r['pings']} pings")
+    print(f"{'receiver':<10}{'hops':>6}{'received':>10}{'p50 ms':>9}{'p99 ms':>9}")
+    for row in r["receivers"]:
+        print(f"{row['receiver']:<10}{row['hops']:>6}{row['received']:>10}{row['p50_ms']:>9.2f}{row['p99_ms']:>9.2f}")
+    p = r["private"]
+    print(f"private to {p['target']}: {p['received']} received, p50 {p['p50_ms']:.2f} ms, p99 {p['p99_ms']:.2f} ms")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(r, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,379 @@
+"""
+Headless load test: many simulated users against one server, results as JSON.
+
+    python -m benchmarks.load_bench [--users 1000] [--duration 60] [--rate 0.05] [--private 0.3]
+                                    [--churn 2] [--procs 4] [--engine thread] [--workers 1] [--json out.json]
+
+Unless --port points at a running server, starts one (--engine, --workers) in
+its own process. --procs generator processes log in --users ChatClients over
+--ramp seconds. Each user then sends --rate messages per second (Poisson),
+--private of them to a random other user. --churn users per second log out
+and back in. Every message carries its send time, so each delivery gives an
+end-to-end latency sample. Reports sent/delivered throughput, latency
+percentiles, the server's CPU and memory (from /proc, Linux only) and failure
+counts. --json writes everything, with the git revision, for comparing versions.
+"""
+import os
+import io
+import json
+import math
+import time
+import random
+import argparse
+import platform
+import functools
+import threading
+import subprocess
+import contextlib
+import multiprocessing
+from server_core import create_server, ENGINES
+from client_core import ChatClient, client_loop
+from envelope import CHAT, PRIVATE, NOTICE
+
+
+PASSWORD = "benchmark"
+TAG = b"lt "           # Message body: "lt <send time> <sender name>"
+DRAIN = 3.0            # Seconds to keep receiving after the last send
+BUCKET_GROWTH = 1.05   # Latency histogram resolution: 5% per bucket
+
+
+# ---------------- LATENCY HISTOGRAM ----------------
+# Log-spaced buckets: constant memory however many samples, and the
+# histograms of several processes merge by adding counts.
+def bucket_of(seconds):
+    return max(0, int(math.log(max(seconds, 1e-6) * 1e6, BUCKET_GROWTH)))
+
+
+def percentiles(histogram, fractions):
+    total = sum(histogram.values())
+    result, seen, ordered = {}, 0, sorted(histogram.items())
+    targets = sorted(fractions)
+    for bucket, count in ordered:
+        seen += count
+        while targets and seen >= targets[0] * total:
+            result[targets.pop(0)] = BUCKET_GROWTH ** (bucket + 1) / 1e3 # Upper edge, in ms
+    return result
+
+
+def raise_fd_limit():
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+# ---------------- SERVER PROCESS ----------------
+def serve(engine, workers, port, ready, stop):
+    raise_fd_limit()
+    server = create_server(engine, workers=workers, host="127.0.0.1", port=port, password=PASSWORD,
+                           history_dir=None, backlog=4096)
+    server.start(lambda message: None)
+    ready.set()
+    stop.wait()
+    server.stop()
+
+
+def process_tree(pid):
+    """pid and all its descendants (sharded servers run workers as children)."""
+    pids, index = [pid], 0
+    while index < len(pids):
+        try:
+            with open(f"/proc/{pids[index]}/task/{pids[index]}/children") as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+        index += 1
+    return pids
+
+
+def usage(pid):
+    """(CPU seconds, resident bytes) of a process tree, None off Linux."""
+    ticks, page = os.sysconf("SC_CLK_TCK"), os.sysconf("SC_PAGE_SIZE")
+    cpu = rss = 0
+    try:
+        for p in process_tree(pid):
+            with open(f"/proc/{p}/stat") as f:
+                fields = f.read().rpartition(")")[2].split()
+            cpu += (int(fields[11]) + int(fields[12])) / ticks # utime + stime
+            with open(f"/proc/{p}/statm") as f:
+                rss += int(f.read().split()[1]) * page
+    except (OSError, IndexError, ValueError):
+        return None
+    return cpu, rss
+
+
+# ---------------- LOAD GENERATOR (child process) ----------------
+class Generator:
+    def __init__(self, port, names, everyone, args):
+        self.port = port
+        self.names = names
+        self.everyone = everyone
+        self.args = args
+        self.rng = random.Random()
+        self.lock = threading.Lock()
+        self.online = {}                 # {name: ChatClient} logged in right now
+        self.tallies = {}                # {ChatClient: tally} not yet merged for good, see receive()
+        self.histogram = {}
+        self.counts = dict(sent=0, sent_private=0, delivered=0, login_failures=0, send_failures=0,
+                           disconnects=0, not_found=0, logins=0, churned=0)
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.counts[key] += n
+
+    def login(self, name):
+        client = ChatClient("127.0.0.1", self.port, PASSWORD, name)
+        client.auto_reconnect = False # A drop is a failure to count, not to hide
+        tally = [{}, 0]
+        # Every client of this process shares the client loop: no thread per user
+        client.on_message = functools.partial(self.receive, name, client, tally)
+        with self.lock:
+            self.tallies[client] = tally
+        if not client.start():
+            with self.lock:
+                self.tallies.pop(client, None)
+            self.count("login_failures")
+            return
+        with self.lock:
+            self.online[name] = client
+            self.counts["logins"] += 1
+
+    # Runs on the client loop for every message; `tally` is [histogram, delivered] since the last merge.
+    # None (the connection is gone) merges what is left, once.
+    def receive(self, name, client, tally, message):
+        if message is None:
+            with self.lock:
+                if self.tallies.pop(client, None) is None:
+                    return
+            self.merge(*tally)
+            with self.lock:
+                if self.online.get(name) is client: # Not a deliberate logout
+                    del self.online[name]
+                    self.counts["disconnects"] += 1
+            return
+        if message.type in (CHAT, PRIVATE) and message.body.startswith(TAG):
+            sent = float(message.body.split(b" ", 2)[1])
+            bucket = bucket_of(time.perf_counter() - sent)
+            histogram = tally[0]
+            histogram[bucket] = histogram.get(bucket, 0) + 1
+            tally[1] += 1
+            if tally[1] % 256 == 0:
+                self.merge(*tally)
+                tally[:] = [{}, 0]
+        elif message.type == NOTICE and message.text.endswith("not found."):
+            self.count("not_found")
+
+    def merge(self, histogram, delivered):
+        with self.lock:
+            for bucket, count in histogram.items():
+                self.histogram[bucket] = self.histogram.get(bucket, 0) + count
+            self.counts["delivered"] += delivered
+
+    def reset(self):
+        """Forgets what was delivered before the run, on the client loop: the tallies are only touched there."""
+        done = threading.Event()
+        def clear():
+            with self.lock:
+                for tally in self.tallies.values():
+                    tally[:] = [{}, 0]
+                self.counts["delivered"] = 0
+                self.histogram.clear()
+            done.set()
+        client_loop()[0].call_soon_threadsafe(clear)
+        done.wait()
+
+    def logout(self, name):
+        with self.lock:
+            client = self.online.pop(name, None)
+        if client is not None:
+            client.disconnect()
+
+    def logout_all(self, timeout=DRAIN):
+        """Logs everyone out and waits until every client's tally has been merged."""
+        for name in list(self.online):
+            self.logout(name)
+        deadline = time.perf_counter() + timeout
+        while self.tallies and time.perf_counter() < deadline:
+            time.sleep(0.01)
+
+    def random_online(self):
+        with self.lock:
+            return self.rng.choice(list(self.online.items())) if self.online else (None, None)
+
+    # Poisson arrivals at users x rate for the whole process
+    def send_loop(self, until):
+        rate = len(self.names) * self.args.rate
+        next_send = time.perf_counter()
+        while rate > 0 and next_send < until:
+            next_send += self.rng.expovariate(rate)
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            name, client = self.random_online()
+            if client is None:
+                continue
+            body = f"lt {time.perf_counter():.6f} {name}"
+            target = None
+            if self.rng.random() < self.args.private:
+                target = self.rng.choice(self.everyone)
+            if client.send_message(body, target=target):
+                self.count("sent_private" if target else "sent")
+            else:
+                self.count("send_failures")
+
+    def churn_loop(self, until):
+        rate = self.args.churn / self.args.procs
+        while rate > 0:
+            time.sleep(self.rng.expovariate(rate))
+            if time.perf_counter() >= until:
+                return
+            name, client = self.random_online()
+            if client is None:
+                continue
+            self.logout(name)
+            self.count("churned")
+            time.sleep(0.2) # Give the server the BYE first, or the name is still taken
+            self.login(name)
+
+
+def generate(port, names, everyone, args, barrier, results):
+    raise_fd_limit()
+    with contextlib.redirect_stdout(io.StringIO()): # ChatClient prints every login
+        generator = Generator(port, names, everyone, args)
+        spacing = args.ramp / max(1, len(names))
+        for name in names:
+            generator.login(name)
+            time.sleep(spacing)
+        barrier.wait()
+        until = time.perf_counter() + args.duration
+        generator.reset() # Only what arrives during the run counts
+        churn = threading.Thread(target=generator.churn_loop, args=(until,), daemon=True)
+        churn.start()
+        generator.send_loop(until)
+        time.sleep(DRAIN)
+        # Clients merge their tallies every 256 deliveries and when they disconnect,
+        # so the report waits for all of them
+        generator.logout_all()
+        with generator.lock:
+            report = {"counts": dict(generator.counts), "histogram": dict(generator.histogram)}
+    results.put(report)
+
+
+# ---------------- ONE RUN ----------------
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run(args):
+    context = multiprocessing.get_context("spawn")
+    server_process = stop = None
+    if args.server_pid is None and not args.external:
+        ready, stop = context.Event(), context.Event()
+        server_process = context.Process(target=serve, args=(args.engine, args.workers, args.port, ready, stop))
+        server_process.start()
+        if not ready.wait(60):
+            raise SystemExit("Server did not start")
+    server_pid = server_process.pid if server_process else args.server_pid
+
+    names = [f"load{i:05d}" for i in range(args.users)]
+    barrier = context.Barrier(args.procs + 1)
+    results = context.Queue()
+    generators = [context.Process(target=generate, args=(args.port, names[i::args.procs], names, args, barrier, results))
+                  for i in range(args.procs)]
+    for process in generators:
+        process.start()
+    barrier.wait(args.ramp + 600)
+
+    # Server CPU and memory, sampled through the run
+    samples, done = [], threading.Event()
+
+    def sample():
+        while not done.wait(0.5):
+            sample = usage(server_pid) if server_pid else None
+            if sample:
+                samples.append(sample)
+
+    before = usage(server_pid) if server_pid else None
+    start = time.perf_counter()
+    threading.Thread(target=sample, daemon=True).start()
+    reports = [results.get(timeout=args.duration + DRAIN + 600) for _ in generators]
+    after = usage(server_pid) if server_pid else None
+    wall = time.perf_counter() - start
+    done.set()
+    for process in generators:
+        process.join()
+    if server_process:
+        stop.set()
+        server_process.join(30)
+
+    counts, histogram = {}, {}
+    for report in reports:
+        for key, value in report["counts"].items():
+            counts[key] = counts.get(key, 0) + value
+        for bucket, value in report["histogram"].items():
+            histogram[bucket] = histogram.get(bucket, 0) + value
+    latency = percentiles(histogram, (0.5, 0.9, 0.99, 0.999, 1.0))
+    return {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "config": {key: value for key, value in vars(args).items() if key != "json"},
+        "seconds": args.duration,
+        "counts": counts,
+        "sent_per_s": (counts["sent"] + counts["sent_private"]) / args.duration,
+        "delivered_per_s": counts["delivered"] / args.duration,
+        "latency_ms": {"p50": latency.get(0.5), "p90": latency.get(0.9), "p99": latency.get(0.99),
+                       "p999": latency.get(0.999), "max": latency.get(1.0)},
+        "server": {
+            "cpu_percent": (after[0] - before[0]) / wall * 100 if before and after else None,
+            "rss_max_mb": max(rss for _, rss in samples) / (1 << 20) if samples else None,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=60, help="Seconds of load after every user logged in")
+    parser.add_argument("--ramp", type=float, default=10, help="Seconds to log everyone in")
+    parser.add_argument("--rate", type=float, default=0.05, help="Messages per second per user")
+    parser.add_argument("--private", type=float, default=0.3, help="Fraction of messages sent as private")
+    parser.add_argument("--churn", type=float, default=0, help="Users per second that log out and back in")
+    parser.add_argument("--procs", type=int, default=max(1, (os.cpu_count() or 2) // 2), help="Generator processes")
+    parser.add_argument("--engine", choices=ENGINES, default="thread")
+    parser.add_argument("--workers", type=int, default=1, help="Server processes (see sharding.py)")
+    parser.add_argument("--port", type=int, default=5597)
+    parser.add_argument("--external", action="store_true", help="Use the server already running on --port")
+    parser.add_argument("--server-pid", type=int, help="Watch this process's CPU/memory (with --external)")
+    parser.add_argument("--json", help="Also write the result to this file")
+    args = parser.parse_args()
+    if args.server_pid is not None:
+        args.external = True
+
+    r = run(args)
+    c, l, s = r["counts"], r["latency_ms"], r["server"]
+    print(f"{args.users} users, {args.rate:g} msg/s each ({args.private:.0%} private), churn {args.churn:g}/s, "
+          f"{r['seconds']:.0f}s, {args.engine} engine x{args.workers}")
+    print(f"sent {c['sent'] + c['sent_private']} ({r['sent_per_s']:.1f}/s), "
+          f"delivered {c['delivered']} ({r['delivered_per_s']:.0f}/s)")
+    if l["p50"] is not None:
+        print(f"latency ms: p50 {l['p50']:.2f}  p90 {l['p90']:.2f}  p99 {l['p99']:.2f}  "
+              f"p99.9 {l['p999']:.2f}  max {l['max']:.2f}")
+    if s["cpu_percent"] is not None:
+        print(f"server: {s['cpu_percent']:.0f}% CPU, {s['rss_max_mb']:.0f} MB RSS peak")
+    print(f"failures: {c['login_failures']} logins, {c['send_failures']} sends, {c['disconnects']} disconnects, "
+          f"{c['not_found']} private targets offline; {c['churned']} churned")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(r, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
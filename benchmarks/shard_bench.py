@@ -0,0 +1,128 @@
+"""
+Broadcast throughput of a sharded server as the number of worker processes grows.
+
+    python -m benchmarks.shard_bench [--workers 1,2,4] [--clients 64] [--messages 20] [--procs 4] [--json out.json]
+
+For each worker count, starts a server on 127.0.0.1 and logs --clients users
+in from --procs load generator processes (so the clients' own decryption does
+not cap the result on one core). Every user then sends --messages global chat
+lines as fast as it can; each line reaches every user, whichever shard they
+landed on. Reports delivered frames per second until the last user has all
+of them. Speedup needs as many free cores as workers plus generators.
+"""
+import os
+import json
+import time
+import argparse
+import threading
+import multiprocessing
+from server_core import create_server, ENGINES
+from client_core import ChatClient
+from rate_limit import RateLimits
+from envelope import CHAT
+
+
+PASSWORD = "benchmark"
+TIMEOUT = 300.0     # Seconds to wait for every delivery before giving up on a run
+
+
+# ---------------- LOAD GENERATOR (child process) ----------------
+def generate(port, names, senders, messages, barrier, results):
+    # Sends only queue now: leave room for every line, so none is refused while the writer catches up
+    clients = [ChatClient("127.0.0.1", port, PASSWORD, name, max_outbound=messages + 64) for name in names]
+    for client in clients:
+        if not client.start():
+            raise SystemExit(f"Could not log in: {client.last_error_msg}")
+    expected = senders * messages
+    counts = [0] * len(clients)
+    done = threading.Semaphore(0)
+
+    def receive(index, client):
+        while True:
+            message = client.receive_message()
+            if message is None:
+                return
+            if message.type == CHAT:
+                counts[index] += 1
+                if counts[index] == expected:
+                    done.release()
+
+    for index, client in enumerate(clients):
+        threading.Thread(target=receive, args=(index, client), daemon=True).start()
+
+    barrier.wait() # Everyone is logged in
+    barrier.wait() # Go
+    for n in range(messages):
+        for client in clients:
+            client.send_message(str(n))
+    finished = all(done.acquire(timeout=TIMEOUT) for _ in clients)
+    results.put({"received": sum(counts), "finished": time.monotonic(), "complete": finished})
+    for client in clients:
+        client.disconnect()
+
+
+# ---------------- ONE RUN ----------------
+def run(engine, workers, clients, messages, procs, port):
+    server = create_server(engine, workers=workers, host="127.0.0.1", port=port, password=PASSWORD,
+                           history_dir=None, send_queue_depth=clients * messages + 1024,
+                           limits=RateLimits.off()) # Every client sends all its lines at once
+    server.start(lambda message: None)
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(procs + 1)
+    results = context.Queue()
+    names = [f"load{i:03d}" for i in range(clients)]
+    generators = [context.Process(target=generate, args=(port, names[i::procs], clients, messages, barrier, results))
+                  for i in range(procs)]
+    for process in generators:
+        process.start()
+    barrier.wait(TIMEOUT)
+    time.sleep(0.5) # Let the join announcements settle on every shard
+    start = time.monotonic()
+    barrier.wait()
+    outcomes = [results.get(timeout=TIMEOUT + 30) for _ in generators]
+    for process in generators:
+        process.join()
+    server.stop()
+
+    elapsed = max(outcome["finished"] for outcome in outcomes) - start
+    received = sum(outcome["received"] for outcome in outcomes)
+    return {
+        "engine": engine,
+        "workers": workers,
+        "clients": clients,
+        "messages_per_client": messages,
+        "sent": clients * messages,
+        "delivered": received,
+        "complete": all(outcome["complete"] for outcome in outcomes),
+        "seconds": elapsed,
+        "deliveries_per_s": received / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", default="1,2,4", help="Comma separated worker counts to compare")
+    parser.add_argument("--engine", choices=ENGINES, default="thread")
+    parser.add_argument("--clients", type=int, default=64)
+    parser.add_argument("--messages", type=int, default=20, help="Chat lines sent by each client")
+    parser.add_argument("--procs", type=int, default=max(1, (os.cpu_count() or 2) // 2), help="Load generator processes")
+    parser.add_argument("--port", type=int, default=5598)
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{os.cpu_count()} CPUs, {args.clients} clients x {args.messages} messages, {args.procs} generator processes")
+    print(f"{'workers':>8}{'delivered':>11}{'seconds':>9}{'frames/s':>11}{'speedup':>9}")
+    for i, workers in enumerate(int(w) for w in args.workers.split(",")):
+        r = run(args.engine, workers, args.clients, args.messages, args.procs, args.port + i)
+        results.append(r)
+        speedup = r["deliveries_per_s"] / results[0]["deliveries_per_s"]
+        print(f"{workers:>8}{r['delivered']:>11}{r['seconds']:>9.2f}{r['deliveries_per_s']:>11.0f}{speedup:>8.2f}x"
+              f"{'' if r['complete'] else '  (incomplete)'}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+File transfer throughput over loopback, and what it does to chat latency.
+
+    python -m benchmarks.transfer_bench [--size-mb 2048] [--file big.iso] [--engine thread] [--json out.json]
+
+Starts a server and two clients on 127.0.0.1, sends one file from alice to
+bob through the server relay and checks the copy. While it streams, alice
+sends a chat line every --ping-ms and bob measures how long each took to
+arrive, so a transfer that starves chat shows up in p99. Without --file,
+--size-mb of random data is written to --dir first.
+"""
+import os
+import json
+import time
+import hashlib
+import argparse
+import tempfile
+import threading
+from server_core import create_server, ENGINES
+from client_core import ChatClient
+from rate_limit import RateLimits
+from file_transfer import DONE, CANCELLED, CHUNK_SIZE, WINDOW
+from envelope import CHAT, FILE_OFFER
+
+
+PASSWORD = "benchmark"
+
+
+def make_file(path, size_mb):
+    block = os.urandom(1 << 20)
+    with open(path, "wb") as f:
+        for i in range(size_mb):
+            f.write(block[i % 256:] + block[:i % 256]) # Shifted so no two blocks are alike
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else 0.0
+
+
+# ---------------- ONE RUN ----------------
+def run(engine, path, workdir, ping_ms, port, compression):
+    # The pings alone are above a user's message rate
+    server = create_server(engine, host="127.0.0.1", port=port, password=PASSWORD, history_dir=None,
+                           limits=RateLimits.off())
+    server.start(lambda message: None)
+    alice = ChatClient("127.0.0.1", port, PASSWORD, "alice", compression=compression)
+    bob = ChatClient("127.0.0.1", port, PASSWORD, "bob", compression=compression)
+    if not (alice.start() and bob.start()):
+        raise SystemExit(f"Could not log in: {alice.last_error_msg or bob.last_error_msg}")
+
+    target = os.path.join(workdir, "received.bin")
+    latencies = []
+
+    def receive(client):
+        while True:
+            message = client.receive_message()
+            if message is None:
+                return
+            if message.type == FILE_OFFER:
+                client.accept_file(message.target, target)
+            elif message.type == CHAT and message.sender == "alice" and message.body.startswith(b"ping "):
+                latencies.append(time.perf_counter() - float(message.body[5:]))
+
+    for client in (alice, bob):
+        threading.Thread(target=receive, args=(client,), daemon=True).start()
+
+    start = time.perf_counter()
+    transfer = alice.send_file("bob", path)
+    while transfer.state not in (DONE, CANCELLED):
+        alice.send_message(f"ping {time.perf_counter()}")
+        time.sleep(ping_ms / 1000)
+    elapsed = time.perf_counter() - start
+    time.sleep(0.2)
+
+    alice.disconnect()
+    bob.disconnect()
+    server.stop()
+    if transfer.state != DONE:
+        raise SystemExit(f"Transfer failed: {transfer.reason}")
+    return {
+        "engine": engine,
+        "compression": list(compression),
+        "size_bytes": transfer.size,
+        "seconds": elapsed,
+        "mb_per_s": transfer.size / elapsed / (1 << 20),
+        "chunk_bytes": CHUNK_SIZE,
+        "window_bytes": WINDOW,
+        "intact": file_digest(path) == file_digest(target),
+        "chat_pings": len(latencies),
+        "chat_p50_ms": percentile(latencies, 0.50) * 1000,
+        "chat_p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=2048)
+    parser.add_argument("--file", help="Send this file instead of generating one")
+    parser.add_argument("--dir", default=None, help="Where to write the generated and received files")
+    parser.add_argument("--engine", choices=ENGINES, default="thread")
+    parser.add_argument("--compression", default="zlib", help="Comma separated modes to offer, empty for none")
+    parser.add_argument("--ping-ms", type=float, default=20)
+    parser.add_argument("--port", type=int, default=5599)
+    parser.add_argument("--json", help="Also write the result to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as workdir:
+        path = args.file
+        if path is None:
+            path = os.path.join(workdir, "payload.bin")
+            print(f"Writing {args.size_mb} MB of test data...")
+            make_file(path, args.size_mb)
+        compression = tuple(mode for mode in args.compression.split(",") if mode)
+        r = run(args.engine, path, workdir, args.ping_ms, args.port, compression)
+
+    print(f"{r['engine']} engine: {r['size_bytes'] / (1 << 20):.0f} MB in {r['seconds']:.1f}s = {r['mb_per_s']:.0f} MB/s, "
+          f"{'intact' if r['intact'] else 'CORRUPTED'}")
+    print(f"chat during transfer: {r['chat_pings']} pings, p50 {r['chat_p50_ms']:.1f} ms, p99 {r['chat_p99_ms']:.1f} ms")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(r, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
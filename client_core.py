@@ -1,122 +1,518 @@
+import asyncio
+import queue
 import socket
 import threading
-import base64
+from bisect import bisect_left
+from collections import deque
 import time
-from cryptography.fernet import Fernet
+from framing import FrameBuffer, pack_frame, RECV_SIZE
+from fanout import SendQueue, POLICY_DISCONNECT
+from session_crypto import KeyExchange, CryptoError, DEFAULT_CODECS
+from compression import FrameCompressor, CompressionError, DEFAULT_MODES, MODES
+from handshake import (make_hello, new_nonce, parse_message, HandshakeError, REJECT, REJECT_PASSWORD, REJECT_DUPLICATE,
+                       REJECT_MALFORMED, REJECT_RESUME, REJECT_CODEC, REJECT_VERSION)
+from envelope import (Envelope, EnvelopeError, pack, unpack, parse_roster, CHAT, PRIVATE, ROOM_MSG, NOTICE, USERS, USER_JOINED,
+                      USER_LEFT, ACK, BYE, ROSTER_SYNC, HISTORY, JOIN, LEAVE, ROOMS, RELOGIN, FILE_DATA, FILE_TYPES)
+from rooms import normalize_room
+from file_transfer import TransferManager, CANCEL_USER, CANCEL_DISCONNECTED
+
+
+ACK_EVERY = 64              # Acknowledge received frames so the server can trim its replay buffer
+RECONNECT_TIMEOUT = 60.0    # Give up resuming after this many seconds
+RECONNECT_MAX_DELAY = 10.0  # Backoff between attempts doubles up to this
+CONNECT_TIMEOUT = 10.0      # Give up on a connect or handshake after this many seconds
+OUTBOUND_DEPTH = 1024       # Frames queued for the server before sends are refused
+DISCONNECT_TIMEOUT = 1.0    # How long disconnect() waits for the BYE to be written
+
+# What to tell the user for each handshake REJECT reason
+REJECT_MESSAGES = {
+    REJECT_PASSWORD: "Invalid password.",
+    REJECT_DUPLICATE: "Duplicate username. Please choose another.",
+    REJECT_MALFORMED: "The server did not understand the login request.",
+    REJECT_RESUME: "Session expired.",
+    REJECT_CODEC: "The server does not support any of our encryption codecs.",
+    REJECT_VERSION: "The server speaks a different protocol version.",
+}
+
+
+class Roster:
+    """
+    Sorted list of online users kept in sync from a USERS snapshot envelope
+    and USER_JOINED/USER_LEFT deltas. apply() returns the edits to mirror in a
+    view: ("reset", users), ("insert", index, name) or ("delete", index, name).
+    A gap in versions returns None: the caller should ask for a fresh snapshot.
+    """
+    def __init__(self, exclude=None):
+        self.exclude = exclude    # Our own name is never listed
+        self.users = []
+        self.version = None       # None until the first snapshot arrives
+
+    def apply(self, message):
+        kind = message.type
+        version, names = parse_roster(message.body)
+
+        if kind == USERS:
+            self.version = version
+            self.users = sorted(u for u in names if u and u != self.exclude)
+            return [("reset", list(self.users))]
+
+        if self.version is None or version <= self.version:
+            return [] # Waiting for a snapshot, or already covered by it
+        if version != self.version + 1:
+            self.version = None # Gap: ignore deltas until the resync snapshot
+            return None
+        self.version = version
+
+        # A delta may name several users; each name is brought to the stated state
+        edits = []
+        for name in names:
+            if not name or name == self.exclude:
+                continue
+            index = bisect_left(self.users, name)
+            present = index < len(self.users) and self.users[index] == name
+            if kind == USER_JOINED and not present:
+                self.users.insert(index, name)
+                edits.append(("insert", index, name))
+            elif kind == USER_LEFT and present:
+                del self.users[index]
+                edits.append(("delete", index, name))
+        return edits
+
+
+# ---------------- CLIENT LOOP ----------------
+# Every ChatClient in a process runs on one asyncio loop in a daemon thread:
+# the GUI thread only queues, and a bot or benchmark can hold hundreds of
+# connections without a thread for each.
+_loop = None
+_loop_thread_id = None
+_loop_lock = threading.Lock()
+
+
+def client_loop():
+    """(loop, id of the thread running it), started on first use."""
+    global _loop, _loop_thread_id
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_loop.run_forever, name="chat-client-loop", daemon=True)
+            thread.start()
+            _loop_thread_id = thread.ident
+        return _loop, _loop_thread_id
 
 
 class ChatClient:
-    def __init__(self, server_ip, server_port, password, username):
+    """
+    Connection to a chat server, run on the shared client loop. start() blocks
+    until we are logged in; everything else only queues and returns at once, so
+    a slow server never stalls the caller. Incoming envelopes go to
+    `on_message(envelope)` on the loop thread, or are read with the blocking
+    receive_message(); None marks the end of the connection either way.
+    """
+    def __init__(self, server_ip, server_port, password, username, codecs=DEFAULT_CODECS, compression=DEFAULT_MODES,
+                 on_message=None, max_outbound=OUTBOUND_DEPTH):
         self.server_ip = server_ip
         self.server_port = server_port
         self.password = password
         self.username = username
+        self.codecs = codecs     # Offered in the handshake, best first
+        self.compression = compression # Compression modes offered, () for none
 
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.cipher = None
+        self.loop, self.loop_thread_id = client_loop()
+        self.reader = None       # asyncio streams of the current connection
+        self.writer = None
+        self.buffer = None       # Frame reassembly for the reader
+        self.frames = deque()
+        self.codec = None
+        self.compressor = None
         self.running = True
         self.last_error_msg = "" # NEW: To store specific error messages
+        self.reject_reason = None
+        self.caps = ()           # Capabilities the server granted
+        self.rooms = set()       # Rooms we joined, rejoined after a new login
+
+        # Incoming messages: handed to on_message, or queued for receive_message()
+        self.inbox = queue.Queue()
+        self.on_message = on_message or self.inbox.put
+        self.receiver_task = None
+
+        # Outgoing frames wait here until the writer task sends them, coalesced
+        # into one write per wakeup; chunks go one at a time behind chat.
+        self.max_outbound = max_outbound
+        self.outbound = None
+        self.writer_task = None
+
+        # Session resumption: the server numbers every frame it sends us
+        self.session_token = None
+        self.last_seq = 0
+        self.unacked = 0
+        self.auto_reconnect = True
+        self.closing = threading.Event()  # Set by disconnect(), stops any reconnect attempt
+        self.transfers = TransferManager(self._send, self._send_chunk) # File transfers, see file_transfer.py
+
+    def _run(self, coro):
+        """Runs a coroutine on the client loop and waits for it; never call this from the loop itself."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def _open_socket(self):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.server_ip, self.server_port), CONNECT_TIMEOUT)
+        # Chat lines are tiny and the writer already batches: never hold one back for a fuller segment
+        self.writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = FrameBuffer()
+        self.frames.clear()
+
+    async def _read_frame(self):
+        """Returns the next frame, or None once the server has closed the connection."""
+        while not self.frames:
+            data = await self.reader.read(RECV_SIZE)
+            if not data:
+                return None
+            self.frames.extend(self.buffer.feed(data))
+        return self.frames.popleft()
 
     # ---------------- CONNECT TO SERVER ----------------
     def start(self):
-        self.last_error_msg = "" # Reset error message on each connection attempt
         try:
-            self.socket.connect((self.server_ip, self.server_port))
-
-            # Step 1: Send password for authentication
-            self.socket.send(self.password.encode('utf-8'))
-            response = self.socket.recv(1024)
-            if response == b"INVALID":
-                self.last_error_msg = "Invalid password."
-                print("❌ Invalid password.")
+            if not self._run(self._login()):
                 return False
+        except Exception as e:
+            self.last_error_msg = f"Connection failed: {e}"
+            print(f"❌ Connection failed: {e}")
+            return False
+        # Only now, so an on_message that waits on the thread calling start() (the Tk bridge) cannot deadlock
+        self.loop.call_soon_threadsafe(self._start_receiver)
+        return True
 
-            # Step 2: Decode encryption key and set up Fernet cipher
-            self.cipher = Fernet(base64.b64decode(response))
+    def _start_receiver(self):
+        if self.receiver_task is None or self.receiver_task.done():
+            self.receiver_task = self.loop.create_task(self._receive())
 
-            time.sleep(0.1)
+    async def _login(self):
+        self.last_error_msg = "" # Reset error message on each connection attempt
+        self.session_token = None
+        self.last_seq = 0
+        self.unacked = 0
+        self.transfers.abort_all(CANCEL_DISCONNECTED) # A new session knows nothing of the old one's transfers
+        try:
+            await self._open_socket()
 
-            # Step 3: Send username once encryption is ready
-            self.socket.send(self.username.encode('utf-8'))
-            
-            # Receive immediate feedback after sending username, could be DUPLICATE_USERNAME
-            # We use a non-blocking check here to see if there's an immediate response
-            # from the server, like a duplicate username rejection.
-            self.socket.settimeout(0.5) # Temporarily set a timeout
-            try:
-                initial_response_encrypted = self.socket.recv(4096)
-                if initial_response_encrypted:
-                    initial_response = self.cipher.decrypt(initial_response_encrypted).decode('utf-8')
-                    if initial_response == "DUPLICATE_USERNAME":
-                        self.last_error_msg = "Duplicate username. Please choose another."
-                        print("❌ Duplicate username.")
-                        self.socket.close()
-                        return False
-                    # If it's not a duplicate username message, process it as a regular message
-                    # This might be the initial USERS: list or a join message from another client
-                    # For now, we'll let receive_message handle it in the loop
-                    # For a robust solution, you might want to buffer this first message
-                    # or explicitly handle the initial USERS: response here.
-                    # For simplicity, we'll rely on _process_message in client_gui.py
-                    # to correctly handle the first incoming messages in the receiver_loop.
-
-            except socket.timeout:
-                pass # No immediate response, which is fine
-            except Exception as e:
-                self.last_error_msg = f"Error during initial server response: {e}"
-                print(f"❌ Error during initial server response: {e}")
-                self.socket.close()
+            if await self._handshake() is None:
                 return False
-            finally:
-                self.socket.settimeout(None) # Reset to blocking mode
 
+            # Fresh queue for a fresh session: the old one's ACKs mean nothing to it
+            if self.outbound:
+                self.outbound.close()
+            self.outbound = SendQueue(max_depth=self.max_outbound, policy=POLICY_DISCONNECT,
+                                      encode=self._seal, encode_bulk=self._seal_chunk)
+            self._start_writer()
             print("🟢 Connected successfully!")
             return True
 
         except Exception as e:
             self.last_error_msg = f"Connection failed: {e}"
             print(f"❌ Connection failed: {e}")
+            self._close_socket()
             return False
 
+    # One round trip: HELLO (password proof, username, key share, capabilities)
+    # out, WELCOME or REJECT back. Returns the WELCOME fields, or None if rejected.
+    async def _handshake(self, resume=None):
+        self.reject_reason = None
+        kex = KeyExchange() # Fresh keys for every connection, resumed or not
+        nonce = new_nonce()
+        hello = make_hello(self.password, self.username, nonce, kex.public_key(), self.codecs,
+                           resume=resume, compression=self.compression)
+        self.writer.write(pack_frame(hello))
+        response = await asyncio.wait_for(self._read_frame(), CONNECT_TIMEOUT)
+        if response is None:
+            raise OSError("Server closed the connection.")
+        kind, fields = parse_message(response)
+        if kind == REJECT:
+            self.reject_reason = fields.get("reason")
+            self.last_error_msg = REJECT_MESSAGES.get(self.reject_reason, f"Rejected by server: {self.reject_reason}")
+            print(f"❌ {self.last_error_msg}")
+            self._close_socket()
+            return None
+
+        self.codec = kex.derive(fields.get("pub"), self.password, nonce, True, fields.get("codec"))
+        mode = fields.get("compression")
+        self.compressor = FrameCompressor(mode) if mode in MODES else None
+        self.session_token = fields.get("token")
+        self.caps = tuple(fields.get("caps", ()))
+        return fields
+
     # ---------------- RECEIVE MESSAGES ----------------
-    def receive_message(self):
+    # Reads until the connection is gone for good. A dropped connection is
+    # resumed transparently; a NOTICE "🔄 Connection restored." or a RELOGIN
+    # (new session, fetch history since its ts) tells the caller.
+    async def _receive(self):
         try:
-            encrypted = self.socket.recv(4096)
-            if not encrypted:
-                return None
-            message = self.cipher.decrypt(encrypted).decode('utf-8')
-            return message
-        except Exception as e:
-            # print(f"Error receiving message: {e}") # Debugging
+            while True:
+                try:
+                    while True:
+                        encrypted = await self._read_frame()
+                        if encrypted is None:
+                            break
+                        message = self._decode(encrypted)
+                        if message is not None:
+                            self.on_message(message)
+                except (OSError, ValueError, CryptoError, CompressionError, EnvelopeError):
+                    pass # Treat a broken socket like EOF
+                except Exception as e:
+                    # print(f"Error receiving message: {e}") # Debugging
+                    return
+
+                self._close_socket()
+                if self.closing.is_set() or not self.auto_reconnect or not self.session_token:
+                    return
+                notice = await self._reconnect()
+                if notice is None:
+                    return
+                self.on_message(notice)
+        finally:
+            self._close_socket()
             self.running = False
+            self.on_message(None)
+
+    def receive_message(self):
+        """Blocks for the next message when no on_message was given; None once the connection is gone."""
+        message = self.inbox.get()
+        if message is None:
+            self.inbox.put(None) # Every later call returns None too
+        return message
+
+    # Skips frames replayed twice, acknowledges what we have, and keeps file
+    # transfer traffic to the TransferManager
+    def _decode(self, encrypted):
+        frame = self.codec.decrypt(encrypted)
+        if self.compressor:
+            frame = self.compressor.decompress(frame)
+        message = unpack(frame)
+        seq = message.seq
+        if seq: # File chunks and acks are not numbered
+            if seq <= self.last_seq:
+                return None
+            self.last_seq = seq
+            self.unacked += 1
+            if self.unacked >= ACK_EVERY:
+                self.unacked = 0
+                self._send(ACK, seq=seq, quiet=True)
+        if message.type == FILE_DATA:
+            return self.transfers.receive_chunk(message)
+        if message.type in FILE_TYPES:
+            return self.transfers.handle(message)
+        return message
+
+    # ---------------- RECONNECT ----------------
+    async def _reconnect(self):
+        """Retries with exponential backoff until the session is back, or returns None."""
+        dropped_at = time.time()
+        deadline = time.monotonic() + RECONNECT_TIMEOUT
+        delay = 0.5
+        while not self.closing.is_set() and time.monotonic() < deadline:
+            try:
+                return await self._resume(dropped_at)
+            except (OSError, asyncio.TimeoutError, HandshakeError, CryptoError) as e:
+                print(f"🔄 Reconnect failed ({e}), retrying in {delay:g}s")
+            self._close_socket()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+        return None
+
+    async def _resume(self, dropped_at):
+        await self._open_socket()
+        if await self._handshake(resume={"token": self.session_token, "last_seq": self.last_seq}):
+            print("🔄 Session resumed.")
+            self._start_writer() # Whatever was queued while we were away goes out now
+            self.transfers.resume()
+            return Envelope(NOTICE, "🔄 Connection restored.")
+        if self.reject_reason != REJECT_RESUME:
             return None
 
+        # Session expired (or the server restarted): log in again from scratch
+        if not await self._login():
+            return None
+        for room in sorted(self.rooms):
+            self._send(JOIN, target=room, quiet=True)
+        return Envelope(RELOGIN, ts=dropped_at)
+
     # ---------------- SEND PUBLIC OR PRIVATE MESSAGES ----------------
-    def send_message(self, msg, target=None):
+    def send_message(self, msg, target=None, room=None):
         """
         Sends a public message if target is None,
-        or a private message if target is provided.
+        a private message if target is provided,
+        or a message to a room we joined.
+        Returns False if it could not be sent.
         """
         if not msg.strip():
-            return
+            return False
 
         try:
             if target:
-                msg = f"PRIVATE:{target}:{msg}"
-            encrypted = self.cipher.encrypt(msg.encode('utf-8'))
-            self.socket.send(encrypted)
+                self._send(PRIVATE, msg, target=target)
+            elif room:
+                self._send(ROOM_MSG, msg, target=room)
+            else:
+                self._send(CHAT, msg)
+            return True
         except Exception as e:
             print(f"❌ Error sending message: {e}")
+            return False
+
+    # ---------------- ROOMS ----------------
+    # The server answers a JOIN with the room's member list (USERS for that room),
+    # also when we are already in it, which is how a room roster is resynced
+    def join_room(self, room):
+        """Returns the canonical room name, or None if the name is not valid."""
+        room = normalize_room(room.strip())
+        if room is None:
+            return None
+        try:
+            self._send(JOIN, target=room)
+            self.rooms.add(room)
+        except Exception as e:
+            print(f"❌ Error joining room: {e}")
+        return room
+
+    def leave_room(self, room):
+        self.rooms.discard(room)
+        try:
+            self._send(LEAVE, target=room)
+        except Exception as e:
+            print(f"❌ Error leaving room: {e}")
+
+    def request_rooms(self):
+        try:
+            self._send(ROOMS)
+        except Exception as e:
+            print(f"❌ Error requesting rooms: {e}")
+
+    # Asks the server for a full user list after a missed roster delta
+    def request_roster(self):
+        try:
+            self._send(ROSTER_SYNC)
+        except Exception as e:
+            print(f"❌ Error requesting user list: {e}")
+
+    # Asks for logged messages: after a log sequence number, since a unix time, or the latest
+    def request_history(self, after=0, since=0.0, limit=100):
+        try:
+            self._send(HISTORY, str(limit), seq=after, ts=since)
+        except Exception as e:
+            print(f"❌ Error requesting history: {e}")
+
+    # ---------------- FILE TRANSFER ----------------
+    def send_file(self, target, path):
+        """Offers a file to `target`; it streams once they accept. Returns the transfer, or None."""
+        try:
+            return self.transfers.offer(target, path)
+        except Exception as e:
+            print(f"❌ Error offering file: {e}")
+            return None
+
+    def accept_file(self, transfer_id, path):
+        try:
+            self.transfers.accept(transfer_id, path)
+        except Exception as e:
+            print(f"❌ Error accepting file: {e}")
+
+    def cancel_file(self, transfer_id, reason=CANCEL_USER):
+        try:
+            self.transfers.cancel(transfer_id, reason)
+        except Exception as e:
+            print(f"❌ Error cancelling file transfer: {e}")
+
+    # Queues a frame for the writer task; it raises OSError when the queue is
+    # full or closed, the way a failed socket send would
+    def _send(self, kind, body="", target="", seq=0, ts=0.0, quiet=False):
+        outbound = self.outbound
+        if (outbound is None or not outbound.put(pack(kind, body, target=target, seq=seq, ts=ts))) and not quiet:
+            raise OSError("Not connected" if outbound is None or outbound.closed else "Too many messages waiting to be sent")
+
+    def _send_chunk(self, chunk):
+        if self.outbound is None or not self.outbound.put_bulk(chunk):
+            raise OSError("File chunk lane is full")
+
+    # Run by the writer as it takes frames, so compression and encryption see them in send order
+    def _seal(self, data):
+        if self.compressor:
+            data = self.compressor.compress(data)
+        return pack_frame(self.codec.encrypt(data))
+
+    def _seal_chunk(self, data):
+        if self.compressor:
+            data = self.compressor.compress(data, skip=True)
+        return pack_frame(self.codec.encrypt(data))
+
+    # ---------------- OUTBOUND QUEUE WRITER ----------------
+    # One writer task per connection. A wakeup drains everything queued so far
+    # in one writelines() call; drain() waits out a slow server here, not in
+    # the thread that queued the message.
+    def _start_writer(self):
+        ready = asyncio.Event()
+        def wakeup(): # Sends come from the GUI and transfer threads as well as the loop
+            if threading.get_ident() == self.loop_thread_id:
+                ready.set()
+            else:
+                self.loop.call_soon_threadsafe(ready.set)
+        self.outbound.wakeup = wakeup
+        ready.set() # Flush anything queued before the writer existed
+        self.writer_task = self.loop.create_task(self._drain_outbound(self.writer, self.outbound, ready))
+
+    async def _drain_outbound(self, writer, outbound, ready):
+        try:
+            while not writer.is_closing():
+                await ready.wait()
+                ready.clear()
+                while not writer.is_closing():
+                    batch = outbound.take_batch()
+                    if not batch:
+                        break
+                    writer.writelines(batch)
+                    await writer.drain()
+                if outbound.closed:
+                    return
+        except (ConnectionError, OSError):
+            pass # The receiver notices the broken connection and resumes it
 
     # ---------------- DISCONNECT ----------------
-    def disconnect(self):
+    def disconnect(self, timeout=DISCONNECT_TIMEOUT):
+        """Logs out. Waits up to `timeout` seconds for the BYE to be written; 0 returns at once."""
+        self.running = False
+        self.closing.set()
+        future = asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop)
+        if timeout:
+            try:
+                future.result(timeout)
+            except Exception as e:
+                print(f"Error during disconnect: {e}")
+
+    async def _shutdown(self):
         try:
-            self.running = False
-            # Attempt a graceful shutdown if socket is still connected
-            if self.socket:
-                self.socket.shutdown(socket.SHUT_RDWR)
-                self.socket.close()
-        except OSError: # Socket might already be closed
-            pass
+            if self.writer and self.codec:
+                self._send(BYE, quiet=True) # Deliberate logout: the server need not hold our session
+            self.transfers.abort_all(CANCEL_DISCONNECTED)
+            await asyncio.wait_for(self._flush(), DISCONNECT_TIMEOUT)
         except Exception as e:
-            print(f"Error during disconnect: {e}")
\ No newline at end of file
+            print(f"Error during disconnect: {e}")
+        if self.outbound:
+            self.outbound.close()
+        self._close_socket()
+        if self.receiver_task:
+            self.receiver_task.cancel() # Stops a reconnect in progress; the receiver reports the end
+        else:
+            self.on_message(None)
+
+    async def _flush(self):
+        while self.outbound and self.outbound.depth() and self.writer and not self.writer.is_closing():
+            await asyncio.sleep(0.001)
+        if self.writer and not self.writer.is_closing():
+            await self.writer.drain()
+
+    def _close_socket(self):
+        if self.writer_task:
+            self.writer_task.cancel()
+            self.writer_task = None
+        if self.writer:
+            self.writer.close() # Sends what the transport still holds, then closes
+            self.writer = None
@@ -1,10 +1,16 @@
 # LANChatApp/client/client_gui.py
 import tkinter as tk
-from tkinter import ttk, scrolledtext, messagebox
+from tkinter import ttk, scrolledtext, messagebox, filedialog
 import threading
 import time
+import json
+from collections import deque
 from datetime import datetime
-from client_core import ChatClient  # expects the ChatClient class in client_core.py
+from client_core import ChatClient, Roster  # expects the ChatClient class in client_core.py
+from envelope import (CHAT, PRIVATE, ROOM_MSG, NOTICE, USERS, USER_JOINED, USER_LEFT, HISTORY_PAGE, ROOM_LIST,
+                      FILE_OFFER, RELOGIN)
+from file_transfer import ACTIVE, WAITING, CANCEL_DECLINED, describe_size
+from presence import describe_names
 
 
 # ---------------- UI COLORS & STYLES ----------------
@@ -13,9 +19,23 @@ TOP_BG = "#1f6feb"
 TAB_ACTIVE_BG = "#4ea1ff"
 GLOBAL_TAB_COLOR = "#e9f2ff"
 PRIVATE_TAB_COLOR = "#fff7e6"
+ROOM_TAB_COLOR = "#eefaf0"
 MSG_FONT = ("Segoe UI", 10)
 TIMESTAMP_FMT = "%H:%M"
 
+# Render pipeline: incoming messages are drained on the Tk thread in frame-sized slices
+FRAME_BUDGET = 0.008        # Seconds of message processing allowed per slice
+INBOX_EVENT = "<<Inbox>>"    # Posted by the client loop when messages arrive for an idle window
+
+# Scrollback: each tab's text widget holds a bounded number of messages,
+# older ones move to an in-memory ring and are paged back when scrolled to.
+SCROLLBACK_MESSAGES = 2000  # Messages kept in the widget
+TRIM_SLACK = 250            # Trim in bulk once this many messages over the cap
+ARCHIVE_MESSAGES = 20000    # Trimmed messages remembered per tab (oldest are forgotten)
+PAGE_SIZE = 200             # Messages restored per scroll to the top
+
+TRANSFERS_REFRESH_MS = 250  # Progress view redraw cadence
+
 # Chat bubble specific colors
 SENT_MSG_COLOR = "#DCF8C6"  # Light green for sent messages
 REC_MSG_COLOR = "#FFFFFF"  # White for received messages
@@ -23,10 +43,50 @@ JOIN_LEAVE_COLOR = "#90A4AE" # Grey for join/leave notifications
 TEXT_COLOR = "#212121"      # Dark text for readability
 
 
+# ---------------- CLIENT LOOP -> TK BRIDGE ----------------
+class InboxBridge:
+    """
+    Hands messages from the client loop thread to the Tk thread. put() never
+    blocks on Tk beyond posting one virtual event, and only for the first
+    message after the window has caught up; the rest just queue until the
+    window drains them. None (end of connection) is queued like a message, so
+    whatever arrived before it is still rendered first.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.messages = deque()
+        self.lock = threading.Lock()
+        self.posted = False           # An INBOX_EVENT is on its way, or the window is draining
+
+    def put(self, msg):
+        with self.lock:
+            self.messages.append((time.monotonic(), msg))
+            if self.posted:
+                return
+            self.posted = True
+        try:
+            # event_generate is the one Tk call that is safe from another thread (threaded Tcl)
+            self.root.event_generate(INBOX_EVENT, when="tail")
+        except (RuntimeError, tk.TclError):
+            pass # The window is gone
+
+    def take(self):
+        """Next (queued_at, msg), or None once empty, after which the next put() posts again."""
+        with self.lock:
+            if self.messages:
+                return self.messages.popleft()
+            self.posted = False
+            return None
+
+    def __len__(self):
+        return len(self.messages)
+
+
 class TabChat:
     """Helper container for tab widgets (each tab has its own text widget)"""
-    def __init__(self, parent_notebook, title, bg_color):
+    def __init__(self, parent_notebook, title, bg_color, max_messages=SCROLLBACK_MESSAGES):
         self.title = title
+        self.max_messages = max_messages
         self.frame = tk.Frame(parent_notebook, bg=bg_color)
         
         # Changed to tk.Text for more control over tags and alignment
@@ -36,6 +96,7 @@ class TabChat:
             foreground=TEXT_COLOR # Default text color for general content
         )
         self.text.pack(fill="both", expand=True, padx=6, pady=6)
+        self.text.configure(yscrollcommand=self._on_scroll)
 
         # Configure tags for message styling
         # lmargin1: indent for first line, lmargin2: indent for subsequent lines
@@ -44,27 +105,100 @@ class TabChat:
         self.text.tag_configure("sent", background=SENT_MSG_COLOR, lmargin1=150, lmargin2=150, rmargin=10, justify="right", wrap="word")
         self.text.tag_configure("received", background=REC_MSG_COLOR, lmargin1=10, lmargin2=10, rmargin=150, justify="left", wrap="word")
         self.text.tag_configure("info", foreground=JOIN_LEAVE_COLOR, justify="center", font=(MSG_FONT[0], 9, "italic"), wrap="word") # For join/leave messages, slightly smaller/italic
+
+        self.pending = []   # Flat [text, tag, text, tag, ...] waiting for the next flush
+        self.shown = deque()                             # (text, tag) currently in the widget, oldest first
+        self.archive = deque(maxlen=ARCHIVE_MESSAGES)    # (text, tag) trimmed from the top, oldest first
+        self.paging = False
         
 
     def display_message(self, sender, message, is_self=False, is_info=False):
-        self.text.config(state="normal")
-        
-        timestamp = datetime.now().strftime(TIMESTAMP_FMT)
+        self.queue_message(sender, message, is_self, is_info)
+        self.flush(follow=True) # Our own message: always jump to it
+
+    # Formats a message for the next flush without touching the widget
+    def queue_message(self, sender, message, is_self=False, is_info=False, sent_at=None):
+        timestamp = (datetime.fromtimestamp(sent_at) if sent_at else datetime.now()).strftime(TIMESTAMP_FMT)
         
         if is_info:
-            full_msg = f"  {message}  \n" # Add some padding for info messages
-            self.text.insert("end", full_msg, "info")
+            self.pending += (f"  {message}  \n", "info") # Add some padding for info messages
         elif is_self:
             # For sent messages, we embed timestamp
-            full_msg = f"{message} [{timestamp}]\n"
-            self.text.insert("end", full_msg, "sent")
+            self.pending += (f"{message} [{timestamp}]\n", "sent")
         else:
             # For received messages, show sender, message, and timestamp
-            full_msg = f"{sender}: {message} [{timestamp}]\n"
-            self.text.insert("end", full_msg, "received")
-            
+            self.pending += (f"{sender}: {message} [{timestamp}]\n", "received")
+
+    # One insert and one scroll for everything queued since the last flush.
+    # Only follows new messages if the user was already at the bottom.
+    def flush(self, follow=False):
+        if not self.pending:
+            return
+        follow = follow or self.text.yview()[1] >= 1.0
+        self.text.config(state="normal")
+        self.text.insert("end", *self.pending)
+        self.shown.extend(zip(self.pending[0::2], self.pending[1::2]))
+        # While the user reads old messages we leave the top alone, up to twice the cap
+        if follow or len(self.shown) > 2 * self.max_messages:
+            self._trim()
         self.text.config(state="disabled")
-        self.text.see("end")
+        if follow:
+            self.text.see("end")
+        self.pending = []
+
+    # Moves the oldest messages from the widget to the archive, in one delete
+    def _trim(self):
+        excess = len(self.shown) - self.max_messages
+        if excess < TRIM_SLACK:
+            return
+        lines = 0
+        for _ in range(excess):
+            entry = self.shown.popleft()
+            lines += entry[0].count("\n")
+            self.archive.append(entry)
+        self.text.delete("1.0", f"{lines + 1}.0")
+
+    # ---------------- lazy history paging ----------------
+    def _on_scroll(self, first, last):
+        if float(first) <= 0.0 and self.archive and not self.paging:
+            self.paging = True
+            self.text.after_idle(self._page_back)
+
+    # Restores the newest archived page above what is shown, keeping the view in place
+    def _page_back(self):
+        try:
+            count = min(PAGE_SIZE, len(self.archive))
+            entries = [self.archive.pop() for _ in range(count)]
+            entries.reverse()
+            lines = sum(text.count("\n") for text, _ in entries)
+            self.text.config(state="normal")
+            self.text.insert("1.0", *[part for entry in entries for part in entry])
+            self.text.config(state="disabled")
+            self.shown.extendleft(reversed(entries))
+            self.text.yview(f"{lines + 1}.0")
+        finally:
+            self.paging = False
+
+
+class RoomTab(TabChat):
+    """A room's chat, with a strip showing its members and a leave button"""
+    def __init__(self, parent_notebook, room, own_name, on_leave):
+        super().__init__(parent_notebook, f"#{room}", ROOM_TAB_COLOR)
+        self.room = room
+        self.roster = Roster(exclude=own_name) # Kept in sync like the global user list
+
+        strip = tk.Frame(self.frame, bg=ROOM_TAB_COLOR)
+        strip.pack(fill="x", before=self.text)
+        self.members_label = tk.Label(strip, text="", bg=ROOM_TAB_COLOR, fg=JOIN_LEAVE_COLOR,
+                                      font=(MSG_FONT[0], 9), anchor="w")
+        self.members_label.pack(side="left", fill="x", expand=True, padx=6)
+        leave_btn = tk.Button(strip, text="Leave room", bg="#ff6b6b", fg="white", relief="flat",
+                              command=lambda: on_leave(room))
+        leave_btn.pack(side="right", padx=6, pady=(4,0))
+
+    def show_members(self):
+        names = self.roster.users
+        self.members_label.config(text=f"{len(names) + 1} members: you" + (f", {describe_names(names)}" if names else ""))
 
 
 class ClientGUI:
@@ -77,8 +211,33 @@ class ClientGUI:
         self.client = None
         self.username = None
 
-        self.users = set()            # current known online users
+        self.roster = Roster()        # current known online users
         self.private_tabs = {}        # username -> TabChat
+        self.room_tabs = {}           # room -> RoomTab
+        self.room_picker = None       # Join dialog, open while shown
+        self.disconnected_at = None   # When we last lost the server, to fetch what we missed
+        self.history_shown = False
+        self.transfers_window = None  # Progress view, open while shown
+
+        # Client loop -> Tk thread hand-off, drained in frame-budgeted batches
+        self.inbox = None
+        self.root.bind(INBOX_EVENT, lambda event: self._drain_inbox(self.inbox))
+        self.render_stats = {"backlog": 0, "last_batch": 0, "last_latency_ms": 0.0, "max_latency_ms": 0.0}
+
+        # Incoming envelopes by type, see _process_message
+        self.handlers = {
+            CHAT: self._on_chat,
+            PRIVATE: self._on_private,
+            ROOM_MSG: self._on_room_message,
+            NOTICE: self._on_notice,
+            USERS: self._on_roster,
+            USER_JOINED: self._on_roster,
+            USER_LEFT: self._on_roster,
+            HISTORY_PAGE: self._on_history_page,
+            ROOM_LIST: lambda msg: self._show_room_picker(msg.json()),
+            FILE_OFFER: self._on_file_offer,
+            RELOGIN: self._on_relogin,
+        }
 
         # Build connect UI first
         self._build_connect_ui()
@@ -136,8 +295,9 @@ class ClientGUI:
             messagebox.showwarning("Missing", "Fill all fields before connecting.")
             return
 
-        # create client and connect
-        self.client = ChatClient(ip, port, password, username)
+        # create client and connect; it runs on its own loop and only queues for us
+        self.inbox = InboxBridge(self.root) # Fresh per connection, so nothing stale leaks into the next one
+        self.client = ChatClient(ip, port, password, username, on_message=self.inbox.put)
         ok = self.client.start()
         if not ok:
             # Check if connection failed due to specific error messages captured by client_core
@@ -151,9 +311,12 @@ class ClientGUI:
             return
 
         self.username = username
-        # build main UI and start receiver thread
+        self.roster = Roster(exclude=username)
+        # build main UI; what arrived meanwhile waits in the inbox and is drawn on the next drain
         self._build_main_ui()
-        threading.Thread(target=self.receiver_loop, daemon=True).start()
+        # Catch up: everything since we dropped off, or just the latest messages on a first login
+        self.history_shown = False
+        self.client.request_history(since=self.disconnected_at or 0.0)
 
     # ---------------- Main UI ----------------
     def _build_main_ui(self):
@@ -170,6 +333,18 @@ class ClientGUI:
                                    relief="flat", command=self.disconnect)
         disconnect_btn.pack(side="right", padx=12, pady=8)
 
+        rooms_btn = tk.Button(header, text="Rooms", bg="#4ea1ff", fg="white",
+                              relief="flat", command=self.client.request_rooms) # The picker opens on the reply
+        rooms_btn.pack(side="right", padx=(6,0), pady=8)
+
+        transfers_btn = tk.Button(header, text="Transfers", bg="#4ea1ff", fg="white",
+                                  relief="flat", command=self.show_transfers)
+        transfers_btn.pack(side="right", pady=8)
+
+        # Render pipeline diagnostics: queued messages and how long the last one waited
+        self.stats_label = tk.Label(header, text="", bg=TOP_BG, fg="#cfe0ff", font=("Segoe UI", 8))
+        self.stats_label.pack(side="right", padx=6)
+
         # Left: online users
         left = tk.Frame(self.root, bg="#f0f4f8", width=200)
         left.pack(side="left", fill="y")
@@ -192,6 +367,8 @@ class ClientGUI:
         style.configure("TNotebook.Tab", padding=[12, 6], font=("Segoe UI", 10, "bold"))
         style.map("TNotebook.Tab", background=[("selected", TAB_ACTIVE_BG)])
 
+        self.private_tabs = {} # Tabs of a previous connection died with the old notebook
+        self.room_tabs = {}
         self.notebook = ttk.Notebook(right)
         self.notebook.pack(fill="both", expand=True, padx=6, pady=8)
 
@@ -211,6 +388,10 @@ class ClientGUI:
                              command=self._on_send)
         send_btn.pack(side="right")
 
+        file_btn = tk.Button(bottom, text="📎 File", bg="#e0e7ef", relief="flat",
+                             command=self._on_send_file)
+        file_btn.pack(side="right", padx=(0,6))
+
     # ---------------- open private tab via users list ----------------
     def _open_private_tab_from_list(self, event=None):
         sel = None
@@ -225,9 +406,11 @@ class ClientGUI:
             return
         self.open_private_tab(sel)
 
-    def open_private_tab(self, username):
+    def open_private_tab(self, username, select=True):
         # if already exists, switch to it
         if username in self.private_tabs:
+            if not select:
+                return
             # Find the tab's index by iterating through notebook frames
             for i, frame_id in enumerate(self.notebook.tabs()):
                 if frame_id == str(self.private_tabs[username].frame):
@@ -239,7 +422,8 @@ class ClientGUI:
         tab = TabChat(self.notebook, username, PRIVATE_TAB_COLOR)
         self.private_tabs[username] = tab
         self.notebook.add(tab.frame, text=username)
-        self.notebook.select(tab.frame) # Switch to the new tab
+        if select:
+            self.notebook.select(tab.frame) # Switch to the new tab
 
     # ---------------- sending messages ----------------
     def _on_send(self):
@@ -255,6 +439,10 @@ class ClientGUI:
             self.client.send_message(text)
             # Display immediately in your own global tab as 'sent'
             self.global_tab.display_message(self.username, text, is_self=True)
+        elif any(str(tab.frame) == sel for tab in self.room_tabs.values()):
+            tab = next(tab for tab in self.room_tabs.values() if str(tab.frame) == sel)
+            self.client.send_message(text, room=tab.room)
+            tab.display_message(self.username, text, is_self=True) # The server's echo is skipped
         else:
             # private tab: find which username
             target = None
@@ -269,124 +457,322 @@ class ClientGUI:
                     break
         self.msg_entry.delete(0, "end")
 
-    # ---------------- receiver loop ----------------
-    def receiver_loop(self):
-        # Ensure UI built
-        # This loop waits for the UI to be ready before proceeding,
-        # preventing errors if messages arrive before elements exist.
-        while not hasattr(self, "notebook") or not self.notebook.winfo_exists():
-            time.sleep(0.05)
-            if not self.client or not self.client.running: # Check if client disconnected while waiting
-                return
-
-        while self.client and self.client.running:
-            try:
-                msg = self.client.receive_message()
-                if not msg:
-                    # connection probably closed, or an error occurred
-                    # Use a small delay to allow UI to finish current processing before disconnecting
-                    self.root.after(100, self.disconnect)
-                    break
-                # process message on the GUI thread
-                self.root.after(0, self._process_message, msg)
-            except Exception as e:
-                # Catch exceptions during message reception
-                print(f"Error in receiver loop: {e}")
-                self.root.after(100, self.disconnect)
-                break
-
-
-    # ---------------- process incoming messages ----------------
-    def _process_message(self, msg):
-        # Handle server rejecting duplicate username - this would be an internal client_core message
-        # If client_core handles it and reports via last_error_msg, client_gui doesn't need to display it as a chat msg.
-        if msg == "DUPLICATE_USERNAME":
-            # This is an internal message, already handled by client.start() logic, so just ignore it here.
+    # ---------------- rooms ----------------
+    def open_room_tab(self, room, select=True):
+        tab = self.room_tabs.get(room)
+        if tab is None:
+            tab = self.room_tabs[room] = RoomTab(self.notebook, room, self.username, self._leave_room)
+            # Rooms sit between Global and the private tabs
+            position = len(self.room_tabs)
+            self.notebook.insert(position if position < len(self.notebook.tabs()) else "end", tab.frame, text=f"#{room}")
+        if select:
+            self.notebook.select(tab.frame)
+        return tab
+
+    def _leave_room(self, room):
+        tab = self.room_tabs.pop(room, None)
+        if self.client:
+            self.client.leave_room(room)
+        if tab:
+            self.notebook.forget(tab.frame)
+            tab.frame.destroy()
+
+    # Tab for anything addressed to a room, or None if we already left it
+    def _room_tab(self, room):
+        tab = self.room_tabs.get(room)
+        if tab is None:
+            if room not in self.client.rooms:
+                return None # Sent before the server saw us leave
+            tab = self.open_room_tab(room, select=False)
+        return tab
+
+    def _on_room_message(self, msg):
+        tab = self._room_tab(msg.target)
+        if tab is not None and msg.sender != self.username: # Our own lines were shown by _on_send
+            tab.queue_message(msg.sender, msg.text, is_self=False, sent_at=msg.ts)
+
+    def _on_room_roster(self, msg):
+        tab = self._room_tab(msg.target)
+        if tab is None:
             return
-
-        # Check for system messages first:
-        if msg.startswith("USERS:"): # Handles updated user list (Issue 1)
-            try:
-                user_list_str = msg.split(":", 1)[1]
-                # Filter out own username and empty strings, then convert to set
-                users = {u.strip() for u in user_list_str.split(",") if u.strip() and u.strip() != self.username}
-                
-                # Clear and update self.users set
-                self.users.clear()
-                self.users.update(users)
-                
-                # Update listbox
-                self.users_listbox.delete(0, "end")
-                for u in sorted(list(self.users)): # Display sorted for consistency
-                    self.users_listbox.insert("end", u)
-            except Exception as e:
-                self.global_tab.display_message(None, f"Error processing user list: {e}", is_info=True)
+        edits = tab.roster.apply(msg)
+        if edits is None:
+            self.client.join_room(msg.target) # Missed a delta: joining again resends the member list
+        elif edits:
+            tab.show_members()
+
+    # Lists the biggest rooms (ROOM_LIST reply) with a field for any other name
+    def _show_room_picker(self, listing):
+        if self.room_picker is None:
+            window = self.room_picker = tk.Toplevel(self.root)
+            window.title("Rooms")
+            window.geometry("300x360")
+            window.protocol("WM_DELETE_WINDOW", self._close_room_picker)
+
+            tk.Label(window, text="Join or create a room:").pack(anchor="w", padx=8, pady=(8,2))
+            self.room_entry = ttk.Entry(window)
+            self.room_entry.pack(fill="x", padx=8)
+            self.room_entry.bind("<Return>", lambda e: self._join_from_picker())
+
+            self.rooms_listbox = tk.Listbox(window, font=MSG_FONT, activestyle="none")
+            self.rooms_listbox.pack(fill="both", expand=True, padx=8, pady=8)
+            self.rooms_listbox.bind("<Double-Button-1>", lambda e: self._join_from_picker(from_list=True))
+
+            join_btn = tk.Button(window, text="Join", bg=TOP_BG, fg="white", relief="flat",
+                                 command=self._join_from_picker)
+            join_btn.pack(side="right", padx=8, pady=(0,8))
+        self.room_names = [name for name, _ in listing]
+        self.rooms_listbox.delete(0, "end")
+        if listing:
+            self.rooms_listbox.insert("end", *(f"#{name} ({count})" for name, count in listing))
+        self.room_picker.lift()
+        self.room_entry.focus_set()
+
+    def _join_from_picker(self, from_list=False):
+        name = self.room_entry.get().strip().lstrip("#")
+        selection = self.rooms_listbox.curselection()
+        if (from_list or not name) and selection:
+            name = self.room_names[selection[0]]
+        if not name:
             return
-        
-        # 1) If it's a join/leave message
-        # We no longer rely on these to update the user listbox (USERS: messages do that),
-        # but we still display them in global chat as info.
-        if msg.startswith("🟢 ") and " joined the chat" in msg:
-            self.global_tab.display_message(None, msg, is_info=True) # Display as info
+        room = self.client.join_room(name)
+        if room is None:
+            messagebox.showwarning("Rooms", "Room names are 1-32 letters, digits, '-' or '_'.", parent=self.room_picker)
+            return
+        self._close_room_picker()
+        self.open_room_tab(room)
+
+    def _close_room_picker(self):
+        if self.room_picker is not None:
+            self.room_picker.destroy()
+            self.room_picker = None
+
+    # ---------------- file transfer ----------------
+    # Files go to the user of the selected private tab; progress is polled
+    # from the client's transfer table, never pushed through the inbox.
+    def _on_send_file(self):
+        sel = self.notebook.select()
+        target = next((user for user, tab in self.private_tabs.items() if str(tab.frame) == sel), None)
+        if target is None:
+            messagebox.showinfo("Send file", "Open a private tab with the user you want to send a file to.")
+            return
+        path = filedialog.askopenfilename(title=f"Send a file to {target}")
+        if not path:
             return
+        transfer = self.client.send_file(target, path)
+        if transfer:
+            self.private_tabs[target].display_message(None, f"📁 Offered '{transfer.name}' ({describe_size(transfer.size)})", is_info=True)
+            self.show_transfers()
 
-        if msg.startswith("🔴 ") and " left the chat" in msg:
-            self.global_tab.display_message(None, msg, is_info=True) # Display as info
+    def _ask_file_offer(self, transfer):
+        if self.client is None or transfer.state != WAITING:
             return
+        accept = messagebox.askyesno(
+            "Incoming file", f"{transfer.peer} wants to send you '{transfer.name}' ({describe_size(transfer.size)}).\n\nAccept?")
+        path = filedialog.asksaveasfilename(title="Save file as", initialfile=transfer.name) if accept else None
+        if self.client is None:
+            return
+        if path:
+            self.client.accept_file(transfer.id, path)
+            self.show_transfers()
+        else:
+            self.client.cancel_file(transfer.id, CANCEL_DECLINED)
 
-        # 2) Private messages from server: format server sends: "💬 [Private] sender: message"
-        if msg.startswith("💬 [Private]"):
+    def show_transfers(self):
+        if self.transfers_window is not None:
+            self.transfers_window.lift()
+            return
+        window = self.transfers_window = tk.Toplevel(self.root)
+        window.title("File Transfers")
+        window.geometry("640x260")
+        window.protocol("WM_DELETE_WINDOW", self._close_transfers)
+
+        columns = ("file", "peer", "progress", "size", "speed", "state")
+        self.transfers_view = ttk.Treeview(window, columns=columns, show="headings", selectmode="browse")
+        for column, width in zip(columns, (200, 90, 80, 80, 90, 90)):
+            self.transfers_view.heading(column, text=column.capitalize())
+            self.transfers_view.column(column, width=width, anchor="w")
+        self.transfers_view.pack(fill="both", expand=True, padx=6, pady=6)
+
+        cancel_btn = tk.Button(window, text="Cancel transfer", bg="#ff6b6b", fg="white", relief="flat",
+                               command=self._cancel_selected_transfer)
+        cancel_btn.pack(side="right", padx=6, pady=(0,6))
+        self._refresh_transfers()
+
+    def _refresh_transfers(self):
+        if self.transfers_window is None:
+            return
+        if self.client is None:
+            self._close_transfers()
+            return
+        for row in self.client.transfers.snapshot():
+            arrow = "⬆" if row["direction"] == "out" else "⬇"
+            percent = 100 * row["bytes"] / row["size"] if row["size"] else 100
+            speed = f"{describe_size(row['rate'])}/s" if row["state"] == ACTIVE else ""
+            state = row["state"] if not row["reason"] else f"{row['state']} ({row['reason']})"
+            values = (f"{arrow} {row['name']}", row["peer"], f"{percent:.0f}%", describe_size(row["size"]), speed, state)
+            if self.transfers_view.exists(row["id"]):
+                if self.transfers_view.item(row["id"], "values") != values: # Skip rows that did not change
+                    self.transfers_view.item(row["id"], values=values)
+            else:
+                self.transfers_view.insert("", "end", iid=row["id"], values=values)
+        self.transfers_window.after(TRANSFERS_REFRESH_MS, self._refresh_transfers)
+
+    def _cancel_selected_transfer(self):
+        selected = self.transfers_view.selection()
+        if selected and self.client:
+            self.client.cancel_file(selected[0])
+
+    def _close_transfers(self):
+        if self.transfers_window is not None:
+            self.transfers_window.destroy()
+            self.transfers_window = None
+
+    # ---------------- render pipeline ----------------
+    # Drains the inbox on the Tk thread for at most FRAME_BUDGET seconds, then
+    # writes each touched tab with a single insert and scroll. Runs while there
+    # is a backlog; an idle window waits for the bridge's next INBOX_EVENT.
+    def _drain_inbox(self, inbox):
+        if inbox is None or inbox is not self.inbox:
+            return # Disconnected, or reconnected with a new client and a new inbox
+        deadline = time.monotonic() + FRAME_BUDGET
+        count = 0
+        disconnected = False
+        empty = False
+        latency = 0.0
+        while time.monotonic() < deadline:
+            item = inbox.take()
+            if item is None:
+                empty = True
+                break
+            queued_at, msg = item
+            if msg is None:
+                disconnected = True
+                break
             try:
-                rest = msg.replace("💬 [Private] ", "", 1)
-                sender, content = rest.split(":", 1)
-                sender = sender.strip()
-                content = content.strip()
-            except Exception:
-                # If parsing fails, treat as general info
-                self.global_tab.display_message(None, msg, is_info=True)
-                return
+                self._process_message(msg)
+            except Exception as e: # One bad message must not stop the pipeline
+                print(f"Error processing message: {e}")
+            count += 1
+            latency = time.monotonic() - queued_at
+
+        for tab in (self.global_tab, *self.room_tabs.values(), *self.private_tabs.values()):
+            tab.flush()
+
+        stats = self.render_stats
+        stats["backlog"] = len(inbox)
+        if count:
+            stats["last_batch"] = count
+            stats["last_latency_ms"] = latency * 1000
+            stats["max_latency_ms"] = max(stats["max_latency_ms"], latency * 1000)
+        status = f"backlog {stats['backlog']} · {stats['last_latency_ms']:.0f} ms"
+        if status != self.stats_label.cget("text"): # Skip the redraw when nothing changed
+            self.stats_label.config(text=status)
+
+        if disconnected:
+            self.disconnect()
+        elif not empty:
+            # Out of budget with messages left: yield to Tk for a moment, then catch up
+            self.root.after(1, self._drain_inbox, inbox)
+
 
-            # --- MODIFIED (for Issue 2) ---
-            # If this private message is an echo of *our own* sent message,
-            # and we have already displayed it in _on_send (as is_self=True),
-            # then simply return to avoid duplicate display in the sender's own tab.
-            if sender == self.username:
-                # The _on_send method already ensured the tab is open and displayed the message.
-                # So we simply ignore the server's echo back to us.
-                return 
-
-            # If it's a private message from another user, ensure their tab is open and display
-            if sender not in self.private_tabs:
-                self.open_private_tab(sender)
-            
-            # Display in that tab as a 'received' message
-            self.private_tabs[sender].display_message(sender, content, is_self=False)
+    # ---------------- process incoming messages ----------------
+    # One dictionary lookup per message: every envelope type has its handler
+    def _process_message(self, msg):
+        handler = self.handlers.get(msg.type)
+        if handler is not None:
+            handler(msg)
+
+    def _on_chat(self, msg):
+        # Our own lines were shown by _on_send when we sent them, skip the server's copy
+        if msg.sender != self.username:
+            self.global_tab.queue_message(msg.sender, msg.text, is_self=False, sent_at=msg.ts)
+
+    def _on_private(self, msg):
+        if msg.sender == self.username:
+            return # The server's echo of what _on_send already displayed
+        if msg.sender not in self.private_tabs:
+            self.open_private_tab(msg.sender)
+        self.private_tabs[msg.sender].queue_message(msg.sender, msg.text, is_self=False, sent_at=msg.ts)
+
+    # Join/leave summaries, errors, file transfer notices and connection events
+    def _on_notice(self, msg):
+        tab = self._room_tab(msg.target) if msg.target else self.global_tab
+        if tab is not None:
+            tab.queue_message(None, msg.text, is_info=True)
+
+    def _on_roster(self, msg):
+        if msg.target: # The room's own roster
+            self._on_room_roster(msg)
             return
-        
-        # 3) Regular broadcast messages (your own messages are handled by _on_send,
-        # and filtered out here to avoid duplicates. Others' broadcasts are displayed.)
         try:
-            sender, content = msg.split(":", 1)
-            sender = sender.strip()
-            content = content.strip()
-            
-            # If the broadcast message is from ourselves, and we've already displayed it locally, skip it.
-            # This avoids duplicate messages (one immediately displayed, one from server broadcast).
-            if sender == self.username:
-                return 
-            
-            self.global_tab.display_message(sender, content, is_self=False) # Display as received
-        except ValueError:
-            # If message doesn't fit "sender: content" format (e.g., server announcements not already caught)
-            self.global_tab.display_message(None, msg, is_info=True)
+            edits = self.roster.apply(msg)
+            if edits is None:
+                # Missed a delta: ask for a fresh snapshot instead of guessing
+                self.client.request_roster()
+                return
+            self._apply_roster_edits(edits)
+        except Exception as e:
+            self.global_tab.queue_message(None, f"Error processing user list: {e}", is_info=True)
+
+    def _on_history_page(self, msg):
+        try:
+            self._show_history(msg.json())
+        except Exception as e:
+            self.global_tab.queue_message(None, f"Error processing history: {e}", is_info=True)
+
+    def _on_file_offer(self, msg): # Asked outside the render pipeline, the dialog is modal
+        transfer = self.client.transfers.get(msg.target)
+        if transfer:
+            self.root.after_idle(self._ask_file_offer, transfer)
+
+    def _on_relogin(self, msg): # Our session expired while we were away: fetch what we missed from the log
+        self.global_tab.queue_message(None, "🔄 Reconnected with a new session.", is_info=True)
+        self.client.request_history(since=msg.ts)
+
+
+    # Renders one page of logged messages in the right tabs, then asks for the next
+    def _show_history(self, page):
+        records = page["messages"]
+        if records and not self.history_shown:
+            self.history_shown = True
+            self.global_tab.queue_message(None, "📜 Earlier messages", is_info=True)
+        for record in records:
+            sender = record["sender"]
+            is_self = sender == self.username
+            if record["kind"] == "private":
+                other = record["target"] if is_self else sender
+                self.open_private_tab(other, select=False)
+                tab = self.private_tabs[other]
+            else:
+                tab = self.global_tab
+            tab.queue_message(sender, record["body"], is_self=is_self, sent_at=record["ts"])
+        if page["next"] is not None:
+            self.client.request_history(page["next"])
+
+    # Mirrors roster edits in the listbox without rebuilding it
+    def _apply_roster_edits(self, edits):
+        for edit in edits:
+            if edit[0] == "reset":
+                self.users_listbox.delete(0, "end")
+                if edit[1]:
+                    self.users_listbox.insert("end", *edit[1])
+            elif edit[0] == "insert":
+                self.users_listbox.insert(edit[1], edit[2])
+            elif edit[0] == "delete":
+                self.users_listbox.delete(edit[1])
 
 
     # ---------------- disconnect ----------------
     def disconnect(self):
         try:
             if self.client:
-                self.client.disconnect()
+                self.disconnected_at = time.time()
+                self.client.disconnect(timeout=0) # The BYE goes out from the client loop, the window never waits
                 self.client = None # Clear client object
+                self.inbox = None
+                self._close_transfers()
+                self._close_room_picker()
         except Exception as e:
             print(f"Error during GUI disconnect process: {e}")
         finally:
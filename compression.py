@@ -0,0 +1,132 @@
+import zlib
+import threading
+from functools import lru_cache
+from framing import MAX_FRAME_SIZE
+
+
+# Negotiated in the handshake, like the codec. Compression happens before
+# encryption; every frame then starts with one of the flags below.
+MODE_ZLIB = "zlib"                 # Each frame compressed on its own: one result serves every recipient
+MODE_ZLIB_STREAM = "zlib-stream"   # One deflate context per connection: better ratio, costs CPU per recipient
+MODES = (MODE_ZLIB_STREAM, MODE_ZLIB)
+DEFAULT_MODES = (MODE_ZLIB,)       # What a client offers unless told otherwise
+
+FLAG_RAW = b"\x00"
+FLAG_ZLIB = b"\x01"
+FLAG_STREAM = b"\x02"
+
+MIN_COMPRESS = 128    # Frames smaller than this are sent as they are
+SHARED_MAX = 64 * 1024   # Larger frames are compressed without caching the result
+LEVEL = 6
+SYNC_TAIL = b"\x00\x00\xff\xff"   # Ends every Z_SYNC_FLUSH block, so it is stripped on the wire
+
+# Preset dictionary: the strings our frames are made of, so even a single
+# short frame finds matches. Most frequent last (closest to the data).
+DICTIONARY = (
+    '","target":null,"body":"'
+    '{"messages":[{"seq":'
+    ',"ts":1700000000.0,"kind":"global","sender":"'
+    ',"kind":"private","sender":"'
+    '"next":null}'
+    '❌  not found.'
+    ' left the chat.🔴 '
+    ' joined the chat.🟢 '
+    ' and  others'
+    ' the and you to is it that for on are this with have what'
+).encode('utf-8')
+
+
+class CompressionError(Exception):
+    """Raised when a compressed frame cannot be expanded."""
+
+
+def deflate(data):
+    """Stateless deflate with the preset dictionary."""
+    compressor = zlib.compressobj(LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=DICTIONARY)
+    return compressor.compress(data) + compressor.flush()
+
+
+# Broadcasts hand the same bytes object to every recipient's writer, so
+# with a cache each one is compressed once (bytes cache their own hash).
+deflate_shared = lru_cache(maxsize=256)(deflate)
+
+
+class FrameCompressor:
+    """
+    Compression for one connection, both directions. compress() runs on the
+    sending side only and decompress() on the receiving side only, each from
+    a single thread. Keeps the counters behind stats().
+    """
+    def __init__(self, mode, threshold=MIN_COMPRESS):
+        if mode not in MODES:
+            raise ValueError(f"Unknown compression mode '{mode}', expected one of {', '.join(MODES)}")
+        self.mode = mode
+        self.threshold = threshold
+        self.deflater = None
+        self.inflater = None
+        if mode == MODE_ZLIB_STREAM:
+            self.deflater = zlib.compressobj(LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=DICTIONARY)
+            self.inflater = zlib.decompressobj(-zlib.MAX_WBITS, zdict=DICTIONARY)
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.compressed_frames = 0
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+
+    # ---------------- SEND ----------------
+    def compress(self, data, skip=False):
+        """`skip` sends the frame as it is (file chunks, usually compressed already)."""
+        if skip or len(data) < self.threshold:
+            frame = FLAG_RAW + data
+        elif self.deflater:
+            packed = self.deflater.compress(data) + self.deflater.flush(zlib.Z_SYNC_FLUSH)
+            frame = FLAG_STREAM + packed[:-len(SYNC_TAIL)] # Always fed to the peer's context, even if larger
+        else:
+            packed = deflate_shared(data) if len(data) <= SHARED_MAX else deflate(data)
+            frame = FLAG_ZLIB + packed if len(packed) < len(data) else FLAG_RAW + data
+        with self.lock:
+            self.frames += 1
+            self.raw_bytes += len(data)
+            self.wire_bytes += len(frame)
+            if frame[:1] != FLAG_RAW:
+                self.compressed_frames += 1
+        return frame
+
+    # ---------------- RECEIVE ----------------
+    def decompress(self, frame):
+        flag, body = frame[:1], frame[1:]
+        if flag == FLAG_RAW:
+            return body
+        try:
+            if flag == FLAG_ZLIB:
+                inflater = zlib.decompressobj(-zlib.MAX_WBITS, zdict=DICTIONARY)
+                data = inflater.decompress(body, MAX_FRAME_SIZE)
+            elif flag == FLAG_STREAM and self.inflater:
+                inflater = self.inflater
+                data = inflater.decompress(body + SYNC_TAIL, MAX_FRAME_SIZE)
+            else:
+                raise CompressionError(f"Unexpected compression flag {flag!r}")
+        except zlib.error as e:
+            raise CompressionError(f"Corrupt compressed frame: {e}")
+        if inflater.unconsumed_tail:
+            raise CompressionError(f"Frame expands past {MAX_FRAME_SIZE} bytes")
+        return data
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "frames": self.frames,
+            "compressed_frames": self.compressed_frames,
+            "raw_bytes": self.raw_bytes,
+            "wire_bytes": self.wire_bytes,
+            "ratio": round(self.wire_bytes / self.raw_bytes, 3) if self.raw_bytes else 1.0,
+        }
+
+
+def choose_mode(offered, allowed=MODES):
+    """First compression mode in the client's list that we allow, or None for no compression."""
+    if isinstance(offered, list):
+        for mode in offered:
+            if isinstance(mode, str) and mode in allowed and mode in MODES:
+                return mode
+    return None
@@ -0,0 +1,136 @@
+import json
+import struct
+
+
+# ---------------- WIRE FORMAT ----------------
+# Every frame after the handshake is one envelope, in both directions. It is
+# compressed and sealed like any other frame; inside the seal it reads:
+#
+#   version  u8    ENVELOPE_VERSION, bumped whenever this layout changes
+#   type     u8    one of the ids below
+#   seq      u64   frame number on numbered server frames; ACK and HISTORY
+#                  carry a sequence number here; 0 otherwise
+#   ts       f64   unix time the server sent it, 0.0 from clients
+#   sender   u16 length + UTF-8, set by the server, ignored from clients
+#   target   u16 length + UTF-8: user, room or transfer id, depending on type
+#   body     the rest: UTF-8 text, JSON, or raw bytes depending on type
+#
+# Names and text are length prefixed or last, so ':' or '|' in a username,
+# room or message never changes how a frame is routed.
+ENVELOPE_VERSION = 1
+HEADER = struct.Struct("!BBQdHH")
+MAX_FIELD = 0xFFFF         # Longest sender or target, in bytes
+
+# Chat, both ways
+CHAT = 1                   # Global chat line
+PRIVATE = 2                # target: the other user
+ROOM_MSG = 3               # target: the room
+NOTICE = 4                 # Server text for the user (joins, errors); target: the room, if about one
+
+# Rosters, server -> client. target: the room, or "" for everyone online.
+# body: the roster version, then one name per line (names are printable, see pack_roster)
+USERS = 5                  # Full snapshot
+USER_JOINED = 6            # Delta: these users are in
+USER_LEFT = 7              # Delta: these users are out
+
+# Requests, client -> server, and their answers
+ACK = 10                   # seq: every frame up to here is processed
+BYE = 11                   # Deliberate logout
+ROSTER_SYNC = 12           # Send a fresh USERS snapshot
+HISTORY = 13               # seq: after this log seq, ts: since this unix time (0: latest); body: limit
+HISTORY_PAGE = 14          # body: {"messages": [...], "next": <seq or null>}
+JOIN = 15                  # target: the room; answered with its USERS
+LEAVE = 16                 # target: the room
+ROOMS = 17                 # List the rooms
+ROOM_LIST = 18             # body: [[room, members], ...]
+
+# File transfers, see file_transfer.py
+FILE_OFFER = 20            # To the server target is the receiver, from it sender is the sender; body: {"id", "name", "size"}
+FILE_ACCEPT = 21           # target: transfer id; body: offset to send from
+FILE_ACK = 22              # target: transfer id; body: offset written so far
+FILE_CANCEL = 23           # target: transfer id; body: reason
+FILE_DATA = 24             # target: transfer id; body: 8 byte offset + raw data
+
+# Never on the wire: ChatClient.receive_message() reports connection events with these
+RELOGIN = 200              # New session after an expired one; ts: when the old one dropped
+
+TYPE_NAMES = {value: name for name, value in globals().items()
+              if name.isupper() and isinstance(value, int) and name not in ("ENVELOPE_VERSION", "MAX_FIELD")}
+FILE_TYPES = (FILE_OFFER, FILE_ACCEPT, FILE_ACK, FILE_CANCEL, FILE_DATA)
+
+
+class EnvelopeError(ValueError):
+    """Raised when a frame is not a valid envelope."""
+
+
+class Envelope:
+    """One decoded frame. `frame` keeps the bytes it came from, so relays can forward them untouched."""
+    __slots__ = ("type", "body", "sender", "target", "seq", "ts", "frame")
+
+    def __init__(self, type, body=b"", sender="", target="", seq=0, ts=0.0, frame=None):
+        self.type = type
+        self.body = body.encode('utf-8') if isinstance(body, str) else body
+        self.sender = sender
+        self.target = target
+        self.seq = seq
+        self.ts = ts
+        self.frame = frame
+
+    @property
+    def text(self):
+        return self.body.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.body)
+
+    def pack(self):
+        return pack(self.type, self.body, self.sender, self.target, self.seq, self.ts)
+
+    def __repr__(self):
+        return (f"Envelope({TYPE_NAMES.get(self.type, self.type)}, sender={self.sender!r}, target={self.target!r}, "
+                f"seq={self.seq}, body={bytes(self.body[:40])!r})")
+
+
+# ---------------- ENCODE / DECODE ----------------
+def pack(kind, body=b"", sender="", target="", seq=0, ts=0.0):
+    if body.__class__ is str:
+        body = body.encode('utf-8')
+    sender = sender.encode('utf-8') if sender else b""
+    target = target.encode('utf-8') if target else b""
+    try:
+        header = HEADER.pack(ENVELOPE_VERSION, kind, seq, ts, len(sender), len(target))
+    except struct.error as e: # A name longer than MAX_FIELD bytes, or a field out of range
+        raise EnvelopeError(f"Cannot pack envelope: {e}")
+    return b"".join((header, sender, target, body))
+
+
+def unpack(frame):
+    try:
+        version, kind, seq, ts, sender_length, target_length = HEADER.unpack_from(frame)
+    except struct.error:
+        raise EnvelopeError(f"Frame of {len(frame)} bytes is too short for an envelope")
+    if version != ENVELOPE_VERSION:
+        raise EnvelopeError(f"Unsupported envelope version {version}")
+    start = HEADER.size
+    middle = start + sender_length
+    end = middle + target_length
+    if end > len(frame):
+        raise EnvelopeError("Envelope fields run past the end of the frame")
+    try:
+        sender = frame[start:middle].decode('utf-8') if sender_length else ""
+        target = frame[middle:end].decode('utf-8') if target_length else ""
+    except UnicodeDecodeError as e:
+        raise EnvelopeError(f"Malformed name in envelope: {e}")
+    return Envelope(kind, frame[end:], sender, target, seq, ts, frame)
+
+
+# ---------------- ROSTER BODIES ----------------
+def pack_roster(version, users):
+    """The server only accepts printable usernames, so a newline never appears inside one."""
+    return "\n".join((str(version), *users))
+
+
+def parse_roster(body):
+    """(version, [names]) of a USERS/USER_JOINED/USER_LEFT body."""
+    version, *users = body.decode('utf-8').split("\n")
+    return int(version), users
@@ -0,0 +1,153 @@
+import socket
+import threading
+from collections import deque
+
+
+# What to do when a client's outbound queue is full
+POLICY_DROP = "drop"               # Drop the new frame for that client and count it
+POLICY_DISCONNECT = "disconnect"   # Treat the client as dead and disconnect it
+POLICIES = (POLICY_DROP, POLICY_DISCONNECT)
+
+MAX_BATCH_BYTES = 256 * 1024       # Upper bound on what one writer wakeup sends in a single call
+BULK_DEPTH = 256                   # File chunks a connection may have queued (senders' windows keep it lower)
+DRAIN_TIMEOUT = 5.0                # Seconds a stopping server waits for queued frames to reach its clients
+
+
+class SendQueue:
+    """
+    Bounded outbound queue for one connection. Broadcasters only append
+    shared, already encoded payloads here; a dedicated writer drains it, so a
+    slow client never stalls the thread that is fanning a message out.
+
+    `encode` turns a payload into wire bytes as the writer takes it (the
+    per-connection encryption), so frames are sealed in the order they are
+    sent and a dropped frame never costs an encryption.
+
+    File chunks wait in a separate bulk lane (`encode_bulk`) that is drained
+    one chunk per write, after every chat frame queued so far, so a transfer
+    never delays chat by more than one chunk.
+    """
+    def __init__(self, max_depth=1024, policy=POLICY_DISCONNECT, encode=None, encode_bulk=None, max_bulk=BULK_DEPTH):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown slow client policy '{policy}', expected one of {', '.join(POLICIES)}")
+        self.max_depth = max_depth
+        self.policy = policy
+        self.encode = encode
+        self.encode_bulk = encode_bulk or encode
+        self.frames = deque()
+        self.bulk = deque()
+        self.max_bulk = max_bulk
+        self.lock = threading.Lock()
+        self.wakeup = lambda: None   # Installed by whichever writer drains this queue
+        self.closed = False
+        self.in_flight = 0           # Frames of the last batch, until the writer comes back for more
+
+        # Counters exposed through ChatServer.queue_stats()
+        self.dropped = 0
+        self.sent_frames = 0
+        self.sent_bytes = 0
+        self.high_water = 0
+
+    def put(self, frame):
+        """Queues a frame. Returns False when the client should be disconnected."""
+        with self.lock:
+            if self.closed:
+                return False
+            if len(self.frames) >= self.max_depth:
+                self.dropped += 1
+                return self.policy == POLICY_DROP
+            self.frames.append(frame)
+            if len(self.frames) > self.high_water:
+                self.high_water = len(self.frames)
+        self.wakeup()
+        return True
+
+    def put_bulk(self, frame):
+        """Queues a file chunk behind chat frames. Returns False when the bulk lane is full."""
+        with self.lock:
+            if self.closed or len(self.bulk) >= self.max_bulk:
+                return False
+            self.bulk.append(frame)
+        self.wakeup()
+        return True
+
+    def take_batch(self, max_bytes=MAX_BATCH_BYTES):
+        """Pops as many queued frames as fit in one write (at least one), encoded. Single consumer only."""
+        batch = []
+        size = 0
+        chunk = None
+        with self.lock:
+            while self.frames and (not batch or size + len(self.frames[0]) <= max_bytes):
+                frame = self.frames.popleft()
+                batch.append(frame)
+                size += len(frame)
+            if self.bulk and (not batch or size + len(self.bulk[0]) <= max_bytes):
+                chunk = self.bulk.popleft()
+            # Writers only ask again once the previous batch is written
+            self.in_flight = len(batch) + (chunk is not None)
+        if self.encode and batch:
+            batch = [self.encode(frame) for frame in batch]
+        if chunk is not None:
+            batch.append(self.encode_bulk(chunk) if self.encode_bulk else chunk)
+        if self.encode or chunk is not None:
+            size = sum(len(frame) for frame in batch)
+        with self.lock:
+            self.sent_frames += len(batch)
+            self.sent_bytes += size
+        return batch
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.frames.clear()
+            self.bulk.clear()
+        self.wakeup()
+
+    def depth(self):
+        return len(self.frames)
+
+    def unsent(self):
+        """Frames not written yet: queued in either lane, or taken by a write still under way."""
+        with self.lock:
+            return len(self.frames) + len(self.bulk) + self.in_flight
+
+    def stats(self):
+        return {
+            "depth": len(self.frames),
+            "bulk_depth": len(self.bulk),
+            "high_water": self.high_water,
+            "dropped": self.dropped,
+            "sent_frames": self.sent_frames,
+            "sent_bytes": self.sent_bytes,
+        }
+
+
+# ---------------- THREAD ENGINE WRITER ----------------
+def start_socket_writer(conn, queue, on_error):
+    """Starts a writer thread that drains `queue` into a blocking socket."""
+    ready = threading.Event()
+    queue.wakeup = ready.set
+    ready.set() # Flush anything queued before the writer existed
+
+    def run():
+        try:
+            while True:
+                ready.wait()
+                ready.clear()
+                while True:
+                    batch = queue.take_batch()
+                    if not batch:
+                        break
+                    # One sendall per batch: frames queued while we were blocked go out together
+                    conn.sendall(batch[0] if len(batch) == 1 else b"".join(batch))
+                if queue.closed:
+                    return
+        except OSError as e:
+            if not queue.closed:
+                try:
+                    conn.shutdown(socket.SHUT_RDWR) # Wakes the reader thread so it can clean up
+                except OSError:
+                    pass
+                on_error(conn, e)
+
+    threading.Thread(target=run, daemon=True).start()
@@ -0,0 +1,331 @@
+import re
+import json
+import time
+import socket
+import itertools
+import threading
+from collections import OrderedDict
+from framing import FrameReader, FrameError, pack_frame
+from fanout import SendQueue, start_socket_writer, POLICY_DISCONNECT
+from session_crypto import KeyExchange, CryptoError, CODECS, choose_codec
+from handshake import (ProofVerifier, HandshakeError, parse_message, pack_message, make_hello, new_nonce,
+                       PROTOCOL_VERSION, HELLO, WELCOME, REJECT, REJECT_PASSWORD, REJECT_DUPLICATE,
+                       REJECT_MALFORMED, REJECT_CODEC)
+
+
+FEDERATION_PORT = 5556
+NODE_NAME = re.compile(r"^[A-Za-z0-9_.-]{1,32}$")
+MAX_HOPS = 8                # An event is dropped after crossing this many links
+SEEN_EVENTS = 8192          # Event ids remembered for dedup
+LINK_QUEUE_DEPTH = 16384    # Events queued for a neighbour before the link is dropped
+RETRY_MIN, RETRY_MAX = 1.0, 30.0   # Reconnect backoff of outgoing links, in seconds
+CAP_FEDERATION = "federation"
+
+# Links are TCP connections between nodes, authenticated and encrypted like a
+# client connection (HELLO with the node name as username, proved with the
+# shared federation secret). After the handshake both ends send a "joined"
+# for every user they know of, then events flow as JSON frames:
+#   {"op", "id", "home", "user", "hops", ...} with the fields of the shard bus
+#   events (see sharding.py). "home" is the node the user is logged in on, "id"
+#   is unique per emitting node. Private messages carry "target"/"target_home"
+#   and follow the route to that node; everything else floods to every
+#   neighbour but the one it came from. Remote users appear as "name@home".
+
+
+def qualify(username, node):
+    return f"{username}@{node}"
+
+
+class PeerLink:
+    """One authenticated, encrypted link to a neighbour node."""
+    def __init__(self, sock, node, codec, addr):
+        self.sock = sock
+        self.node = node
+        self.addr = addr
+        # Events are small and latency is the point: do not let Nagle hold them back
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.codec = codec
+        self.reader = None
+        self.queue = SendQueue(LINK_QUEUE_DEPTH, POLICY_DISCONNECT,
+                               encode=lambda payload: pack_frame(codec.encrypt(payload)))
+
+    def send(self, event):
+        """False if the neighbour cannot keep up and the link should go."""
+        return self.queue.put(json.dumps(event, ensure_ascii=False).encode('utf-8'))
+
+    def close(self):
+        self.queue.close()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class Federation:
+    """
+    Connects a ChatServer to other nodes. Listens on `listen` (host, port) for
+    neighbours and keeps a link open to every address in `peers`, redialling
+    with backoff. Local users and routing come first; only what concerns other
+    nodes crosses a link, and each event is delivered once however many paths
+    it takes.
+    """
+    def __init__(self, node, secret, listen=None, peers=(), codecs=tuple(CODECS), max_hops=MAX_HOPS):
+        if not NODE_NAME.match(node):
+            raise ValueError(f"Invalid node name '{node}'")
+        self.node = node
+        self.secret = secret
+        self.proofs = ProofVerifier(secret)
+        self.listen = listen
+        self.peers = list(peers)
+        self.codecs = codecs
+        self.max_hops = max_hops
+        self.server = None
+        self.running = False
+        self.listen_socket = None
+        self.lock = threading.Lock()
+        self.links = {}              # {node name: PeerLink}
+        self.routes = {}             # {home node: PeerLink the first news of it came over}
+        self.users = {}              # {"name@home": home} of every remote user
+        self.seen = OrderedDict()    # Recent event ids, oldest first
+        self.event_ids = itertools.count(1)
+
+    # ---------------- START / STOP ----------------
+    def start(self, server):
+        self.server = server
+        self.running = True
+        if self.listen:
+            self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.listen_socket.bind(tuple(self.listen))
+            self.listen_socket.listen(16)
+            threading.Thread(target=self.accept_links, daemon=True).start()
+        for addr in self.peers:
+            threading.Thread(target=self.dial, args=(tuple(addr),), daemon=True).start()
+        self.server.log.info(f"🌐 Federation node '{self.node}'"
+                             + (f" listening on {self.listen[0]}:{self.listen[1]}" if self.listen else "")
+                             + (f", linking to {len(self.peers)} peer(s)" if self.peers else ""))
+
+    def stop(self):
+        self.running = False
+        if self.listen_socket:
+            try:
+                self.listen_socket.shutdown(socket.SHUT_RDWR) # Wakes accept()
+            except OSError:
+                pass
+            self.listen_socket.close()
+        with self.lock:
+            links = list(self.links.values())
+        for link in links:
+            link.close()
+
+    # ---------------- LINK SETUP ----------------
+    def accept_links(self):
+        while self.running:
+            try:
+                sock, addr = self.listen_socket.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.accept_link, args=(sock, addr), daemon=True).start()
+
+    def accept_link(self, sock, addr):
+        reader = FrameReader(sock)
+        try:
+            sock.settimeout(10)
+            kind, hello = parse_message(reader.read_frame() or b"")
+            sock.settimeout(None)
+            node = hello.get("username")
+            if kind != HELLO or CAP_FEDERATION not in (hello.get("caps") or ()) or not isinstance(node, str) \
+                    or not NODE_NAME.match(node) or node == self.node:
+                return self.refuse(sock, REJECT_MALFORMED)
+            if not self.proofs.verify(hello):
+                self.server.log.warning(f"❌ Federation link from {addr} rejected: wrong secret")
+                return self.refuse(sock, REJECT_PASSWORD)
+            codec_name = choose_codec(hello.get("codecs"), self.codecs)
+            if codec_name is None:
+                return self.refuse(sock, REJECT_CODEC)
+            kex = KeyExchange()
+            codec = kex.derive(hello.get("pub"), self.secret, hello["nonce"], False, codec_name)
+            link = PeerLink(sock, node, codec, addr)
+            with self.lock:
+                duplicate = node in self.links
+                if not duplicate:
+                    self.links[node] = link
+            if duplicate: # Both ends dialled each other, one link is enough
+                return self.refuse(sock, REJECT_DUPLICATE)
+            if not self.running:
+                return self.link_down(link)
+            sock.sendall(pack_frame(pack_message(WELCOME, {
+                "v": PROTOCOL_VERSION, "pub": kex.public_key(), "codec": codec_name,
+                "node": self.node, "caps": [CAP_FEDERATION]})))
+        except (OSError, HandshakeError, CryptoError, FrameError, KeyError):
+            sock.close()
+            return
+        link.reader = reader
+        self.run_link(link)
+
+    def refuse(self, sock, reason):
+        try:
+            sock.sendall(pack_frame(pack_message(REJECT, {"reason": reason})))
+        except OSError:
+            pass
+        sock.close()
+
+    def dial(self, addr):
+        delay = RETRY_MIN
+        while self.running:
+            link = None
+            try:
+                link = self.connect(addr)
+            except (OSError, HandshakeError, CryptoError, FrameError) as e:
+                self.server.log.warning(f"⚠️ Federation link to {addr[0]}:{addr[1]} failed ({e}), retrying in {delay:g}s")
+            if link is not None:
+                delay = RETRY_MIN
+                self.run_link(link) # Returns once the link is gone
+            if self.running:
+                time.sleep(delay)
+                delay = min(delay * 2, RETRY_MAX)
+
+    def connect(self, addr):
+        sock = socket.create_connection(addr, timeout=10)
+        try:
+            kex, nonce = KeyExchange(), new_nonce()
+            sock.sendall(pack_frame(make_hello(self.secret, self.node, nonce, kex.public_key(), self.codecs,
+                                               caps=(CAP_FEDERATION,))))
+            reader = FrameReader(sock)
+            kind, fields = parse_message(reader.read_frame() or b"")
+            if kind == REJECT:
+                raise HandshakeError(f"rejected: {fields.get('reason')}")
+            node = fields.get("node")
+            if not isinstance(node, str) or not NODE_NAME.match(node) or node == self.node:
+                raise HandshakeError(f"bad node name {node!r}")
+            codec = kex.derive(fields.get("pub"), self.secret, nonce, True, fields.get("codec"))
+            sock.settimeout(None)
+        except Exception:
+            sock.close()
+            raise
+        link = PeerLink(sock, node, codec, addr)
+        link.reader = reader
+        with self.lock:
+            if node in self.links:
+                link = None
+            else:
+                self.links[node] = link
+        if link is None:
+            sock.close()
+            raise HandshakeError(f"already linked to '{node}'")
+        return link
+
+    # ---------------- LINK LIFETIME ----------------
+    def run_link(self, link):
+        start_socket_writer(link.sock, link.queue, lambda conn, error: None)
+        self.server.log.info(f"🔗 Federation link to '{link.node}' up ({link.addr[0]}:{link.addr[1]})")
+        self.send_snapshot(link)
+        try:
+            while self.running:
+                frame = link.reader.read_frame()
+                if frame is None:
+                    break
+                self.receive(link, json.loads(link.codec.decrypt(frame)))
+        except (OSError, ValueError, CryptoError, FrameError) as e:
+            if self.running:
+                self.server.log.warning(f"⚠️ Federation link to '{link.node}' failed: {e}")
+        finally:
+            self.link_down(link)
+
+    def send_snapshot(self, link):
+        """Tells a neighbour about every user we know of, except those it told us about."""
+        with self.lock:
+            remote = [(q, home) for q, home in self.users.items() if self.routes.get(home) is not link]
+        users = [(username, self.node) for username in self.server.sessions.usernames()]
+        users += [(q.rpartition("@")[0], home) for q, home in remote]
+        for username, home in users:
+            self.send_event({"op": "joined", "user": username, "home": home}, only=link)
+
+    def link_down(self, link):
+        with self.lock:
+            if self.links.get(link.node) is not link:
+                return
+            del self.links[link.node]
+            lost_homes = {home for home, route in self.routes.items() if route is link}
+            for home in lost_homes:
+                del self.routes[home]
+            lost = [q for q, home in self.users.items() if home in lost_homes]
+            for q in lost:
+                del self.users[q]
+            others = list(self.links.values())
+        link.close()
+        if self.running:
+            self.server.log.warning(f"🔌 Federation link to '{link.node}' down, {len(lost)} remote user(s) gone")
+        for q in lost:
+            username, _, home = q.rpartition("@")
+            self.server.on_bus_event({"op": "left", "user": q})
+            self.send_event({"op": "left", "user": username, "home": home})
+        # Anyone still reachable another way is announced again by the neighbours left
+        for other in others:
+            other.send({"op": "sync"})
+
+    # ---------------- EVENTS ----------------
+    def publish(self, event):
+        """Called by the ChatServer for what its own users do."""
+        event = dict(event, home=self.node)
+        if event["op"] == "private":
+            event["target"], _, event["target_home"] = event["target"].rpartition("@")
+        self.send_event(event)
+
+    def send_event(self, event, came_from=None, only=None):
+        if "id" not in event:
+            event = dict(event, id=f"{self.node}:{next(self.event_ids)}", hops=0)
+        with self.lock:
+            self.remember(event["id"])
+            if only is not None:
+                links = [only]
+            elif event["op"] == "private" and event["target_home"] in self.routes:
+                links = [self.routes[event["target_home"]]]
+            else:
+                links = [link for link in self.links.values() if link is not came_from]
+        for link in links:
+            if link is not came_from and not link.send(event):
+                self.server.log.warning(f"🐢 Federation link to '{link.node}' cannot keep up. Dropping it.")
+                link.close()
+
+    def remember(self, event_id):
+        # Callers hold self.lock
+        self.seen[event_id] = True
+        if len(self.seen) > SEEN_EVENTS:
+            self.seen.popitem(last=False)
+
+    def receive(self, link, event):
+        op, home, username = event.get("op"), event.get("home"), event.get("user")
+        if op == "sync":
+            return self.send_snapshot(link)
+        if not isinstance(home, str) or not isinstance(username, str) or "id" not in event:
+            return
+        qualified = qualify(username, home)
+        with self.lock:
+            if event["id"] in self.seen or home == self.node:
+                return # Seen it already, or our own event came back round a loop
+            self.remember(event["id"])
+            route = self.routes.setdefault(home, link)
+            if op == "joined":
+                known = qualified in self.users
+                self.users[qualified] = home
+            elif op == "left":
+                if route is not link or qualified not in self.users:
+                    return # Still reachable the way we know
+                del self.users[qualified]
+
+        if op == "private" and event.get("target_home") == self.node:
+            self.server.on_bus_event(dict(event, user=qualified))
+            return
+        if event.get("hops", 0) + 1 < self.max_hops:
+            self.send_event(dict(event, hops=event.get("hops", 0) + 1), came_from=link)
+        if op == "joined" and known:
+            return
+        if op != "private":
+            self.server.on_bus_event(dict(event, user=qualified))
+
+    def snapshot(self):
+        """{neighbour node: address} of the links currently up."""
+        with self.lock:
+            return {node: link.addr for node, link in self.links.items()}
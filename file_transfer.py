@@ -0,0 +1,361 @@
+import os
+import json
+import mmap
+import time
+import struct
+import secrets
+import threading
+from envelope import Envelope, pack, NOTICE, FILE_OFFER, FILE_ACCEPT, FILE_ACK, FILE_CANCEL, FILE_DATA
+
+
+# ---------------- PROTOCOL ----------------
+# Control messages are ordinary envelopes, addressed like PRIVATE:
+#   FILE_OFFER   target <user>, body {"id", "name", "size"}; from the server, sender <user>
+#   FILE_ACCEPT  target <id>, body <offset>    receiver -> sender: send from offset on
+#   FILE_ACK     target <id>, body <offset>    receiver -> sender: everything before offset is on disk
+#   FILE_CANCEL  target <id>, body <reason>    either way, ends the transfer
+# Data travels as FILE_DATA, target <id>, body <u64 offset><raw bytes>. The
+# server routes chunks and acks by transfer id and forwards them untouched,
+# without numbering them or keeping them for replay; the sender's window
+# bounds what is in flight.
+ID_LENGTH = 16
+OFFSET = struct.Struct("!Q")
+
+CHUNK_SIZE = 64 * 1024
+WINDOW = 16 * CHUNK_SIZE     # Unacknowledged bytes a sender may have in flight
+ACK_EVERY = WINDOW // 4      # The receiver acks after writing this much
+PART_SUFFIX = ".part"        # Incomplete downloads, picked up again if the same file is re-sent
+
+# Transfer states
+WAITING = "waiting"          # Offered, not accepted yet
+ACTIVE = "active"
+DONE = "done"
+CANCELLED = "cancelled"
+
+# FILE_CANCEL reasons
+CANCEL_DECLINED = "declined"
+CANCEL_NOT_FOUND = "not_found"
+CANCEL_PEER_LEFT = "peer_left"
+CANCEL_BUSY = "busy"
+CANCEL_ERROR = "error"
+CANCEL_USER = "cancelled"
+CANCEL_DISCONNECTED = "disconnected"
+
+
+def new_transfer_id():
+    return secrets.token_hex(ID_LENGTH // 2)
+
+
+def valid_transfer_id(transfer_id):
+    return isinstance(transfer_id, str) and len(transfer_id) == ID_LENGTH and transfer_id.isalnum()
+
+
+def pack_chunk(transfer_id, offset, data):
+    return pack(FILE_DATA, OFFSET.pack(offset) + data, target=transfer_id)
+
+
+def describe_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+# ---------------- TRANSFERS ----------------
+class Transfer:
+    def __init__(self, transfer_id, peer, name, size):
+        self.id = transfer_id
+        self.peer = peer
+        self.name = name
+        self.size = size
+        self.state = WAITING
+        self.reason = None
+        self.done_bytes = 0          # Acknowledged (outgoing) or written (incoming)
+        self.started_at = None
+        self.started_bytes = 0       # done_bytes when this run started, for the rate
+        self.finished_at = None
+        self.lock = threading.Condition()
+
+    def start(self, offset):
+        self.state = ACTIVE
+        self.done_bytes = self.started_bytes = offset
+        self.started_at = time.monotonic()
+
+    def finish(self, state, reason=None):
+        self.state = state
+        self.reason = reason
+        self.finished_at = time.monotonic()
+        self.lock.notify_all()
+
+    def progress(self):
+        elapsed = ((self.finished_at or time.monotonic()) - self.started_at) if self.started_at else 0
+        return {
+            "id": self.id,
+            "direction": self.direction,
+            "peer": self.peer,
+            "name": self.name,
+            "size": self.size,
+            "bytes": self.done_bytes,
+            "state": self.state,
+            "reason": self.reason,
+            "rate": (self.done_bytes - self.started_bytes) / elapsed if elapsed > 0 else 0.0,
+        }
+
+
+class OutgoingTransfer(Transfer):
+    """
+    Streams a file out of a read-only memory map: each chunk is framed
+    straight from the mapped pages. A thread sends while the window allows and
+    sleeps on the transfer's condition until the receiver acks more.
+    """
+    direction = "out"
+
+    def __init__(self, transfer_id, peer, path):
+        super().__init__(transfer_id, peer, os.path.basename(path), os.path.getsize(path))
+        self.path = path
+        self.sent = 0                # Next offset to send
+        self.thread = None
+
+    def accept(self, offset, send):
+        with self.lock:
+            if self.state not in (WAITING, ACTIVE) or not 0 <= offset <= self.size:
+                return
+            if self.state == WAITING:
+                self.start(offset)
+                if offset < self.size:
+                    self.thread = threading.Thread(target=self.run, args=(send,), daemon=True)
+                    self.thread.start()
+            # A repeated accept means the receiver came back: restart from what it has
+            self.done_bytes = self.sent = offset
+            if offset == self.size:
+                self.finish(DONE)
+            self.lock.notify_all()
+
+    def acknowledge(self, offset):
+        with self.lock:
+            if self.state != ACTIVE or not self.done_bytes < offset <= self.size:
+                return False
+            self.done_bytes = offset
+            if offset == self.size:
+                self.finish(DONE)
+            self.lock.notify_all()
+            return self.state == DONE
+
+    def rewind(self):
+        """Our connection dropped: chunks after the last ack may be lost, send them again."""
+        with self.lock:
+            self.sent = self.done_bytes
+            self.lock.notify_all()
+
+    def run(self, send):
+        with open(self.path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+            view = memoryview(mapped) if mapped else None
+            try:
+                while True:
+                    with self.lock:
+                        while self.state == ACTIVE and (self.sent >= self.size or self.sent >= self.done_bytes + WINDOW):
+                            self.lock.wait()
+                        if self.state != ACTIVE:
+                            return
+                        offset = self.sent
+                        end = self.sent = min(offset + CHUNK_SIZE, self.size)
+                    try:
+                        send(pack_chunk(self.id, offset, view[offset:end]))
+                    except OSError:
+                        with self.lock: # Reconnecting: wait for the rewind
+                            self.lock.wait(1.0)
+            finally:
+                if mapped:
+                    view.release()
+                    mapped.close()
+
+
+class IncomingTransfer(Transfer):
+    """Writes chunks to <path>.part in order and renames it once complete."""
+    direction = "in"
+
+    def __init__(self, transfer_id, peer, name, size):
+        super().__init__(transfer_id, peer, name, size)
+        self.path = None
+        self.file = None
+        self.acked = 0
+
+    def accept(self, path):
+        """Opens the download; returns the offset to start from (a leftover .part is resumed)."""
+        with self.lock:
+            self.path = path
+            part = path + PART_SUFFIX
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            self.file = open(part, "r+b" if offset else "wb")
+            if offset > self.size:
+                self.file.truncate(0)
+                offset = 0
+            self.file.seek(offset)
+            self.start(offset)
+            self.acked = offset
+            if offset == self.size:
+                self.complete()
+            return offset
+
+    def write(self, offset, data):
+        """Appends a chunk. Returns the offset to ack, or None if no ack is due yet."""
+        with self.lock:
+            if self.state != ACTIVE:
+                return None
+            skip = self.done_bytes - offset # Resent after a reconnect: keep only what is new
+            if skip < 0 or skip >= len(data) or self.done_bytes + len(data) - skip > self.size:
+                return None
+            self.file.write(data[skip:])
+            self.done_bytes += len(data) - skip
+            if self.done_bytes == self.size:
+                self.complete()
+            elif self.done_bytes - self.acked < ACK_EVERY:
+                return None
+            self.acked = self.done_bytes
+            return self.acked
+
+    def complete(self):
+        self.file.close()
+        os.replace(self.path + PART_SUFFIX, self.path)
+        self.finish(DONE)
+
+    def close(self):
+        if self.file and not self.file.closed:
+            self.file.close()
+
+
+# ---------------- CLIENT SIDE ----------------
+class TransferManager:
+    """
+    A client's file transfers. `send(kind, body, target=...)` sends a control
+    envelope and `send_chunk(frame)` a packed data frame; both come from the
+    ChatClient. Handlers return an envelope for the chat window (a NOTICE, or
+    the FILE_OFFER to ask the user about), or None.
+    """
+    def __init__(self, send, send_chunk):
+        self.send = send
+        self.send_chunk = send_chunk
+        self.lock = threading.Lock()
+        self.transfers = {}
+        self.handlers = {
+            FILE_OFFER: self._on_offer,
+            FILE_ACCEPT: self._on_accept,
+            FILE_ACK: self._on_ack,
+            FILE_CANCEL: self._on_cancel,
+        }
+
+    def get(self, transfer_id):
+        return self.transfers.get(transfer_id)
+
+    def snapshot(self):
+        with self.lock:
+            transfers = list(self.transfers.values())
+        return [transfer.progress() for transfer in transfers]
+
+    # ---------------- LOCAL ACTIONS ----------------
+    def offer(self, target, path):
+        transfer = OutgoingTransfer(new_transfer_id(), target, path)
+        with self.lock:
+            self.transfers[transfer.id] = transfer
+        offer = {"id": transfer.id, "name": transfer.name, "size": transfer.size}
+        self.send(FILE_OFFER, json.dumps(offer, ensure_ascii=False), target=target)
+        return transfer
+
+    def accept(self, transfer_id, path):
+        transfer = self.transfers.get(transfer_id)
+        if isinstance(transfer, IncomingTransfer) and transfer.state == WAITING:
+            offset = transfer.accept(path)
+            self.send(FILE_ACCEPT, str(offset), target=transfer_id)
+            if transfer.state == DONE: # Empty, or already complete on disk
+                self.send(FILE_ACK, str(offset), target=transfer_id)
+
+    def cancel(self, transfer_id, reason=CANCEL_USER):
+        if self._end(transfer_id, reason):
+            self.send(FILE_CANCEL, reason, target=transfer_id)
+
+    def _end(self, transfer_id, reason):
+        transfer = self.transfers.get(transfer_id)
+        if transfer is None:
+            return None
+        with transfer.lock:
+            if transfer.state in (DONE, CANCELLED):
+                return None
+            transfer.finish(CANCELLED, reason)
+        if isinstance(transfer, IncomingTransfer):
+            transfer.close()
+        return transfer
+
+    # ---------------- FROM THE SERVER ----------------
+    def handle(self, message):
+        handler = self.handlers.get(message.type)
+        return handler(message) if handler else None
+
+    def _on_offer(self, message):
+        try:
+            offer = message.json()
+            transfer = IncomingTransfer(offer["id"], message.sender, os.path.basename(offer["name"]), int(offer["size"]))
+        except (ValueError, KeyError, TypeError):
+            return None
+        with self.lock:
+            self.transfers[transfer.id] = transfer
+        # The window asks the user, then calls accept() or cancel()
+        return Envelope(FILE_OFFER, sender=transfer.peer, target=transfer.id)
+
+    def _outgoing(self, message):
+        transfer = self.transfers.get(message.target)
+        return transfer if isinstance(transfer, OutgoingTransfer) and message.body.isdigit() else None
+
+    def _on_accept(self, message):
+        transfer = self._outgoing(message)
+        if transfer is None:
+            return None
+        transfer.accept(int(message.body), self.send_chunk)
+        if transfer.state == DONE:
+            return Envelope(NOTICE, f"✅ Sent '{transfer.name}' to {transfer.peer}.")
+        return Envelope(NOTICE, f"📁 {transfer.peer} accepted '{transfer.name}'.")
+
+    def _on_ack(self, message):
+        transfer = self._outgoing(message)
+        if transfer is not None and transfer.acknowledge(int(message.body)):
+            return Envelope(NOTICE, f"✅ Sent '{transfer.name}' to {transfer.peer}.")
+        return None
+
+    def _on_cancel(self, message):
+        reason = message.text
+        transfer = self._end(message.target, reason)
+        if transfer is None:
+            return None
+        return Envelope(NOTICE, f"❌ Transfer of '{transfer.name}' {'declined' if reason == CANCEL_DECLINED else f'stopped ({reason})'}.")
+
+    def receive_chunk(self, message):
+        transfer = self.transfers.get(message.target)
+        if not isinstance(transfer, IncomingTransfer) or len(message.body) < OFFSET.size:
+            return None
+        try:
+            ack = transfer.write(OFFSET.unpack_from(message.body)[0], memoryview(message.body)[OFFSET.size:])
+        except OSError as e:
+            self.cancel(transfer.id, CANCEL_ERROR)
+            return Envelope(NOTICE, f"❌ Could not save '{transfer.name}': {e}")
+        if ack is None:
+            return None
+        self.send(FILE_ACK, str(ack), target=transfer.id)
+        if transfer.state == DONE:
+            return Envelope(NOTICE, f"✅ Received '{transfer.name}' from {transfer.peer} ({transfer.path}).")
+        return None
+
+    # ---------------- CONNECTION EVENTS ----------------
+    def resume(self):
+        """After a resumed connection: senders resend unacked chunks, receivers restate their offset."""
+        for transfer in list(self.transfers.values()):
+            if transfer.state != ACTIVE:
+                continue
+            if isinstance(transfer, OutgoingTransfer):
+                transfer.rewind()
+            else:
+                self.send(FILE_ACCEPT, str(transfer.done_bytes), target=transfer.id)
+
+    def abort_all(self, reason):
+        """The session is gone (new login or disconnect): the server forgot our transfers."""
+        for transfer_id in list(self.transfers):
+            self._end(transfer_id, reason)
@@ -0,0 +1,83 @@
+import struct
+from collections import deque
+
+
+# Every frame on the wire is a 4-byte big-endian payload length followed by the payload.
+HEADER = struct.Struct("!I")
+HEADER_SIZE = HEADER.size
+MAX_FRAME_SIZE = 16 * 1024 * 1024   # Refuse anything larger than 16 MB
+RECV_SIZE = 64 * 1024
+
+
+class FrameError(Exception):
+    """Raised when the peer sends a frame we cannot accept."""
+
+
+# ---------------- ENCODE ----------------
+def pack_frame(payload):
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    if len(payload) > MAX_FRAME_SIZE:
+        raise FrameError(f"Frame of {len(payload)} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+    return HEADER.pack(len(payload)) + payload
+
+
+# ---------------- STREAMING DECODE ----------------
+class FrameBuffer:
+    """
+    Reassembly buffer for a byte stream. Feed it whatever recv() returned
+    and it hands back every frame that is now complete, keeping partial
+    frames until the rest arrives.
+    """
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self._buf = bytearray()
+
+    def feed(self, data):
+        self._buf += data
+        frames = []
+        view = memoryview(self._buf)
+        offset = 0
+        end = len(self._buf)
+        try:
+            while end - offset >= HEADER_SIZE:
+                (length,) = HEADER.unpack_from(view, offset)
+                if length > self.max_frame_size:
+                    raise FrameError(f"Incoming frame of {length} bytes exceeds the {self.max_frame_size} byte limit")
+                if end - offset - HEADER_SIZE < length:
+                    break # Wait for the rest of this frame
+                start = offset + HEADER_SIZE
+                frames.append(bytes(view[start:start + length]))
+                offset = start + length
+        finally:
+            view.release()
+        if offset:
+            del self._buf[:offset] # Drop everything consumed in one go
+        return frames
+
+    def pending_bytes(self):
+        return len(self._buf)
+
+
+# ---------------- BLOCKING SOCKET READER ----------------
+class FrameReader:
+    """Reads whole frames from a blocking socket, one recv() may yield many frames."""
+    def __init__(self, sock, recv_size=RECV_SIZE):
+        self.sock = sock
+        self.recv_size = recv_size
+        self.buffer = FrameBuffer()
+        self.frames = deque()
+
+    def push(self, data):
+        """Bytes someone else already read off this socket (a shard handover)."""
+        if data:
+            self.frames.extend(self.buffer.feed(data))
+
+    def read_frame(self):
+        """Returns the next frame, or None once the peer has closed the connection."""
+        while not self.frames:
+            data = self.sock.recv(self.recv_size)
+            if not data:
+                return None
+            self.frames.extend(self.buffer.feed(data))
+        return self.frames.popleft()
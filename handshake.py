@@ -0,0 +1,113 @@
+import hmac
+import json
+import time
+import base64
+import hashlib
+import secrets
+import threading
+
+
+# One round trip: the client sends HELLO:<json>, the server answers
+# WELCOME:<json> or REJECT:<json>, then the chat starts.
+HELLO = "HELLO"
+WELCOME = "WELCOME"
+REJECT = "REJECT"
+PROTOCOL_VERSION = 2     # 2: chat frames are typed envelopes (envelope.py)
+
+# Features a client may ask for; the server answers with the ones it grants
+CAPABILITIES = ("roster_delta", "history", "resume", "rooms")
+
+# REJECT reasons
+REJECT_PASSWORD = "invalid_password"
+REJECT_DUPLICATE = "duplicate_username"
+REJECT_MALFORMED = "malformed_hello"
+REJECT_RESUME = "resume_failed"
+REJECT_CODEC = "no_common_codec"
+REJECT_VERSION = "unsupported_version"
+
+PROOF_WINDOW = 300   # Seconds of clock skew a password proof may have
+
+
+class HandshakeError(Exception):
+    """Raised when a handshake message cannot be parsed."""
+
+
+# ---------------- ENCODE / DECODE ----------------
+def pack_message(kind, fields):
+    return f"{kind}:{json.dumps(fields, separators=(',', ':'))}".encode('utf-8')
+
+
+def parse_message(frame):
+    """Returns (kind, fields) of a HELLO/WELCOME/REJECT frame."""
+    try:
+        kind, _, body = frame.decode('utf-8').partition(":")
+        fields = json.loads(body)
+    except ValueError as e:
+        raise HandshakeError(f"Malformed handshake message: {e}")
+    if kind not in (HELLO, WELCOME, REJECT) or not isinstance(fields, dict):
+        raise HandshakeError(f"Unexpected handshake message '{kind}'")
+    return kind, fields
+
+
+# ---------------- PASSWORD PROOF ----------------
+# The password never crosses the wire: the client sends an HMAC of a fresh
+# nonce, the time and its username, keyed with the password.
+def password_proof(password, username, nonce, ts):
+    message = f"{nonce}:{ts}:{username}".encode('utf-8')
+    return hmac.new(password.encode('utf-8'), message, hashlib.sha256).hexdigest()
+
+
+def new_nonce():
+    return base64.urlsafe_b64encode(secrets.token_bytes(16)).decode('ascii')
+
+
+def make_hello(password, username, nonce, public_key, codecs, caps=CAPABILITIES, resume=None, compression=()):
+    ts = int(time.time())
+    fields = {
+        "v": PROTOCOL_VERSION,
+        "username": username,
+        "nonce": nonce,
+        "ts": ts,
+        "proof": password_proof(password, username, nonce, ts),
+        "pub": public_key, # Ephemeral X25519 key, see session_crypto.py
+        "codecs": list(codecs), # Frame codecs we can speak, best first
+        "caps": list(caps),
+    }
+    if compression:
+        fields["compression"] = list(compression) # See compression.py, best first
+    if resume:
+        fields["resume"] = resume # {"token": ..., "last_seq": ...}
+    return pack_message(HELLO, fields)
+
+
+class ProofVerifier:
+    """
+    Checks HELLO password proofs. A proof is only valid within PROOF_WINDOW
+    seconds of its timestamp and only once, so a captured HELLO cannot be replayed.
+    """
+    def __init__(self, password, window=PROOF_WINDOW):
+        self.password = password
+        self.window = window
+        self.lock = threading.Lock()
+        self.seen = {}   # {nonce: ts} of proofs accepted within the window
+
+    def verify(self, fields):
+        try:
+            username, nonce, ts, proof = fields["username"], fields["nonce"], int(fields["ts"]), fields["proof"]
+        except (KeyError, TypeError, ValueError, OverflowError): # int(Infinity) overflows
+            return False
+        if not (isinstance(username, str) and isinstance(nonce, str) and isinstance(proof, str)):
+            return False
+        now = time.time()
+        if abs(now - ts) > self.window:
+            return False
+        expected = password_proof(self.password, username, nonce, ts)
+        if not hmac.compare_digest(expected, proof):
+            return False
+        with self.lock:
+            if nonce in self.seen:
+                return False
+            if len(self.seen) > 1024:
+                self.seen = {n: t for n, t in self.seen.items() if now - t <= self.window}
+            self.seen[nonce] = ts
+        return True
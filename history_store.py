@@ -0,0 +1,267 @@
+import os
+import json
+import time
+import threading
+from collections import deque
+from bisect import bisect_left, bisect_right
+
+
+SEGMENT_BYTES = 4 * 1024 * 1024   # Roll to a new segment file past this size
+MAX_SEGMENTS = 64                 # Compaction keeps at most this many segments
+INDEX_EVERY = 64                  # One sparse index entry per this many records
+FLUSH_INTERVAL = 0.05             # Group commit: one write + fsync per interval
+MAX_PAGE = 500                    # Upper bound on records returned by one query
+
+KIND_GLOBAL = "global"
+KIND_PRIVATE = "private"
+
+
+class HistoryStore:
+    """
+    Append-only chat log on disk, split into segment files named after the
+    first sequence number they hold. Each line is one JSON record:
+    {"seq", "ts", "kind", "sender", "target", "body"}.
+
+    append() only assigns a sequence number and queues the record; a writer
+    thread batches queued records into one write and one fsync per
+    FLUSH_INTERVAL, so the broadcast path never waits on the disk.
+
+    A sparse in-memory index of (seq, ts, segment, offset) every INDEX_EVERY
+    records lets queries seek straight to a sequence number or a time.
+    """
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES, max_segments=MAX_SEGMENTS,
+                 flush_interval=FLUSH_INTERVAL):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.flush_interval = flush_interval
+
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.flush_lock = threading.Lock()   # Serialises the writer thread and close()
+        self.segments = []        # First seq of every segment file, ascending
+        self.index = []           # (seq, ts, segment_first_seq, offset), ascending
+        self.index_seqs = []      # Just the seqs of self.index, for bisect
+        self.index_times = []     # Just the timestamps of self.index, for bisect
+        self.unflushed = []       # Records appended but not yet on disk
+        self.next_seq = 1
+        self.last_ts = 0.0
+        self.file = None
+        self.file_size = 0
+        self.records_in_file = 0
+        self.running = False
+
+    # ---------------- LIFECYCLE ----------------
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._recover()
+        self.running = True
+        threading.Thread(target=self._writer, daemon=True).start()
+
+    def close(self):
+        with self.lock:
+            self.running = False
+            self.wakeup.notify()
+        self._flush()
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def _path(self, first_seq):
+        return os.path.join(self.directory, f"{first_seq:020d}.log")
+
+    # Rebuilds the index from the segment files, dropping a torn last line
+    def _recover(self):
+        names = sorted(n for n in os.listdir(self.directory) if n.endswith(".log"))
+        for name in names:
+            first_seq = int(name[:-4])
+            self.segments.append(first_seq)
+            path = self._path(first_seq)
+            offset = 0
+            count = 0
+            with open(path, "rb+") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        f.truncate(offset) # Crash mid-write: keep everything before it
+                        break
+                    if count % INDEX_EVERY == 0:
+                        self._add_index(record, first_seq, offset)
+                    self.next_seq = record["seq"] + 1
+                    self.last_ts = max(self.last_ts, record["ts"])
+                    offset += len(line)
+                    count += 1
+            self.file_size = offset
+            self.records_in_file = count
+        if self.segments:
+            self.file = open(self._path(self.segments[-1]), "ab")
+
+    def _add_index(self, record, segment, offset):
+        self.index.append((record["seq"], record["ts"], segment, offset))
+        self.index_seqs.append(record["seq"])
+        self.index_times.append(record["ts"])
+
+    # ---------------- WRITE PATH ----------------
+    def append(self, kind, sender, body, target=None):
+        """Queues a message for the log and returns its sequence number."""
+        with self.lock:
+            seq = self.next_seq
+            self.next_seq += 1
+            self.last_ts = max(self.last_ts, time.time()) # Never let the time index go backwards
+            self.unflushed.append({"seq": seq, "ts": self.last_ts, "kind": kind,
+                                   "sender": sender, "target": target, "body": body})
+        return seq
+
+    def _writer(self):
+        while True:
+            with self.lock:
+                if not self.running:
+                    return
+                self.wakeup.wait(self.flush_interval)
+            self._flush()
+
+    # Group commit: everything queued since the last flush, one write, one fsync
+    def _flush(self):
+        with self.flush_lock:
+            self._flush_batch()
+
+    def _flush_batch(self):
+        with self.lock:
+            batch = list(self.unflushed)
+        if not batch:
+            return
+
+        chunks = []
+        for record in batch:
+            line = (json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+            if self.file is None or self.file_size >= self.segment_bytes:
+                self._write(chunks)
+                chunks = []
+                self._roll(record["seq"])
+            if self.records_in_file % INDEX_EVERY == 0:
+                with self.lock:
+                    self._add_index(record, self.segments[-1], self.file_size)
+            chunks.append(line)
+            self.file_size += len(line)
+            self.records_in_file += 1
+        self._write(chunks)
+
+        with self.lock:
+            del self.unflushed[:len(batch)]
+
+    def _write(self, chunks):
+        if chunks:
+            self.file.write(b"".join(chunks))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def _roll(self, first_seq):
+        if self.file:
+            self.file.close()
+        self.file = open(self._path(first_seq), "ab")
+        self.file_size = 0
+        self.records_in_file = 0
+        with self.lock:
+            self.segments.append(first_seq)
+        self._compact()
+
+    # ---------------- COMPACTION ----------------
+    # Drops the oldest segments (and their index entries) beyond max_segments
+    def _compact(self):
+        with self.lock:
+            if len(self.segments) <= self.max_segments:
+                return
+            expired = self.segments[:-self.max_segments]
+            del self.segments[:len(expired)]
+            keep = bisect_left(self.index_seqs, self.segments[0])
+            del self.index[:keep]
+            del self.index_seqs[:keep]
+            del self.index_times[:keep]
+        for first_seq in expired:
+            try:
+                os.remove(self._path(first_seq))
+            except OSError:
+                pass
+
+    # ---------------- READ PATH ----------------
+    def seq_at(self, ts):
+        """Sequence number of the first record at or after unix time `ts` (approximate to the index)."""
+        with self.lock:
+            pos = bisect_left(self.index_times, ts)
+            if pos == 0:
+                return self.index_seqs[0] if self.index_seqs else 1
+            return self.index_seqs[pos - 1]
+
+    def last_seq(self):
+        return self.next_seq - 1
+
+    def read(self, viewer, after_seq=0, limit=100, since=None):
+        """
+        Records after `after_seq` (or from unix time `since`) that `viewer` may
+        see: every global message plus private ones they sent or received.
+        Returns (records, next_after) where next_after is None on the last page.
+        """
+        limit = max(1, min(limit, MAX_PAGE))
+        if since is not None:
+            after_seq = max(after_seq, self.seq_at(since) - 1)
+
+        records = []
+        last_scanned = after_seq
+        for record in self._scan(after_seq + 1):
+            last_scanned = record["seq"]
+            if since is not None and record["ts"] < since:
+                continue
+            if record["kind"] == KIND_GLOBAL or viewer in (record["sender"], record["target"]):
+                records.append(record)
+                if len(records) == limit:
+                    break
+        more = last_scanned < self.last_seq()
+        return records, (last_scanned if more else None)
+
+    def latest(self, viewer, limit=100):
+        """The last `limit` records visible to `viewer`, oldest first."""
+        limit = max(1, min(limit, MAX_PAGE))
+        start = max(0, self.last_seq() - limit * 4) # Private traffic may be filtered out, so look further back
+        records = deque(maxlen=limit) # Read through to the end of the log, keeping the newest
+        for record in self._scan(start + 1):
+            if record["kind"] == KIND_GLOBAL or viewer in (record["sender"], record["target"]):
+                records.append(record)
+        return list(records)
+
+    # Yields records from `start_seq` on: seek via the sparse index, then read the segments
+    def _scan(self, start_seq):
+        with self.lock:
+            pos = bisect_right(self.index_seqs, start_seq) - 1
+            if pos >= 0:
+                _, _, segment, offset = self.index[pos]
+            elif self.segments:
+                segment, offset = self.segments[0], 0
+            else:
+                segment, offset = None, 0
+            segments = list(self.segments)
+            tail = list(self.unflushed)
+            flushed_until = tail[0]["seq"] if tail else self.next_seq
+        if segment is not None:
+            for first_seq in segments[segments.index(segment):]:
+                if first_seq >= flushed_until:
+                    break
+                try:
+                    with open(self._path(first_seq), "rb") as f:
+                        f.seek(offset)
+                        for line in f:
+                            try:
+                                record = json.loads(line)
+                            except ValueError:
+                                break # A write in progress
+                            if record["seq"] >= flushed_until:
+                                break
+                            if record["seq"] >= start_seq:
+                                yield record
+                except FileNotFoundError:
+                    pass # Compacted away while we were reading
+                offset = 0
+
+        for record in tail:
+            if record["seq"] >= start_seq:
+                yield record
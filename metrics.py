@@ -0,0 +1,226 @@
+import bisect
+import threading
+
+
+METRICS_PORT = 9464
+# Upper bounds, in seconds, of the timing histograms: 10 µs .. 5 s
+TIME_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0, 5.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+SWEEP_MIN = 64             # Cells a metric registers before it first looks for ended threads
+
+
+# ---------------- PER-THREAD CELLS ----------------
+# Every thread updates its own cell, so the hot path takes no lock and never
+# contends: a cell is written by one thread only and read when scraped.
+# Cells of threads that have ended are folded into `retired` at the next scrape,
+# or when new cells have doubled the list since the last sweep (the thread
+# engine starts one thread per connection and one Timer per presence batch),
+# so they do not pile up on a server that is never scraped.
+class _PerThread:
+    def __init__(self, size):
+        self.size = size
+        self.local = threading.local()
+        self.lock = threading.Lock()      # Only taken once per thread, and when scraping
+        self.cells = []                   # [(thread, cell)]
+        self.retired = [0] * size
+        self.sweep_at = SWEEP_MIN         # Sweep when this many cells are registered
+
+    def cell(self):
+        try:
+            return self.local.cell
+        except AttributeError:
+            cell = self.local.cell = [0] * self.size
+            with self.lock:
+                self.cells.append((threading.current_thread(), cell))
+                if len(self.cells) >= self.sweep_at:
+                    self._sweep()
+            return cell
+
+    # Under self.lock: a cell of a thread that has ended is never written again
+    def _sweep(self):
+        live = []
+        retired = self.retired
+        for thread, cell in self.cells:
+            if thread.is_alive():
+                live.append((thread, cell))
+            else:
+                for i, value in enumerate(cell):
+                    retired[i] += value
+        self.cells = live
+        self.sweep_at = max(SWEEP_MIN, 2 * len(live))
+
+    def totals(self):
+        with self.lock:
+            self._sweep()
+            totals = list(self.retired)
+            for _, cell in self.cells:
+                for i, value in enumerate(cell):
+                    totals[i] += value
+        return totals
+
+
+class Counter(_PerThread):
+    """Monotonic count, e.g. messages or bytes."""
+    kind = "counter"
+
+    def __init__(self):
+        super().__init__(1)
+
+    def inc(self, amount=1):
+        self.cell()[0] += amount
+
+    def value(self):
+        return self.totals()[0]
+
+
+class Histogram(_PerThread):
+    """Distribution of observations over fixed buckets, plus their sum and count."""
+    kind = "histogram"
+
+    def __init__(self, buckets=TIME_BUCKETS):
+        self.buckets = tuple(buckets)
+        # One slot per bucket, one for +Inf, then the sum
+        super().__init__(len(self.buckets) + 2)
+
+    def observe(self, value):
+        cell = self.cell()
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def value(self):
+        totals = self.totals()
+        return totals[:-1], totals[-1] # (counts per bucket, sum)
+
+    def quantile(self, fraction, counts=None):
+        """Upper bound of the bucket holding the given quantile, None if empty."""
+        counts = counts if counts is not None else self.value()[0]
+        total, seen = sum(counts), 0
+        if not total:
+            return None
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            seen += count
+            if seen >= fraction * total:
+                return bound
+
+
+class Gauge:
+    """Current value, read from a callback at scrape time so the hot path pays nothing."""
+    kind = "gauge"
+
+    def __init__(self, read):
+        self.read = read
+
+    def value(self):
+        return self.read()
+
+
+# ---------------- REGISTRY ----------------
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.families = {}   # {name: (help, kind, {label tuple: metric})}, in registration order
+
+    def register(self, name, help_text, metric, labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            family = self.families.setdefault(name, (help_text, metric.kind, {}))
+            if family[1] != metric.kind:
+                raise ValueError(f"Metric {name} is already a {family[1]}")
+            return family[2].setdefault(key, metric)
+
+    def counter(self, name, help_text, **labels):
+        return self.register(name, help_text, Counter(), labels)
+
+    def histogram(self, name, help_text, buckets=TIME_BUCKETS, **labels):
+        return self.register(name, help_text, Histogram(buckets), labels)
+
+    def gauge(self, name, help_text, read, **labels):
+        return self.register(name, help_text, Gauge(read), labels)
+
+    def series(self):
+        with self.lock:
+            return [(name, help_text, kind, list(metrics.items()))
+                    for name, (help_text, kind, metrics) in self.families.items()]
+
+    # ---------------- PROMETHEUS TEXT FORMAT ----------------
+    def render(self):
+        lines = []
+        for name, help_text, kind, metrics in self.series():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in metrics:
+                if kind != "histogram":
+                    lines.append(f"{name}{format_labels(labels)} {format_value(metric.value())}")
+                    continue
+                counts, total = metric.value()
+                cumulative = 0
+                for bound, count in zip(metric.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {format_value(total)}")
+                lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """{series: value}, histograms as {"count", "sum", "p50", "p99"}; for logs and tests."""
+        result = {}
+        for name, _, kind, metrics in self.series():
+            for labels, metric in metrics:
+                series = name + format_labels(labels)
+                if kind != "histogram":
+                    result[series] = metric.value()
+                    continue
+                counts, total = metric.value()
+                result[series] = {"count": sum(counts), "sum": total,
+                                  "p50": metric.quantile(0.5, counts), "p99": metric.quantile(0.99, counts)}
+        return result
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (f'{key}="{escape_label(value)}"' for key, value in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# ---------------- HTTP ENDPOINT ----------------
+class MetricsServer:
+    """GET /metrics in Prometheus text format, on localhost unless told otherwise."""
+    def __init__(self, registry, port=METRICS_PORT, host="127.0.0.1"):
+        # Imported here: http.server is slow to load and most servers never serve metrics
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass # Scrapes every few seconds would drown the server log
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.host, self.port = host, self.httpd.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
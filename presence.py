@@ -0,0 +1,72 @@
+import threading
+
+
+SUMMARY_NAMES = 10   # Names spelled out in a join/leave summary before "and N others"
+
+
+class PresenceAggregator:
+    """
+    Collects joins and leaves for `window` seconds and hands them to
+    `on_flush(joined, left)` in one go, so a reconnect storm costs one
+    summary and one roster update per window instead of one per user.
+
+    Only the final state of each name is kept: someone who drops and
+    reconnects inside a window is simply still online. With window <= 0
+    every event is flushed immediately.
+
+    `lock` is the server's roster lock; flushes run while holding it so
+    they are ordered with registrations and newcomers' snapshots.
+    """
+    def __init__(self, window, on_flush, lock):
+        self.window = window
+        self.on_flush = on_flush
+        self.roster_lock = lock
+        self.lock = threading.Lock()
+        self.pending = {}     # {username: True if online, False if gone}, in event order
+        self.timer = None
+        self.closed = False
+
+    def joined(self, username):
+        self._record(username, True)
+
+    def left(self, username):
+        self._record(username, False)
+
+    def _record(self, username, online):
+        with self.lock:
+            if self.closed:
+                return
+            self.pending.pop(username, None) # Re-insert so the latest event sorts last
+            self.pending[username] = online
+            immediate = self.window <= 0
+            if not immediate and self.timer is None:
+                self.timer = threading.Timer(self.window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        if immediate:
+            self.flush()
+
+    def flush(self):
+        with self.roster_lock:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+                self.timer = None
+            if pending:
+                joined = [name for name, online in pending.items() if online]
+                left = [name for name, online in pending.items() if not online]
+                self.on_flush(joined, left)
+
+    def close(self):
+        """Flushes whatever is pending and stops accepting events."""
+        self.flush()
+        with self.lock:
+            self.closed = True
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+
+
+def describe_names(names):
+    if len(names) <= SUMMARY_NAMES:
+        return ", ".join(names)
+    return f"{', '.join(names[:SUMMARY_NAMES])} and {len(names) - SUMMARY_NAMES} others"
@@ -0,0 +1,204 @@
+import threading
+from time import monotonic
+
+
+# Defaults, per second; 0 turns a limit off
+CONN_FRAMES = 5000         # Frames of any kind one connection may send (file chunks included)
+CONN_BYTES = 0             # Encrypted bytes one connection may send
+USER_MESSAGES = 20         # Chat, private and room messages per user
+USER_BYTES = 64 * 1024     # Text of those messages per user
+FAN_OUT = 0                # Deliveries (messages x recipients) the whole server makes for users' messages
+BURST = 2.0                # A bucket holds this many seconds of its rate
+NOTICE_INTERVAL = 2.0      # A user over a limit hears about it at most this often
+
+# What a bucket holds while its limit is off: never charged, and the next refill
+# after the limit is turned on clamps it to a whole burst
+FULL = float("inf")
+
+
+class Limit:
+    """
+    A rate and its burst (`seconds` worth of the rate). Every bucket built on
+    it reads both on each call, so set() applies to all of them at once.
+    """
+    __slots__ = ("rate", "burst")
+
+    def __init__(self, rate, seconds=BURST):
+        self.set(rate, seconds)
+
+    def set(self, rate, seconds=BURST):
+        if rate < 0:
+            raise ValueError(f"A rate cannot be negative: {rate}")
+        self.rate = rate
+        self.burst = rate * seconds
+
+
+# ---------------- TOKEN BUCKETS ----------------
+# Refilled lazily from the time of the last call, no timer. A Throttle is
+# used by the one thread reading its connection; the fan-out budget is shared.
+class TokenBucket:
+    __slots__ = ("limit", "tokens", "stamp")
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.tokens = FULL
+        self.stamp = monotonic()
+
+    def take(self, amount=1):
+        """
+        Takes `amount` tokens if there are that many, or if the bucket is full
+        (more than a whole burst then leaves it in debt). False leaves the
+        bucket as it was.
+        """
+        limit = self.limit
+        if not limit.rate:
+            self.tokens = FULL
+            return True
+        now = monotonic()
+        tokens = self.tokens + (now - self.stamp) * limit.rate
+        if tokens > limit.burst:
+            tokens = limit.burst
+        self.stamp = now
+        if tokens < amount and tokens < limit.burst:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - amount
+        return True
+
+
+class SharedBucket(TokenBucket):
+    """A TokenBucket every handler thread takes from."""
+    __slots__ = ("lock",)
+
+    def __init__(self, limit):
+        super().__init__(limit)
+        self.lock = threading.Lock()
+
+    def take(self, amount=1):
+        if not self.limit.rate:
+            self.tokens = FULL
+            return True
+        with self.lock:
+            return TokenBucket.take(self, amount)
+
+
+class Throttle:
+    """
+    A frame (or message) rate and a byte rate checked together, for one
+    connection or one user. The two buckets are inlined: this runs for every
+    frame, and one clock read and no calls is most of its cost.
+    """
+    __slots__ = ("frame_limit", "byte_limit", "frames", "bytes", "stamp")
+
+    def __init__(self, frame_limit, byte_limit):
+        self.frame_limit = frame_limit
+        self.byte_limit = byte_limit
+        self.frames = self.bytes = FULL
+        self.stamp = monotonic()
+
+    def _refill(self):
+        """Both buckets as of now; one whose limit is off is FULL and stays uncharged."""
+        now = monotonic()
+        elapsed, self.stamp = now - self.stamp, now
+        frame_limit, byte_limit = self.frame_limit, self.byte_limit
+        frames = data = FULL
+        if frame_limit.rate:
+            frames = self.frames + elapsed * frame_limit.rate
+            if frames > frame_limit.burst:
+                frames = frame_limit.burst
+        if byte_limit.rate:
+            data = self.bytes + elapsed * byte_limit.rate
+            if data > byte_limit.burst:
+                data = byte_limit.burst
+        return frames, data
+
+    def delay(self, size):
+        """Charges one frame of `size` bytes; the seconds to wait before reading the next one."""
+        frame_limit, byte_limit = self.frame_limit, self.byte_limit
+        if not (frame_limit.rate or byte_limit.rate):
+            return 0.0
+        frames, data = self._refill()
+        self.frames = frames = frames - 1
+        self.bytes = data = data - size
+        wait = -frames / frame_limit.rate if frames < 0 and frame_limit.rate else 0.0
+        if data < 0 and byte_limit.rate and -data / byte_limit.rate > wait:
+            wait = -data / byte_limit.rate
+        return wait
+
+    def admit(self, size):
+        """
+        Charges one message of `size` bytes if both rates allow it now (a
+        message over a whole byte burst passes when the bucket is full).
+        """
+        frame_limit, byte_limit = self.frame_limit, self.byte_limit
+        if not (frame_limit.rate or byte_limit.rate):
+            return True
+        frames, data = self._refill()
+        if ((frame_limit.rate and frames < 1)
+                or (byte_limit.rate and data < size and data < byte_limit.burst)):
+            self.frames, self.bytes = frames, data
+            return False
+        self.frames, self.bytes = frames - 1, data - size
+        return True
+
+
+# ---------------- SERVER LIMITS ----------------
+class RateLimits:
+    """
+    Flood control of one server, per second (0 turns a limit off):
+      conn_frames, conn_bytes    every frame a connection sends, handshake
+                                 included. Over the rate its reader pauses, so
+                                 nothing more is read or decrypted and TCP
+                                 pushes back on the client.
+      user_messages, user_bytes  chat, private and room messages of one user,
+                                 kept across resumes. Over the rate a message
+                                 is dropped before it is fanned out and the
+                                 user gets a notice.
+      fan_out                    deliveries per second for all users' messages
+                                 together (a broadcast to 100 users costs 100).
+                                 Over it, messages are dropped the same way.
+    set() changes them at run time, for every connection at once.
+    """
+    NAMES = ("conn_frames", "conn_bytes", "user_messages", "user_bytes", "fan_out")
+
+    def __init__(self, conn_frames=CONN_FRAMES, conn_bytes=CONN_BYTES, user_messages=USER_MESSAGES,
+                 user_bytes=USER_BYTES, fan_out=FAN_OUT, burst=BURST):
+        self.burst = burst
+        self.conn_frames = Limit(conn_frames, burst)
+        self.conn_bytes = Limit(conn_bytes, burst)
+        self.user_messages = Limit(user_messages, burst)
+        self.user_bytes = Limit(user_bytes, burst)
+        self.fan_out = Limit(fan_out, burst)
+
+    @classmethod
+    def off(cls):
+        return cls(**{name: 0 for name in cls.NAMES})
+
+    def set(self, **rates):
+        check_rates(rates)
+        for name, rate in rates.items():
+            getattr(self, name).set(rate, self.burst)
+
+    def rates(self):
+        return {name: getattr(self, name).rate for name in self.NAMES}
+
+    def connection_throttle(self):
+        return Throttle(self.conn_frames, self.conn_bytes)
+
+    def user_throttle(self):
+        return Throttle(self.user_messages, self.user_bytes)
+
+    def fan_out_budget(self):
+        return SharedBucket(self.fan_out)
+
+
+def check_rates(rates):
+    for name, rate in rates.items():
+        if name not in RateLimits.NAMES:
+            raise ValueError(f"Unknown rate limit '{name}', expected one of {', '.join(RateLimits.NAMES)}")
+        if not isinstance(rate, (int, float)) or isinstance(rate, bool) or rate < 0:
+            raise ValueError(f"Bad rate for {name}: {rate!r}")
+
+
+def describe_rates(rates):
+    return ", ".join(f"{name} {rate:g}/s" if rate else f"{name} off" for name, rate in rates.items())
@@ -0,0 +1,109 @@
+import re
+import threading
+
+
+ROOM_NAME = re.compile(r"^[A-Za-z0-9_-]{1,32}$")
+MAX_LISTED = 500    # Rooms returned by one ROOMS request, biggest first
+
+
+def normalize_room(name):
+    """Room names are case insensitive; returns the canonical name, or None if invalid."""
+    if not isinstance(name, str) or not ROOM_NAME.match(name):
+        return None
+    return name.lower()
+
+
+class Room:
+    def __init__(self, name):
+        self.name = name
+        self.members = {}         # {username: Session}
+        self.version = 0          # Bumped once per membership change, like the global roster
+        self._snapshot = None     # Tuple of member sessions, rebuilt lazily after a change
+
+    def snapshot(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            snapshot = self._snapshot = tuple(self.members.values())
+        return snapshot
+
+
+class RoomRegistry:
+    """
+    Room membership indexed both ways: room -> members for fan-out and
+    user -> rooms for cleanup when a user leaves. Joins and leaves are O(1);
+    a room's member tuple is rebuilt on its next message after a change, so
+    a message costs O(members of the room) whatever the number of rooms or users.
+    Empty rooms are dropped.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rooms = {}           # {room name: Room}
+        self.rooms_of = {}        # {username: set of room names}
+
+    def join(self, name, session):
+        """Adds a member. Returns (room version, usernames) after the join and whether it was new."""
+        with self.lock:
+            room = self.rooms.get(name)
+            if room is None:
+                room = self.rooms[name] = Room(name)
+            added = session.username not in room.members
+            if added:
+                room.members[session.username] = session
+                room.version += 1
+                room._snapshot = None
+                self.rooms_of.setdefault(session.username, set()).add(name)
+            return room.version, list(room.members), added
+
+    def leave(self, name, session):
+        """Removes a member. Returns the room version after the leave, or None if not a member."""
+        username = session.username
+        with self.lock:
+            room = self.rooms.get(name)
+            if room is None or room.members.get(username) is not session:
+                return None
+            del room.members[username]
+            room.version += 1
+            room._snapshot = None
+            if not room.members:
+                del self.rooms[name]
+            names = self.rooms_of.get(username)
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    del self.rooms_of[username]
+            return room.version
+
+    def leave_all(self, session):
+        """Removes a session from every room. Returns [(room name, version)] of the rooms left."""
+        left = []
+        for name in sorted(self.rooms_of.get(session.username, ())):
+            version = self.leave(name, session)
+            if version is not None:
+                left.append((name, version))
+        return left
+
+    # ---------------- READERS ----------------
+    def members(self, name):
+        """Member sessions of a room, () if it does not exist."""
+        room = self.rooms.get(name)
+        if room is None:
+            return ()
+        with self.lock:
+            return room.snapshot()
+
+    def is_member(self, name, session):
+        room = self.rooms.get(name)
+        return room is not None and room.members.get(session.username) is session
+
+    def rooms_for(self, username):
+        return sorted(self.rooms_of.get(username, ()))
+
+    def listing(self, limit=MAX_LISTED):
+        """[(room name, member count)] of the biggest rooms."""
+        with self.lock:
+            counts = [(name, len(room.members)) for name, room in self.rooms.items()]
+        counts.sort(key=lambda item: (-item[1], item[0]))
+        return counts[:limit]
+
+    def __len__(self):
+        return len(self.rooms)
@@ -1,32 +1,109 @@
 import socket
 import threading
-from cryptography.fernet import Fernet
-import base64
+import json
+import time
+import secrets
+import itertools
 from datetime import datetime
+from framing import FrameReader, pack_frame
+from fanout import SendQueue, start_socket_writer, POLICY_DISCONNECT, DRAIN_TIMEOUT
+from session_registry import Session, SessionRegistry, RemoteUser, STAGE_HELLO, STAGE_CHAT
+from session_crypto import KeyExchange, CryptoError, CODECS, choose_codec
+from handshake import (ProofVerifier, HandshakeError, parse_message, pack_message, CAPABILITIES,
+                       PROTOCOL_VERSION, HELLO, WELCOME, REJECT, REJECT_PASSWORD, REJECT_DUPLICATE,
+                       REJECT_MALFORMED, REJECT_RESUME, REJECT_CODEC, REJECT_VERSION)
+from envelope import (unpack, pack, pack_roster, MAX_FIELD, CHAT, PRIVATE, ROOM_MSG, NOTICE, USERS, USER_JOINED,
+                      USER_LEFT, ACK, BYE, ROSTER_SYNC, HISTORY, HISTORY_PAGE, JOIN, LEAVE, ROOMS, ROOM_LIST,
+                      FILE_OFFER, FILE_ACCEPT, FILE_ACK, FILE_CANCEL, FILE_DATA)
+from compression import FrameCompressor, MODES, MIN_COMPRESS, choose_mode
+from file_transfer import CANCEL_NOT_FOUND, CANCEL_PEER_LEFT, CANCEL_BUSY, valid_transfer_id, describe_size
+from rooms import RoomRegistry, normalize_room
+from presence import PresenceAggregator, describe_names
+from history_store import HistoryStore, KIND_GLOBAL, KIND_PRIVATE
+from metrics import MetricsRegistry, MetricsServer
+from server_log import ServerLog, MESSAGE
+from rate_limit import RateLimits, NOTICE_INTERVAL, describe_rates
+
+
+ENGINES = ("thread", "async")
+DRAIN_POLL = 0.02          # How often stop() checks whether the outbound queues are empty
+RATE_LIMITED = frozenset((CHAT, PRIVATE, ROOM_MSG)) # What the user rate limits and the fan-out budget count
 
 
 class ChatServer:
-    def __init__(self, host='0.0.0.0', port=5555, password='admin123'):
+    def __init__(self, host='0.0.0.0', port=5555, password='admin123', backlog=128,
+                 send_queue_depth=1024, slow_client_policy=POLICY_DISCONNECT, presence_window=0.1,
+                 history_dir="chat_history", resume_grace=30.0, codecs=tuple(CODECS),
+                 compression=MODES, compression_threshold=MIN_COMPRESS, bus=None, federation=None,
+                 metrics_port=None, metrics_interval=0, log_file=None, log_level=MESSAGE, limits=None):
         self.host = host
         self.port = port
         self.password = password
+        self.proofs = ProofVerifier(password)
+        self.codecs = codecs                 # Frame codecs a client may pick, see session_crypto.py
+        self.compression = compression       # Compression modes a client may pick, () turns it off
+        self.compression_threshold = compression_threshold
+        self.backlog = backlog
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.clients = {}      # {conn: username}
-        self.user_conns = {}   # {username: conn}
+        self.sessions = SessionRegistry()
+        self.tokens = {}                     # {session token: Session}, for resumes
+        self.transfers = {}                  # {transfer id: (sender, target, size)} of file transfers being relayed
+        self.transfers_lock = threading.Lock()
+        self.resume_grace = resume_grace     # Seconds a dropped session waits for its client
+        self.frame_seq = itertools.count(1)  # Every numbered payload gets the next value
+        self.fanout_lock = threading.Lock()
+        self.roster_lock = threading.RLock() # Keeps roster deltas in version order on every queue
+        self.roster_version = 0              # Bumped once per USER_JOINED/USER_LEFT delta sent
+        self.rooms = RoomRegistry()          # Named rooms and their members
+        self.bus = bus                       # sharding.ShardLink when running as one shard of several
+        self.federation = federation         # federation.Federation linking this server to other nodes
+        self.remote_users = {}               # {username: RemoteUser} logged in on other shards or nodes
+        self.room_lock = threading.Lock()    # Keeps each room's roster deltas in version order
+        # Joins/leaves within presence_window seconds go out as one summary + roster update
+        self.presence = PresenceAggregator(presence_window, self.announce_presence, self.roster_lock)
+        self.send_queue_depth = send_queue_depth
+        self.slow_client_policy = slow_client_policy
+        self.limits = limits or RateLimits()  # Flood control, see rate_limit.py; set_limits() changes it live
+        self.fan_out_budget = self.limits.fan_out_budget()
         self.running = True
-
-        # Generate encryption key
-        key = Fernet.generate_key()
-        self.cipher = Fernet(key)
-        self.encoded_key = base64.b64encode(key)
+        self.stopping = False                # Set by drain(): dropped clients are not held for a resume
+        # Persistent message log, None turns history off
+        self.history = HistoryStore(history_dir) if history_dir else None
+        self.metrics_port = metrics_port     # Prometheus endpoint on localhost, None turns it off
+        self.metrics_interval = metrics_interval # Seconds between 📊 log lines, 0 turns them off
+        self.metrics_server = None
+        # Handlers only queue log records; a writer thread formats, files and forwards them
+        self.log = ServerLog(log_file, log_level)
+        self.setup_metrics()
+        self.handlers = self.message_handlers()
 
     # ---------------- START SERVER ----------------
-    def start(self, on_log):
-        self.on_log = on_log
-        self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(10)
-        self.on_log(f"🟢 Server started on {self.host}:{self.port}")
+    def start(self, on_log=None):
+        self.start_log(on_log)
+        if self.bus: # Connections are handed over by the ShardedChatServer
+            self.open_history()
+            self.start_metrics()
+            self.bus.start(self)
+            self.log.info(f"🟢 Shard {self.bus.shard} started")
+            return
+        self.bind()
+        self.open_history()
+        self.start_metrics()
+        self.log.info(f"🟢 Server started on {self.host}:{self.port}")
         threading.Thread(target=self.accept_clients, daemon=True).start()
+        if self.federation:
+            self.federation.start(self)
+
+    # on_log(text) gets every line that passes the log level, on the log writer thread
+    def start_log(self, on_log):
+        if on_log:
+            self.log.add_sink(lambda level, text: on_log(text))
+        self.log.start()
+
+    def bind(self):
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind((self.host, self.port))
+        self.server_socket.listen(self.backlog)
 
     # ---------------- ACCEPT CLIENTS ----------------
     def accept_clients(self):
@@ -37,170 +114,813 @@ class ChatServer:
             except OSError: # Server socket might be closed while waiting for accept
                 break
 
+    # A socket accepted by the hub, with whatever it already read (the HELLO)
+    def adopt_connection(self, conn, addr, initial):
+        threading.Thread(target=self.handle_client, args=(conn, addr, initial), daemon=True).start()
+
 
     # ---------------- HANDLE EACH CLIENT ----------------
-    def handle_client(self, conn, addr):
-        username = None # Initialize username to None
+    def handle_client(self, conn, addr, initial=b""):
+        self.m_connections.inc()
+        client = Session(conn, addr)
+        throttle = self.limits.connection_throttle()
         try:
-            # Step 1: Authenticate with password
-            password = conn.recv(1024).decode('utf-8')
-            if password != self.password:
-                conn.send(b"INVALID")
-                conn.close()
-                return
-
-            # Step 2: Send encryption key
-            conn.send(self.encoded_key)
-
-            # Step 3: Get username
-            username = conn.recv(1024).decode('utf-8')
-            # Check for duplicate username
-            if username in self.user_conns:
-                conn.send(self.cipher.encrypt(b"DUPLICATE_USERNAME"))
-                conn.close()
-                self.on_log(f"❌ Connection from {addr} rejected: Duplicate username '{username}'")
-                return
-                
-            self.clients[conn] = username
-            self.user_conns[username] = conn
-
-            self.on_log(f"👤 {username} connected from {addr}")
-            
-            # --- NEW: Send current user list to the newly connected client ---
-            self.send_user_list(conn) # Send full user list only to the new client
-            
-            # --- MODIFIED: Broadcast join message and updated user list to ALL clients ---
-            # Now, we also broadcast the updated user list to all existing clients
-            self.broadcast(f"🟢 {username} joined the chat.")
-            self.broadcast_user_list() # Broadcast updated user list
-            
-
-            # Step 4: Listen for messages
+            reader = FrameReader(conn)
+            reader.push(initial)
             while self.running:
-                encrypted = conn.recv(4096)
-                if not encrypted:
+                frame = reader.read_frame()
+                if frame is None:
                     break
-
-                msg = self.cipher.decrypt(encrypted).decode('utf-8')
-                if msg.startswith("PRIVATE:"):
-                    parts = msg.split(":", 2)
-                    if len(parts) == 3:
-                        _, target, content = parts
-                        self.private_message(username, target, content)
-                else:
-                    self.broadcast(f"{username}: {msg}")
+                wait = throttle.delay(len(frame))
+                if wait:
+                    self.throttled(wait)
+                    time.sleep(wait) # Reads nothing meanwhile: TCP slows the client down
+                session = self.process_frame(client, frame)
+                if session is None:
+                    break
+                client = session
 
         except Exception as e:
-            self.on_log(f"⚠️ Connection error with {addr} ({username or 'Unknown'}): {e}")
+            self.log.warning(f"⚠️ Connection error with {addr} ({client.username or 'Unknown'}): {e}")
         finally:
-            self.remove_client(conn, username) # Pass username to remove_client
+            self.drop_connection(client, conn)
 
-    # ---------------- BROADCAST MESSAGE ----------------
-    def broadcast(self, message):
-        encrypted = self.cipher.encrypt(message.encode('utf-8'))
-        for conn in list(self.clients.keys()):
-            try:
-                conn.send(encrypted)
-            except:
-                self.remove_client(conn) # This will now call remove_client with just conn
-        self.on_log(message)
-    
-    # --- NEW: Send user list to a specific client ---
-    def send_user_list(self, conn):
-        users = ",".join(self.user_conns.keys())
-        msg = f"USERS:{users}"
+    # ---------------- PROCESS ONE FRAME ----------------
+    # Engine independent: returns the session to continue with (a resumed one
+    # replaces the fresh one), or None once the connection should be closed.
+    # After the handshake every frame is an envelope (envelope.py), handed to
+    # the handler registered for its type.
+    def process_frame(self, client, frame):
+        # Step 1: Handshake, one HELLO answered by WELCOME or REJECT
+        if client.stage == STAGE_HELLO:
+            started = time.perf_counter()
+            session = self.accept_hello(client, frame)
+            self.m_handshake.observe(time.perf_counter() - started)
+            (self.m_handshakes_ok if session else self.m_handshakes_rejected).inc()
+            return session
+
+        # Step 2: Chat messages
+        self.m_bytes_in.inc(len(frame))
+        started = time.perf_counter()
+        frame = client.codec.decrypt(frame)
+        self.m_decrypt.observe(time.perf_counter() - started)
+        if client.compressor:
+            frame = client.compressor.decompress(frame)
+        message = unpack(frame)
+        entry = self.handlers.get(message.type)
+        if entry is None:
+            return client # A type from a newer client, ignore it
+        handler, counter = entry
+        counter.inc()
+        if message.type in RATE_LIMITED and not self.admit(client, message):
+            return client
+        handler(client, message)
+        # BYE: deliberate logout, do not hold the session for a resume
+        return None if client.logged_out else client
+
+    # ---------------- RATE LIMITS ----------------
+    # Two places, both cheap next to what they save. The engines charge every
+    # frame to its connection before it is decrypted and pause the reader when
+    # over the rate (frames cannot be skipped: the nonces count them). Chat,
+    # private and room messages are then charged to the user and to the
+    # server's fan-out budget, and dropped before being sealed for everyone.
+    def throttled(self, wait):
+        self.m_throttled.inc()
+        self.m_throttled_seconds.inc(wait)
+
+    def admit(self, session, message):
+        if not session.throttle.admit(len(message.body)):
+            self.shed(session, self.m_shed["user"], "You are sending messages too fast")
+            return False
+        budget = self.fan_out_budget
+        if budget.limit.rate and not budget.take(self.recipients(message)):
+            self.shed(session, self.m_shed["fan_out"], "The server is busy")
+            return False
+        return True
+
+    def recipients(self, message):
+        if message.type == PRIVATE:
+            return 2 # The target and the sender's own copy
+        if message.type == ROOM_MSG:
+            return len(self.rooms.members(normalize_room(message.target)))
+        return len(self.sessions)
+
+    def shed(self, session, counter, reason):
+        counter.inc()
+        session.shed += 1
+        now = time.monotonic()
+        if now - session.warned_at >= NOTICE_INTERVAL:
+            self.fan_out([session], NOTICE,
+                         f"⚠️ {reason}: {session.shed} message(s) not delivered since the last warning.")
+            self.log.warning("🚦 {}: {} message(s) dropped ({})", session.username, session.shed, reason.lower())
+            session.shed, session.warned_at = 0, now
+
+    def set_limits(self, **rates):
+        """Changes rate limits (per second, 0 turns one off) for every connection at once."""
+        self.limits.set(**rates)
+        self.log.info(f"🚦 Rate limits: {describe_rates(self.limits.rates())}")
+
+    # ---------------- CLIENT MESSAGES ----------------
+    # {type: (handler(session, envelope), counter)}. The sender is always the
+    # session's own username, whatever the envelope says.
+    def message_handlers(self):
+        counted = self.m_in
+        return {
+            CHAT: (self.chat_message, counted["global"]),
+            PRIVATE: (lambda client, message: self.private_message(client.username, message.target, message.text),
+                      counted["private"]),
+            ROOM_MSG: (lambda client, message: self.room_message(client, message.target, message.text),
+                       counted["room"]),
+            ACK: (lambda client, message: client.acknowledge(message.seq), counted["control"]),
+            BYE: (self.say_bye, counted["control"]),
+            ROSTER_SYNC: (lambda client, message: self.send_user_list(client), counted["control"]),
+            HISTORY: (self.send_history, counted["control"]),
+            JOIN: (lambda client, message: self.join_room(client, message.target), counted["control"]),
+            LEAVE: (lambda client, message: self.leave_room(client, message.target), counted["control"]),
+            ROOMS: (lambda client, message: self.fan_out([client], ROOM_LIST, json.dumps(self.rooms.listing())),
+                    counted["control"]),
+            FILE_OFFER: (self.offer_file, counted["file"]),
+            FILE_ACCEPT: (self.file_control, counted["file"]),
+            FILE_ACK: (self.file_control, counted["file"]),
+            FILE_CANCEL: (self.file_control, counted["file"]),
+            FILE_DATA: (self.relay_chunk, counted["file"]),
+        }
+
+    def say_bye(self, client, message):
+        client.logged_out = True
+
+    def chat_message(self, client, message):
+        msg = message.text
+        self.record_history(KIND_GLOBAL, client.username, msg)
+        self.broadcast(CHAT, msg, sender=client.username)
+        self.publish({"op": "broadcast", "user": client.username, "msg": msg})
+
+    # ---------------- HANDSHAKE ----------------
+    # HELLO:{"username", "nonce", "ts", "proof", "pub", "codecs", "caps"[, "compression", "resume"]}
+    # is checked in one go; the reply carries our half of the key exchange, the
+    # chosen codec and compression mode, the session token and the granted
+    # capabilities. Every connection gets its own keys.
+    def accept_hello(self, client, frame):
         try:
-            conn.send(self.cipher.encrypt(msg.encode('utf-8')))
-        except Exception as e:
-            self.on_log(f"Error sending user list to a client: {e}")
-
-    # --- NEW: Broadcast user list to all clients ---
-    def broadcast_user_list(self):
-        users = ",".join(self.user_conns.keys())
-        msg = f"USERS:{users}"
-        encrypted = self.cipher.encrypt(msg.encode('utf-8'))
-        for conn in list(self.clients.keys()):
-            try:
-                conn.send(encrypted)
-            except:
-                self.on_log(f"Error broadcasting user list to client {self.clients.get(conn, 'Unknown')}")
-                self.remove_client(conn)
+            kind, hello = parse_message(frame)
+        except HandshakeError:
+            kind, hello = None, {}
+        username = hello.get("username")
+        if kind != HELLO or not isinstance(username, str) or not username:
+            return self.reject(client, REJECT_MALFORMED)
+        if hello.get("v") != PROTOCOL_VERSION:
+            return self.reject(client, REJECT_VERSION)
+        # Printable (rosters are one name per line) and short enough to leave room for "@node"
+        if not username.isprintable() or len(username.encode('utf-8')) > MAX_FIELD // 2:
+            return self.reject(client, REJECT_MALFORMED)
+        if self.federation and "@" in username: # Reserved for users of other nodes, name@node
+            return self.reject(client, REJECT_MALFORMED)
+        if not self.proofs.verify(hello):
+            return self.reject(client, REJECT_PASSWORD)
+        kex = KeyExchange()
+        codec = choose_codec(hello.get("codecs"), self.codecs)
+        if codec is None:
+            return self.reject(client, REJECT_CODEC)
+        try:
+            client.codec = kex.derive(hello.get("pub"), self.password, hello["nonce"], False, codec)
+        except CryptoError:
+            return self.reject(client, REJECT_MALFORMED)
+        mode = choose_mode(hello.get("compression"), self.compression)
+        client.compressor = FrameCompressor(mode, self.compression_threshold) if mode else None
+        caps = hello.get("caps")
+        client.caps = tuple(cap for cap in caps if cap in CAPABILITIES) if isinstance(caps, list) else ()
+        if "resume" in hello:
+            return self.resume_client(client, username, hello["resume"], kex.public_key())
+
+        client.username = username
+        client.token = secrets.token_urlsafe(16)
+        client.throttle = self.limits.user_throttle() # A resume keeps the session's, so reconnecting resets nothing
+        client.send_queue = self.new_send_queue(client)
+        with self.roster_lock:
+            # Registering checks for a duplicate username atomically
+            added = self.sessions.add(client)
+            if added:
+                client.stage = STAGE_CHAT
+                self.tokens[client.token] = client
+                self.send_welcome(client, kex.public_key()) # Goes out before anything queued, the writer is not running yet
+                self.start_writer(client)
+                # Full snapshot for the newcomer, everyone else hears about it in the next presence flush
+                self.send_user_list(client)
+                self.presence.joined(username)
+                self.publish({"op": "joined", "user": username})
+
+        if not added:
+            client.username = None
+            self.log.warning(f"❌ Connection from {client.addr} rejected: Duplicate username '{username}'")
+            return self.reject(client, REJECT_DUPLICATE)
+
+        self.log.info(f"👤 {username} connected from {client.addr}")
+        return client
+
+    def send_welcome(self, session, public_key, resumed=False):
+        session.conn.sendall(pack_frame(pack_message(WELCOME, {
+            "v": PROTOCOL_VERSION,
+            "pub": public_key,
+            "codec": session.codec.name,
+            "compression": session.compressor.mode if session.compressor else None,
+            "token": session.token,
+            "caps": list(session.caps),
+            "resumed": resumed,
+        })))
+
+    def reject(self, client, reason):
+        client.conn.sendall(pack_frame(pack_message(REJECT, {"reason": reason})))
+        client.conn.close()
+        return None
+
+    # ---------------- BROADCAST MESSAGE ----------------
+    def broadcast(self, kind, body, sender="", log=True):
+        self.fan_out(self.sessions.snapshot(), kind, body, sender)
+        if log:
+            if sender:
+                self.log.message("{}: {}", sender, body)
+            else:
+                self.log.info(body)
+
+    # ---------------- FAN-OUT ----------------
+    # Messages are encoded once and the same payload is queued for every recipient;
+    # each connection's writer seals it with that connection's keys on the way out.
+    # Each envelope carries a server-wide sequence number that clients echo back
+    # when resuming, so only what they missed is replayed.
+    def fan_out(self, sessions, kind, body="", sender="", target=""):
+        self.drop_slow(self.enqueue(sessions, kind, body, sender, target))
+
+    # fan_out() without the disconnects: returns the sessions whose queue was full.
+    # Used under room_lock, which remove_session() takes too; the caller passes
+    # them to drop_slow() once the lock is released.
+    def enqueue(self, sessions, kind, body="", sender="", target=""):
+        # Numbering and queueing under one lock: every queue sees increasing numbers
+        started = time.perf_counter()
+        with self.fanout_lock:
+            seq = next(self.frame_seq)
+            payload = pack(kind, body, sender, target, seq, time.time())
+            slow = [session for session in sessions if not session.deliver(seq, payload)]
+        self.m_fan_out.observe(time.perf_counter() - started)
+        self.m_deliveries.inc(len(sessions))
+        return slow
+
+    def drop_slow(self, slow):
+        for session in slow:
+            self.m_slow.inc()
+            self.log.warning(f"🐢 Outbound queue of {session.username} is full. Disconnecting.")
+            self.remove_session(session)
+
+    def new_send_queue(self, session):
+        codec, compressor = session.codec, session.compressor
+        encrypt_time, frames_out, bytes_out = self.m_encrypt.observe, self.m_frames_out.inc, self.m_bytes_out.inc
+
+        def seal(data):
+            started = time.perf_counter()
+            frame = pack_frame(codec.encrypt(data))
+            encrypt_time(time.perf_counter() - started)
+            frames_out()
+            bytes_out(len(frame))
+            return frame
+
+        if compressor:
+            # Compressed before sealing: ciphertext does not compress
+            encode = lambda payload: seal(compressor.compress(payload))
+            encode_bulk = lambda payload: seal(compressor.compress(payload, skip=True))
+        else:
+            encode = encode_bulk = seal
+        return SendQueue(self.send_queue_depth, self.slow_client_policy, encode=encode, encode_bulk=encode_bulk)
+
+    def start_writer(self, session):
+        start_socket_writer(session.conn, session.send_queue, self.on_writer_error)
+
+    def on_writer_error(self, conn, error):
+        session = self.sessions.get(conn)
+        self.log.warning(f"⚠️ Send error to {session.username if session else 'Unknown'}: {error}")
+
+    def queue_stats(self):
+        """Outbound queue depth and drop counters, keyed by username (connected users only)."""
+        return {session.username: queue.stats() for session in self.sessions.snapshot()
+                if (queue := session.send_queue) is not None}
+
+    def compression_stats(self):
+        """Raw vs. wire bytes of outbound frames, keyed by username (compressing users only)."""
+        return {session.username: compressor.stats() for session in self.sessions.snapshot()
+                if (compressor := session.compressor) is not None}
+
+    # ---------------- METRICS ----------------
+    # Counters and histograms are bumped on the hot path without locks (see
+    # metrics.py); gauges are only read when scraped or logged.
+    def setup_metrics(self):
+        m = self.metrics = MetricsRegistry()
+        self.m_connections = m.counter("chat_connections_total", "TCP connections accepted")
+        self.m_handshakes_ok = m.counter("chat_handshakes_total", "Handshakes by outcome", result="ok")
+        self.m_handshakes_rejected = m.counter("chat_handshakes_total", "Handshakes by outcome", result="rejected")
+        self.m_handshake = m.histogram("chat_handshake_seconds", "Time to check a HELLO and answer it")
+        self.m_in = {kind: m.counter("chat_messages_in_total", "Frames received from clients, by kind", kind=kind)
+                     for kind in ("global", "private", "room", "file", "control")}
+        self.m_bytes_in = m.counter("chat_bytes_in_total", "Encrypted frame bytes received from clients")
+        self.m_decrypt = m.histogram("chat_decrypt_seconds", "Time to open one inbound frame")
+        self.m_deliveries = m.counter("chat_fan_out_deliveries_total", "Payloads queued for a recipient")
+        self.m_fan_out = m.histogram("chat_fan_out_seconds", "Time to number a message and queue it for every recipient")
+        self.m_frames_out = m.counter("chat_frames_out_total", "Frames sealed for clients")
+        self.m_bytes_out = m.counter("chat_bytes_out_total", "Encrypted frame bytes sent to clients")
+        self.m_encrypt = m.histogram("chat_encrypt_seconds", "Time to seal one outbound frame")
+        self.m_slow = m.counter("chat_slow_disconnects_total", "Clients disconnected for a full outbound queue")
+        self.m_throttled = m.counter("chat_throttled_frames_total", "Frames read late for a connection over its rate")
+        self.m_throttled_seconds = m.counter("chat_throttled_seconds_total", "Time readers paused for connection rates")
+        self.m_shed = {limit: m.counter("chat_messages_shed_total", "Messages dropped by the rate limits", limit=limit)
+                       for limit in ("user", "fan_out")}
+        m.gauge("chat_sessions", "Users logged in on this server", lambda: len(self.sessions))
+        m.gauge("chat_remote_users", "Users of other shards or nodes", lambda: len(self.remote_users))
+        m.gauge("chat_queue_depth", "Frames waiting in outbound queues",
+                lambda: sum(stats["depth"] for stats in self.queue_stats().values()), stat="total")
+        m.gauge("chat_queue_depth", "Frames waiting in outbound queues",
+                lambda: max((stats["depth"] for stats in self.queue_stats().values()), default=0), stat="max")
+        m.gauge("chat_queue_dropped", "Frames dropped by the outbound queues of connected users",
+                lambda: sum(stats["dropped"] for stats in self.queue_stats().values()))
+
+    def start_metrics(self):
+        if self.metrics_port is not None:
+            self.metrics_server = MetricsServer(self.metrics, self.metrics_port)
+            self.metrics_server.start()
+            self.log.info(f"📊 Metrics on http://{self.metrics_server.host}:{self.metrics_server.port}/metrics")
+        if self.metrics_interval > 0:
+            threading.Thread(target=self.log_metrics, daemon=True).start()
+
+    def log_metrics(self):
+        # One line per interval: rates since the previous line, latencies since start
+        previous, last = self.metric_totals(), time.monotonic()
+        while True:
+            time.sleep(self.metrics_interval)
+            if not self.running:
+                return
+            current, now = self.metric_totals(), time.monotonic()
+            rates = [(current[i] - previous[i]) / (now - last) for i in range(len(current))]
+            queues = self.queue_stats().values()
+            self.log.info(f"📊 {len(self.sessions)} users, {rates[0]:.0f} msg/s in, {rates[1]:.0f} frames/s out "
+                          f"({describe_size(rates[2])}/s), fan-out p99 {self.format_quantile(self.m_fan_out)}, "
+                          f"encrypt p99 {self.format_quantile(self.m_encrypt)}, "
+                          f"max queue {max((stats['depth'] for stats in queues), default=0)}")
+            previous, last = current, now
+
+    def metric_totals(self):
+        return (sum(counter.value() for counter in self.m_in.values()), self.m_frames_out.value(), self.m_bytes_out.value())
+
+    def format_quantile(self, histogram, fraction=0.99):
+        bound = histogram.quantile(fraction)
+        return "-" if bound is None else f"≤{bound * 1000:g} ms"
+
+    # ---------------- ROSTER ----------------
+    # A client gets the full list once (a USERS envelope), then only
+    # USER_JOINED / USER_LEFT deltas, each with the next roster version. Deltas carry
+    # the final state of each name, so applying one twice is harmless.
+    def send_user_list(self, session):
+        with self.roster_lock:
+            users = itertools.chain(self.sessions.usernames(), self.remote_users)
+            self.fan_out([session], USERS, pack_roster(self.roster_version, users))
+
+    def broadcast_roster_delta(self, kind, usernames):
+        # Callers hold roster_lock, so versions go out in order
+        self.roster_version += 1
+        self.fan_out(self.sessions.snapshot(), kind, pack_roster(self.roster_version, usernames))
+
+    # ---------------- PRESENCE ----------------
+    # Called by the PresenceAggregator once per window, with roster_lock held.
+    def announce_presence(self, joined, left):
+        if left:
+            self.broadcast_roster_delta(USER_LEFT, left)
+        if joined:
+            self.broadcast_roster_delta(USER_JOINED, joined)
+
+        # Only broadcast if there are clients left to receive. Every shard
+        # announces every user, leave the log to the one they were on.
+        if len(self.sessions):
+            if left:
+                self.broadcast(NOTICE, f"🔴 {describe_names(left)} left the chat.", log=not self.bus)
+            if joined:
+                self.broadcast(NOTICE, f"🟢 {describe_names(joined)} joined the chat.", log=not self.bus)
+
+    # ---------------- HISTORY ----------------
+    def open_history(self):
+        if self.history:
+            self.history.open()
+            self.log.info(f"📜 Message history in '{self.history.directory}' (last seq {self.history.last_seq()})")
+
+    def record_history(self, kind, sender, msg, target=None):
+        if self.history:
+            self.history.append(kind, sender, msg, target) # Only queues, the disk write is batched
+
+    # HISTORY with seq = a log sequence number to read after, or ts = a unix
+    # time to read since, or neither for the latest messages; body = the page
+    # size. Answered with a HISTORY_PAGE.
+    def send_history(self, session, message):
+        limit = int(message.body) if message.body.isdigit() else 100
+        records, next_after = [], None
+        if self.history is None:
+            pass
+        elif message.seq:
+            records, next_after = self.history.read(session.username, after_seq=message.seq, limit=limit)
+        elif message.ts:
+            records, next_after = self.history.read(session.username, limit=limit, since=message.ts)
+        else:
+            records = self.history.latest(session.username, limit)
+        page = json.dumps({"messages": records, "next": next_after}, ensure_ascii=False)
+        self.fan_out([session], HISTORY_PAGE, page)
 
     # ---------------- PRIVATE MESSAGE ----------------
     def private_message(self, sender, target, msg):
-        if target in self.user_conns:
-            target_conn = self.user_conns[target]
-            text = f"💬 [Private] {sender}: {msg}"
-            encrypted = self.cipher.encrypt(text.encode('utf-8'))
-            
-            # Send to target
-            try:
-                target_conn.send(encrypted)
-            except:
-                self.on_log(f"Error sending private message to {target}. Removing client.")
-                self.remove_client(target_conn)
-                return # If target fails, don't try to send to sender again
-
-            # Also send back to sender’s own window for their record
-            sender_conn = self.user_conns[sender]
-            try:
-                sender_conn.send(encrypted) # Send the same message back to sender
-            except:
-                self.on_log(f"Error sending private message echo to {sender}. Removing client.")
-                self.remove_client(sender_conn)
-
-            self.on_log(f"[Private] {sender} → {target}: {msg}")
+        sender_session = self.sessions.find(sender)
+        target_session = self.sessions.find(target)
+        if sender_session is None: # Sender left while we were routing
+            return
+        if target_session:
+            # Send to target, and the same frame back to the sender's own window for their record
+            self.fan_out([target_session, sender_session], PRIVATE, msg, sender, target)
+            self.record_history(KIND_PRIVATE, sender, msg, target)
+            self.log.message("[Private] {} → {}: {}", sender, target, msg)
+        elif target in self.remote_users:
+            # The target's shard delivers it and keeps its own copy in history
+            self.publish({"op": "private", "user": sender, "target": target, "msg": msg})
+            self.fan_out([sender_session], PRIVATE, msg, sender, target)
+            self.record_history(KIND_PRIVATE, sender, msg, target)
+            self.log.message("[Private] {} → {}: {}", sender, target, msg)
         else:
-            sender_conn = self.user_conns[sender]
-            try:
-                sender_conn.send(self.cipher.encrypt(f"❌ {target} not found.".encode('utf-8')))
-            except:
-                self.on_log(f"Error informing {sender} that {target} was not found. Removing client.")
-                self.remove_client(sender_conn)
+            self.fan_out([sender_session], NOTICE, f"❌ {target} not found.")
+
+    # ---------------- ROOMS ----------------
+    # JOIN, LEAVE and ROOM_MSG name the room as their target, ROOMS lists them.
+    # Whatever a member receives about a room carries the room as its target,
+    # including a USERS/USER_JOINED/USER_LEFT roster versioned per room.
+    # Fan-out only ever touches the members of the room.
+    def join_room(self, session, name):
+        room = normalize_room(name)
+        if room is None:
+            self.fan_out([session], NOTICE, f"❌ Invalid room name '{name}'.")
+            return
+        with self.room_lock:
+            version, names, added = self.rooms.join(room, session)
+            # A repeated JOIN just resends the snapshot, clients use it to resync
+            slow = self.enqueue([session], USERS, pack_roster(version, names), target=room)
+            if added:
+                members = self.rooms.members(room)
+                slow += self.enqueue([member for member in members if member is not session], USER_JOINED,
+                                     pack_roster(version, [session.username]), target=room)
+                slow += self.enqueue(members, NOTICE, f"🟢 {session.username} joined #{room}.", target=room)
+        self.drop_slow(slow)
+        if added and not session.remote:
+            self.publish({"op": "room_join", "user": session.username, "room": room})
+            self.log.info(f"🚪 {session.username} joined #{room}")
+
+    def leave_room(self, session, name):
+        room = normalize_room(name)
+        if room is not None:
+            with self.room_lock:
+                version = self.rooms.leave(room, session)
+                slow = self.announce_room_leave(room, version, session) if version is not None else []
+            self.drop_slow(slow)
+            if version is not None and not session.remote:
+                self.publish({"op": "room_leave", "user": session.username, "room": room})
+
+    # Called under room_lock: returns the slow members for drop_slow()
+    def announce_room_leave(self, room, version, session):
+        members = self.rooms.members(room)
+        slow = self.enqueue(members, USER_LEFT, pack_roster(version, [session.username]), target=room)
+        slow += self.enqueue(members, NOTICE, f"🔴 {session.username} left #{room}.", target=room)
+        if not session.remote:
+            self.log.info(f"🚪 {session.username} left #{room}")
+        return slow
+
+    def room_message(self, session, name, msg):
+        room = normalize_room(name)
+        if room is None or not self.rooms.is_member(room, session):
+            self.fan_out([session], NOTICE, f"❌ You are not in #{name}.")
+            return
+        self.fan_out(self.rooms.members(room), ROOM_MSG, msg, session.username, room)
+        if not session.remote:
+            self.publish({"op": "room_msg", "user": session.username, "room": room, "msg": msg})
+            self.log.message("[#{}] {}: {}", room, session.username, msg)
+
+    # ---------------- SHARDS AND FEDERATION ----------------
+    # Only used when this server is one shard of a ShardedChatServer or a
+    # federation node: events from the other shards or nodes replay their users'
+    # side of the protocol here, with a RemoteUser standing in for the sender.
+    # The sender's own server logs them.
+    def publish(self, event):
+        if self.bus:
+            self.bus.publish(event)
+        if self.federation:
+            self.federation.publish(event)
+
+    def on_bus_event(self, event):
+        op, username = event.get("op"), event.get("user")
+        if op == "joined":
+            with self.roster_lock:
+                if username in self.remote_users:
+                    return # Announced again after a link came back
+                self.remote_users[username] = RemoteUser(username)
+                self.presence.joined(username)
+        elif op == "left":
+            with self.roster_lock:
+                remote = self.remote_users.pop(username, None)
+                if remote is not None:
+                    self.presence.left(username)
+            if remote is not None:
+                slow = []
+                with self.room_lock:
+                    for room, version in self.rooms.leave_all(remote):
+                        slow += self.announce_room_leave(room, version, remote)
+                self.drop_slow(slow)
+        elif op == "broadcast":
+            self.record_history(KIND_GLOBAL, username, event["msg"])
+            self.broadcast(CHAT, event["msg"], sender=username, log=False)
+        elif op == "private":
+            target = self.sessions.find(event["target"])
+            if target is not None:
+                self.fan_out([target], PRIVATE, event["msg"], username, event["target"])
+                self.record_history(KIND_PRIVATE, username, event["msg"], event["target"])
+        elif op in ("room_join", "room_leave", "room_msg"):
+            remote = self.remote_users.get(username)
+            if remote is None:
+                return
+            if op == "room_join":
+                self.join_room(remote, event["room"])
+            elif op == "room_leave":
+                self.leave_room(remote, event["room"])
+            else:
+                self.room_message(remote, event["room"], event["msg"])
+
+    # ---------------- FILE TRANSFER ----------------
+    # Offers, accepts and cancels travel like private messages (numbered, so a
+    # resume replays them). Chunks and acks are routed by transfer id and the
+    # decrypted frame is queued for the receiver as it is, chunks on the bulk
+    # lane behind chat. See file_transfer.py for the protocol.
+    def file_control(self, client, message):
+        kind, transfer_id, value = message.type, message.target, message.text
+        with self.transfers_lock:
+            transfer = self.transfers.get(transfer_id)
+            if transfer is None or client.username not in transfer[:2]:
+                return
+            sender, target, size = transfer
+            peer = self.sessions.find(target if client.username == sender else sender)
+            finished = kind == FILE_CANCEL or (kind == FILE_ACK and value == str(size))
+            if finished:
+                del self.transfers[transfer_id]
+        if kind != FILE_CANCEL and client.username != target:
+            return # Only the receiver accepts and acks
+        if peer is not None:
+            if kind == FILE_ACK:
+                peer.send_direct(message.frame)
+            else:
+                self.fan_out([peer], kind, value, target=transfer_id)
+        if kind == FILE_ACK and finished:
+            self.log.info(f"📁 {sender} → {target}: transfer {transfer_id} complete ({describe_size(size)})")
+
+    def offer_file(self, client, message):
+        target = message.target
+        try:
+            offer = message.json()
+            transfer_id, size = offer["id"], offer["size"]
+        except (ValueError, KeyError, TypeError):
+            return
+        if not (valid_transfer_id(transfer_id) and isinstance(size, int) and size >= 0):
+            return
+        target_session = self.sessions.find(target)
+        with self.transfers_lock:
+            known = transfer_id in self.transfers
+            if not known and target_session is not None and target != client.username:
+                self.transfers[transfer_id] = (client.username, target, size)
+        if known:
+            return
+        if target_session is None or target == client.username:
+            self.fan_out([client], FILE_CANCEL, CANCEL_NOT_FOUND, target=transfer_id)
+            return
+        self.fan_out([target_session], FILE_OFFER, json.dumps(offer, ensure_ascii=False), client.username)
+        self.log.info(f"📁 {client.username} → {target}: offering '{offer.get('name')}' ({describe_size(size)})")
+
+    def relay_chunk(self, client, message):
+        transfer = self.transfers.get(message.target)
+        if transfer is None or transfer[0] != client.username:
+            return # Cancelled meanwhile
+        target = self.sessions.find(transfer[1])
+        if target is None or target.send_direct(message.frame, bulk=True):
+            return
+        if target.send_queue is not None: # Bulk lane full: the sender ignored its window
+            self.cancel_transfer(message.target, CANCEL_BUSY)
+        # Otherwise the receiver is detached and restates its offset when it resumes
+
+    def cancel_transfer(self, transfer_id, reason):
+        with self.transfers_lock:
+            transfer = self.transfers.pop(transfer_id, None)
+        if transfer is not None:
+            sessions = [s for s in map(self.sessions.find, transfer[:2]) if s is not None]
+            self.fan_out(sessions, FILE_CANCEL, reason, target=transfer_id)
+
+    def cancel_transfers_of(self, username):
+        with self.transfers_lock:
+            ids = [transfer_id for transfer_id, transfer in self.transfers.items() if username in transfer[:2]]
+        for transfer_id in ids:
+            self.cancel_transfer(transfer_id, CANCEL_PEER_LEFT)
+
+
+    # ---------------- RESUME ----------------
+    # A HELLO with "resume": {"token", "last_seq"}. The dropped session takes over this
+    # connection, gets WELCOME and then every frame after last_seq, before any new one.
+    def resume_client(self, client, username, resume, public_key):
+        token = resume.get("token") if isinstance(resume, dict) else None
+        last_seq = resume.get("last_seq") if isinstance(resume, dict) else None
+        session = self.tokens.get(token) if isinstance(token, str) else None
+        if session is not None and session.username != username:
+            session = None
+        missed = None
+        if session is not None and isinstance(last_seq, int):
+            with session.lock: # Holds fan-out to this session until the replay is queued
+                missed = session.missed_since(last_seq)
+                if missed is not None:
+                    old_conn, old_addr, old_queue = session.conn, session.addr, session.send_queue
+                    if old_queue:
+                        old_queue.close()
+                    session.conn, session.addr = client.conn, client.addr
+                    session.detached_at = None
+                    session.codec, session.caps = client.codec, client.caps
+                    session.compressor = client.compressor
+                    session.send_queue = self.new_send_queue(session)
+                    self.send_welcome(session, public_key, resumed=True)
+                    for payload in missed:
+                        session.send_queue.put(payload)
+                    self.sessions.reattach(session, old_conn, old_addr)
+                    self.start_writer(session)
+
+        if missed is None:
+            # Unknown, expired, or too far behind to replay: the client must log in again
+            self.reject(client, REJECT_RESUME)
+            if session is not None:
+                self.remove_session(session)
+            return None
 
+        if old_conn is not client.conn:
+            self.close_connection(old_conn) # A half-open old connection may still be around
+        self.log.info(f"🔄 {session.username} resumed from {client.addr}, replayed {len(missed)} frames")
+        return session
+
+    # Keeps a dropped user online for resume_grace seconds, collecting frames to replay
+    def detach_client(self, session, conn):
+        with session.lock:
+            if session.conn is not conn:
+                return # Resumed on a new connection in the meantime
+            if session.send_queue:
+                session.send_queue.close()
+                session.send_queue = None
+            detached_at = session.detached_at = time.monotonic()
+        self.sessions.detach(session)
+        self.close_connection(conn)
+        timer = threading.Timer(self.resume_grace, self.expire_session, (session, detached_at))
+        timer.daemon = True
+        timer.start()
+        self.log.info(f"⏸️ {session.username} dropped, holding the session for {self.resume_grace:g}s")
+
+    def expire_session(self, session, detached_at):
+        if session.detached_at == detached_at: # Not resumed (or dropped again) since
+            self.remove_session(session)
 
     # ---------------- REMOVE CLIENT ----------------
-    # Modified to accept username, or derive it from conn if not provided
-    def remove_client(self, conn, username=None):
-        if conn in self.clients:
-            if username is None: # If username not passed, find it
-                username = self.clients.get(conn, "Unknown User")
-            
-            del self.clients[conn]
-            if username in self.user_conns:
-                del self.user_conns[username]
-            
-            # Only broadcast if there are other clients left to receive
-            if self.clients:
-                self.broadcast(f"🔴 {username} left the chat.")
-                self.broadcast_user_list() # Broadcast updated user list after removal
-            
+    def remove_client(self, conn):
+        session = self.sessions.get(conn)
+        return session is not None and self.remove_session(session)
+
+    # Safe to call any number of times from any thread: the registry removes a
+    # session for exactly one caller, so each user leaves (and is announced) once.
+    def remove_session(self, session):
+        with self.roster_lock:
+            if not self.sessions.remove(session):
+                return False
+            self.presence.left(session.username)
+            self.publish({"op": "left", "user": session.username}) # Other shards drop them from rooms too
+        self.tokens.pop(session.token, None)
+        self.cancel_transfers_of(session.username)
+        slow = []
+        with self.room_lock:
+            for room, version in self.rooms.leave_all(session):
+                slow += self.announce_room_leave(room, version, session)
+        self.drop_slow(slow)
+
+        with session.lock:
+            if session.send_queue:
+                session.send_queue.close()
+                session.send_queue = None
+            session.detached_at = None
+        self.close_connection(session.conn)
+        self.log.info(f"🛑 {session.username} disconnected.")
+        return True
+
+    def close_connection(self, conn):
+        try:
+            conn.shutdown(socket.SHUT_RDWR) # Wakes its reader if we are on another thread
+        except OSError:
+            pass
+        conn.close()
+
+    # Called once the reader of a connection is done, whatever the reason
+    def drop_connection(self, client, conn):
+        if client.stage != STAGE_CHAT:
             conn.close()
-            self.on_log(f"🛑 {username} disconnected.")
-        elif username: # If conn not in clients but username is known
-            # Clean up user_conns if only username is known but conn is gone
-            if username in self.user_conns:
-                del self.user_conns[username]
-            if self.clients: # Only broadcast if other clients exist
-                self.broadcast(f"🔴 {username} left the chat.")
-                self.broadcast_user_list()
-            self.on_log(f"🛑 {username} (connection already gone) disconnected.")
+            self.log.info(f"🛑 Unknown client disconnected.")
+        elif client.conn is not conn:
+            conn.close() # This session has already been resumed on another connection
+        elif client.logged_out or self.resume_grace <= 0 or not self.running or self.stopping:
+            self.remove_session(client)
         else:
-            self.on_log(f"🛑 Unknown client disconnected.")
+            self.detach_client(client, conn)
 
 
     # ---------------- STOP SERVER ----------------
-    def stop(self):
+    # Graceful: no new connections, then up to drain_timeout seconds for what
+    # is already queued to be written, and only then are the sockets closed.
+    # stop(0) closes them right away.
+    def stop(self, drain_timeout=DRAIN_TIMEOUT):
+        self.close_listener()
+        if self.federation:
+            self.federation.stop()
+        if drain_timeout > 0:
+            self.drain(drain_timeout)
         self.running = False
-        # Close all client connections gracefully before closing server socket
-        # Iterate over a copy of keys, as self.clients will be modified
-        for conn in list(self.clients.keys()):
-            self.remove_client(conn)
-        
+        if self.metrics_server:
+            self.metrics_server.stop()
+        for session in self.sessions.snapshot():
+            self.remove_session(session)
+        self.presence.close()
+        if self.history:
+            self.history.close()
+        self.log.info("🛑 Server stopped.")
+        self.log.close()
+
+    def close_listener(self):
         try:
-            self.server_socket.shutdown(socket.SHUT_RDWR) # Attempt graceful shutdown
+            self.server_socket.shutdown(socket.SHUT_RDWR) # Wakes the accept thread
         except OSError:
-            pass # Socket might already be closed
+            pass # Never bound (a shard), or already closed
         finally:
             self.server_socket.close()
-        self.on_log("🛑 Server stopped.")
+
+    def drain(self, timeout):
+        """
+        Waits up to `timeout` seconds until every connected client's queue is
+        written out, so stopping never cuts a broadcast off halfway through the
+        recipients. Returns the number of frames still unsent.
+        """
+        self.presence.flush()       # Pending join/leave summaries go out with the rest
+        with self.fanout_lock:
+            pass                    # A fan-out under way finishes queueing first
+        deadline = time.monotonic() + timeout
+        while True:
+            unsent = sum(self.unsent(session) for session in self.sessions.snapshot())
+            if not unsent or time.monotonic() >= deadline:
+                break
+            time.sleep(DRAIN_POLL)
+        if unsent:
+            self.log.warning(f"⚠️ Stopping with {unsent} frames not yet sent")
+            return unsent
+
+        # Then end each stream after its last frame and let the clients hang up.
+        # Closing first would reset connections with client frames still unread,
+        # and a reset throws away whatever the kernel has not sent yet.
+        self.stopping = True
+        for session in self.sessions.snapshot():
+            self.end_stream(session)
+        while (any(session.detached_at is None for session in self.sessions.snapshot())
+               and time.monotonic() < deadline):
+            time.sleep(DRAIN_POLL)
+        return 0
+
+    def unsent(self, session):
+        queue = session.send_queue
+        return queue.unsent() if queue else 0 # None while detached: nobody to send to
+
+    def end_stream(self, session):
+        with session.lock:
+            queue, session.send_queue = session.send_queue, None # Later frames are only kept for replay
+        if queue is None:
+            return
+        queue.close() # Empty by now, its writer just exits
+        try:
+            session.conn.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+
+# ---------------- ENGINE SELECTION ----------------
+def create_server(engine="thread", workers=1, **kwargs):
+    """
+    Builds a server for the chosen engine: one thread per client, or a single
+    asyncio loop. With workers > 1, that many processes of it share the port.
+    """
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown server engine '{engine}', expected one of {', '.join(ENGINES)}")
+    if workers > 1:
+        if kwargs.get("federation"):
+            raise ValueError("Federation needs a single-process server (workers=1)")
+        from sharding import ShardedChatServer # Only pulled in when asked for
+        return ShardedChatServer(engine, workers, **kwargs)
+    if engine == "async":
+        from async_server_core import AsyncChatServer
+        return AsyncChatServer(**kwargs)
+    return ChatServer(**kwargs)
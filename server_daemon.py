@@ -0,0 +1,234 @@
+"""
+Headless chat server: the same server as server_gui.py, configured from a
+JSON file, CHAT_* environment variables and command line flags (later ones
+win), logging to stdout and stopping gracefully on SIGTERM or Ctrl+C.
+
+    python server_daemon.py --config server.json
+    CHAT_PASSWORD=secret CHAT_ENGINE=async python server_daemon.py --port 6000
+
+The config file holds the same settings by name, e.g.
+{"port": 5555, "engine": "async", "workers": 2, "log_file": "chat_server.log"},
+plus an optional "federation" object: {"node", "secret", "listen": [host, port],
+"peers": [[host, port], ...]}. Nothing here imports Tk; federation and the
+sharded server are only imported when configured. SIGHUP reads the file again
+and applies its rate limits (limit_*) without a restart.
+"""
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+from server_core import create_server, ENGINES
+from server_log import LEVELS, LEVEL_NAMES
+from fanout import POLICIES, DRAIN_TIMEOUT
+from rate_limit import RateLimits
+
+
+ENV_PREFIX = "CHAT_"
+CSV = "csv"                 # A list: comma separated in the environment and on the command line
+
+LIMIT_PREFIX = "limit_"     # limit_<name> settings make up the server's RateLimits
+
+# (name, type, help). Every name is a create_server() keyword except drain_timeout
+# and the limits; a setting given nowhere keeps the engine's own default.
+SETTINGS = (
+    ("host", str, "Address to listen on"),
+    ("port", int, "TCP port for clients"),
+    ("password", str, "Server password (prefer the environment or the config file: flags show up in ps)"),
+    ("engine", str, f"Server engine: {', '.join(ENGINES)}"),
+    ("workers", int, "Processes sharing the port, see sharding.py"),
+    ("backlog", int, "Connections the kernel queues before they are accepted"),
+    ("send_queue_depth", int, "Frames queued per client before the slow client policy applies"),
+    ("slow_client_policy", str, f"When a client's queue is full: {', '.join(POLICIES)}"),
+    ("resume_grace", float, "Seconds a dropped session waits for its client to resume"),
+    ("presence_window", float, "Seconds of joins and leaves announced together"),
+    ("history_dir", str, "Message history directory, empty turns history off"),
+    ("codecs", CSV, "Frame codecs clients may pick"),
+    ("compression", CSV, "Compression modes clients may pick, empty turns compression off"),
+    ("compression_threshold", int, "Smallest payload worth compressing, in bytes"),
+    ("metrics_port", int, "Prometheus endpoint on localhost"),
+    ("metrics_interval", float, "Seconds between metrics log lines, 0 turns them off"),
+    ("log_file", str, "Rotating log file, on top of stdout"),
+    ("log_level", str, f"Log verbosity: {', '.join(LEVELS)}"),
+    ("drain_timeout", float, f"Seconds a stop waits for queued messages to go out (default {DRAIN_TIMEOUT:g})"),
+    ("limit_conn_frames", float, "Frames per second a connection may send before its reads are slowed down"),
+    ("limit_conn_bytes", float, "Bytes per second a connection may send before its reads are slowed down"),
+    ("limit_user_messages", float, "Chat messages per second a user may send before they are dropped"),
+    ("limit_user_bytes", float, "Bytes of chat per second a user may send before messages are dropped"),
+    ("limit_fan_out", float, "Deliveries per second for all users' messages together"),
+)
+
+
+class ConfigError(ValueError):
+    """Raised for a config file, variable or flag that cannot be used."""
+
+
+# ---------------- CONFIGURATION ----------------
+def convert(name, kind, value):
+    """A setting from text (environment, flags) or JSON, as the server expects it."""
+    try:
+        if kind == CSV:
+            if isinstance(value, str):
+                return tuple(item.strip() for item in value.split(",") if item.strip())
+            return tuple(value)
+        if kind is str:
+            return value if isinstance(value, str) else str(value)
+        if isinstance(value, bool):
+            raise ValueError("not a number")
+        return kind(value)
+    except (TypeError, ValueError) as e:
+        raise ConfigError(f"Bad value for {name}: {value!r} ({e})")
+
+
+def load_file(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            config = json.load(f)
+    except OSError as e:
+        raise ConfigError(f"Cannot read config file {path}: {e}")
+    except ValueError as e:
+        raise ConfigError(f"Config file {path} is not valid JSON: {e}")
+    if not isinstance(config, dict):
+        raise ConfigError(f"Config file {path} must hold a JSON object")
+    known = {name for name, _, _ in SETTINGS} | {"federation"}
+    unknown = sorted(set(config) - known)
+    if unknown:
+        raise ConfigError(f"Unknown setting(s) in {path}: {', '.join(unknown)}")
+    return config
+
+
+def load_settings(args, environ=os.environ):
+    """Config file, then CHAT_<NAME> variables, then flags; returns (settings, federation config or None)."""
+    config = load_file(args.config) if args.config else {}
+    settings = {}
+    for name, kind, _ in SETTINGS:
+        value = getattr(args, name)
+        if value is None:
+            value = environ.get(ENV_PREFIX + name.upper())
+        if value is None:
+            value = config.get(name)
+        if value is not None:
+            settings[name] = convert(name, kind, value)
+
+    if settings.get("engine", ENGINES[0]) not in ENGINES:
+        raise ConfigError(f"Unknown engine '{settings['engine']}', expected one of {', '.join(ENGINES)}")
+    if settings.get("slow_client_policy", POLICIES[0]) not in POLICIES:
+        raise ConfigError(f"Unknown slow client policy '{settings['slow_client_policy']}'")
+    if settings.get("log_level", "info").lower() not in LEVELS:
+        raise ConfigError(f"Unknown log level '{settings['log_level']}', expected one of {', '.join(LEVELS)}")
+    if "history_dir" in settings and not settings["history_dir"]:
+        settings["history_dir"] = None
+    if not settings.get("password"):
+        raise ConfigError(f"No password set: use {ENV_PREFIX}PASSWORD, the config file or --password")
+    return settings, config.get("federation")
+
+
+def build_federation(config):
+    from federation import Federation # Only pulled in when configured
+    try:
+        return Federation(config["node"], config["secret"],
+                          listen=tuple(config["listen"]) if config.get("listen") else None,
+                          peers=[tuple(peer) for peer in config.get("peers", ())])
+    except (KeyError, TypeError) as e:
+        raise ConfigError(f"Federation needs at least a node and a secret: {e}")
+
+
+def limit_rates(settings):
+    """Every rate limit: the configured ones, the defaults for the rest (0 turns one off)."""
+    rates = RateLimits().rates()
+    rates.update((name[len(LIMIT_PREFIX):], value) for name, value in settings.items() if name.startswith(LIMIT_PREFIX))
+    for name, rate in rates.items():
+        if rate < 0:
+            raise ConfigError(f"Bad value for {LIMIT_PREFIX}{name}: {rate:g} (0 turns it off)")
+    return rates
+
+
+def build_server(settings, federation=None):
+    kwargs = {name: value for name, value in settings.items() if not name.startswith(LIMIT_PREFIX)}
+    kwargs.pop("drain_timeout", None)
+    engine = kwargs.pop("engine", ENGINES[0])
+    workers = kwargs.pop("workers", 1)
+    kwargs["limits"] = RateLimits(**limit_rates(settings))
+    if federation:
+        kwargs["federation"] = build_federation(federation)
+    return create_server(engine, workers, **kwargs)
+
+
+# SIGHUP: the config file is read again and its rate limits applied (variables and flags still win)
+def reload_limits(args, server):
+    try:
+        settings, _ = load_settings(args)
+        server.set_limits(**limit_rates(settings))
+    except ValueError as e:
+        server.log.warning(f"⚠️ Config not reloaded: {e}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--config", default=os.environ.get(ENV_PREFIX + "CONFIG"),
+                        help=f"JSON config file (or {ENV_PREFIX}CONFIG)")
+    for name, kind, help_text in SETTINGS:
+        # Everything is parsed as text here so flags, variables and the file share convert()
+        parser.add_argument("--" + name.replace("_", "-"), dest=name, metavar=name.upper(),
+                            help=f"{help_text} [{ENV_PREFIX}{name.upper()}]")
+    return parser.parse_args(argv)
+
+
+# ---------------- RUN ----------------
+class Reload(Exception):
+    """Raised on the main thread by SIGHUP."""
+
+
+def interrupt(signum, frame):
+    raise KeyboardInterrupt # Unwinds the main thread's wait
+
+
+def reload(signum, frame):
+    raise Reload
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        settings, federation = load_settings(args)
+        server = build_server(settings, federation)
+    except ValueError as e: # ConfigError, or one the server raised for a bad setting
+        print(f"❌ {e}", file=sys.stderr)
+        return 2
+
+    # Lines that pass the log level, on stdout for the terminal or the service manager's journal
+    server.log.add_sink(lambda level, text: print(f"{LEVEL_NAMES.get(level, level):<7} {text}", flush=True))
+    try:
+        server.start()
+    except (OSError, RuntimeError) as e:
+        server.log.close()
+        print(f"❌ Could not start the server: {e}", file=sys.stderr)
+        return 1
+
+    # SIGTERM (a service manager stopping us) is handled like Ctrl+C, which a
+    # shell may have left ignored for a background job
+    signal.signal(signal.SIGTERM, interrupt)
+    signal.signal(signal.SIGINT, interrupt)
+    if hasattr(signal, "SIGHUP"): # Not on Windows
+        signal.signal(signal.SIGHUP, reload)
+    try:
+        while True:
+            try:
+                time.sleep(3600)
+            except Reload:
+                signal.signal(signal.SIGHUP, signal.SIG_IGN) # One reload at a time
+                reload_limits(args, server)
+                signal.signal(signal.SIGHUP, reload)
+    except KeyboardInterrupt:
+        pass
+    # A second signal while draining quits at once
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    server.log.info("🛑 Stopping, sending what is still queued...")
+    server.stop(settings.get("drain_timeout", DRAIN_TIMEOUT))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
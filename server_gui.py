@@ -1,6 +1,15 @@
+import os
 import tkinter as tk
+from datetime import datetime
 from tkinter import scrolledtext, messagebox
-from server_core import ChatServer
+from server_core import create_server, ENGINES
+from server_log import LEVELS
+
+
+LOG_FILE = "chat_server.log"
+LOG_REFRESH_MS = 250        # The log view samples the server log this often
+LOG_VIEW_LINES = 1000       # Lines kept in the log box, older ones are trimmed
+LOG_BATCH = 200             # Most lines added per refresh; the rest are counted as skipped
 
 
 class ChatServerGUI:
@@ -11,12 +20,32 @@ class ChatServerGUI:
         self.master.configure(bg="#121212")
 
         self.server = None
+        self.log_seen = 0           # Server log lines the view has accounted for
 
         # ---------------- UI SETUP ----------------
         tk.Label(master, text="Server Password:", bg="#121212", fg="white").pack(pady=(10, 0))
         self.password_entry = tk.Entry(master, show="*", width=30)
         self.password_entry.pack(pady=(0, 10))
 
+        tk.Label(master, text="Engine:", bg="#121212", fg="white").pack()
+        self.engine_var = tk.StringVar(value=ENGINES[0])
+        engine_menu = tk.OptionMenu(master, self.engine_var, *ENGINES)
+        engine_menu.config(width=10)
+        engine_menu.pack(pady=(0, 10))
+
+        # More than one worker runs the engine in that many processes, see sharding.py
+        tk.Label(master, text="Worker processes:", bg="#121212", fg="white").pack()
+        self.workers_var = tk.IntVar(value=1)
+        tk.Spinbox(master, from_=1, to=max(1, os.cpu_count() or 1), textvariable=self.workers_var,
+                   width=5, state="readonly").pack(pady=(0, 10))
+
+        # "info" leaves chat lines out of the log; they are still delivered
+        tk.Label(master, text="Log level:", bg="#121212", fg="white").pack()
+        self.log_level_var = tk.StringVar(value="message")
+        level_menu = tk.OptionMenu(master, self.log_level_var, *LEVELS)
+        level_menu.config(width=10)
+        level_menu.pack(pady=(0, 10))
+
         self.start_btn = tk.Button(master, text="Start Server", bg="#00C853", fg="white",
                                    font=('Segoe UI', 10, 'bold'), command=self.start_server)
         self.start_btn.pack(pady=10)
@@ -37,16 +66,37 @@ class ChatServerGUI:
             messagebox.showwarning("Missing Field", "Please enter a password!")
             return
 
-        self.server = ChatServer(password=password)
-        self.server.start(self.log_message)
+        self.server = create_server(self.engine_var.get(), workers=self.workers_var.get(), password=password,
+                                    log_file=LOG_FILE, log_level=self.log_level_var.get())
+        try:
+            self.server.start()
+        except (OSError, RuntimeError) as e:
+            self.server = None
+            messagebox.showerror("Server Error", f"Could not start the server: {e}")
+            return
         self.start_btn.config(state="disabled")
+        self.log_seen = 0
+        self.master.after(LOG_REFRESH_MS, self.refresh_log, self.server)
 
-    # ---------------- LOG MESSAGES ----------------
-    def log_message(self, msg):
-        self.log_box.config(state="normal")
-        self.log_box.insert("end", msg + "\n")
-        self.log_box.config(state="disabled")
-        self.log_box.see("end")
+    # ---------------- LOG VIEW ----------------
+    # Runs on the Tk thread only. Server threads never touch the widget: each
+    # refresh takes the newest lines from the server log in one insert, and a
+    # flood shows up as a count of skipped lines (they are all in LOG_FILE).
+    def refresh_log(self, server):
+        if server is not self.server:
+            return
+        records, skipped, self.log_seen = server.log.recent_since(self.log_seen, LOG_BATCH)
+        if records or skipped:
+            lines = [f"… {skipped} lines not shown, see {LOG_FILE}"] if skipped else []
+            lines.extend(f"{datetime.fromtimestamp(ts):%H:%M:%S} {text}" for ts, _, text in records)
+            self.log_box.config(state="normal")
+            self.log_box.insert("end", "\n".join(lines) + "\n")
+            excess = int(self.log_box.index("end-1c").split(".")[0]) - 1 - LOG_VIEW_LINES
+            if excess > 0:
+                self.log_box.delete("1.0", f"{excess + 1}.0")
+            self.log_box.config(state="disabled")
+            self.log_box.see("end")
+        self.master.after(LOG_REFRESH_MS, self.refresh_log, server)
 
     # ---------------- STOP SERVER ----------------
     def stop_server(self):
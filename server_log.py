@@ -0,0 +1,199 @@
+import os
+import time
+import threading
+from collections import deque
+from datetime import datetime
+
+
+# Verbosity, lowest first. A server logs what is at or above its level:
+# "info" drops the per-message lines and keeps connections, rooms and errors.
+DEBUG = 10
+MESSAGE = 15               # Every chat line, private and room message
+INFO = 20                  # Connections, rooms, transfers, start and stop
+WARNING = 30               # Errors on one connection, slow clients, failed links
+ERROR = 40
+LEVELS = {"debug": DEBUG, "message": MESSAGE, "info": INFO, "warning": WARNING, "error": ERROR}
+LEVEL_NAMES = {value: name.upper() for name, value in LEVELS.items()}
+
+FLUSH_INTERVAL = 0.1       # The writer wakes this often and handles everything queued since
+MAX_PENDING = 100000       # Records waiting for the writer before new ones are dropped (and counted)
+MAX_BYTES = 10 * 1024 * 1024 # Rotate the log file past this size
+BACKUPS = 5                # Rotated files kept: server.log.1 .. server.log.5
+RECENT = 1000              # Lines kept for the GUI view
+
+
+def parse_level(level):
+    """A level name ("info") or number; raises ValueError for anything else."""
+    if isinstance(level, int):
+        return level
+    try:
+        return LEVELS[str(level).lower()]
+    except KeyError:
+        raise ValueError(f"Unknown log level '{level}', expected one of {', '.join(LEVELS)}")
+
+
+class ServerLog:
+    """
+    Logging off the hot path. info(), message() and the other levels only
+    append a (time, level, template, args) record to a deque, or do nothing
+    below the configured level. A writer thread wakes every FLUSH_INTERVAL,
+    formats the batch, writes it to a rotating file in one write() and hands
+    each line to the sinks (the on_log callback, a shard's bus link).
+    Templates are only formatted there: message("{}: {}", sender, body)
+    costs the handler no string work.
+
+    The last RECENT lines stay in memory for views that sample them at
+    their own pace, see recent_since().
+    """
+    def __init__(self, path=None, level=MESSAGE, max_bytes=MAX_BYTES, backups=BACKUPS,
+                 flush_interval=FLUSH_INTERVAL, max_pending=MAX_PENDING, recent=RECENT):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        self.pending = deque()   # Appended by any thread, emptied by the writer only
+        self.sinks = []          # sink(level, text), called on the writer thread
+        self.recent = deque(maxlen=recent)
+        self.recent_lock = threading.Lock()
+        self.written = 0         # Lines handled so far; recent_since() counts against it
+        self.dropped = 0         # Records refused while the writer was MAX_PENDING behind
+        self.flush_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.file = None
+        self.file_size = 0
+        self.set_level(level)
+
+    # ---------------- HOT PATH ----------------
+    # debug() .. error() are rebound by set_level(): a level below the threshold
+    # is a no-op function, the others append straight to the queue. Either way a
+    # call is one Python function call, with no level test inside.
+    def set_level(self, level):
+        self.level = parse_level(level)
+        for name, value in LEVELS.items():
+            setattr(self, name, self._enqueuer(value) if value >= self.level else _ignore)
+
+    def _enqueuer(self, level):
+        pending, now, max_pending = self.pending, time.time, self.max_pending
+        def log(text, *args):
+            if len(pending) < max_pending:
+                pending.append((now(), level, text, args))
+            else:
+                self.dropped += 1
+        return log
+
+    def log(self, level, text, *args):
+        """For a level chosen at run time (relayed shard lines); the named methods are cheaper."""
+        if level < self.level:
+            return
+        if len(self.pending) < self.max_pending:
+            self.pending.append((time.time(), level, text, args))
+        else:
+            self.dropped += 1
+
+    # ---------------- LIFECYCLE ----------------
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def start(self):
+        if self.thread is not None:
+            return
+        if self.path:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.file = open(self.path, "a", encoding="utf-8")
+            self.file_size = self.file.tell()
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        """Writes out everything queued so far, then stops the writer."""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    # ---------------- WRITER ----------------
+    def _writer(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            pending = self.pending
+            batch = [pending.popleft() for _ in range(len(pending))]
+            if not batch:
+                return
+            records = []
+            for ts, level, text, args in batch:
+                if args:
+                    try:
+                        text = text.format(*args)
+                    except (IndexError, KeyError, ValueError) as e:
+                        text = f"{text} {args!r} (bad log template: {e})"
+                records.append((ts, level, text))
+
+            if self.file:
+                self._write(records)
+            with self.recent_lock:
+                self.recent.extend(records)
+                self.written += len(records)
+            for sink in self.sinks:
+                for _, level, text in records:
+                    try:
+                        sink(level, text)
+                    except Exception:
+                        pass # A broken view must not stop the log
+
+    def _write(self, records):
+        data = "".join(f"{format_time(ts)} {LEVEL_NAMES.get(level, level):<7} {text}\n" for ts, level, text in records)
+        try:
+            self.file.write(data)
+            self.file.flush()
+        except OSError:
+            return # Disk full or gone: the sinks and the view still get the lines
+        self.file_size += len(data.encode("utf-8"))
+        if self.file_size >= self.max_bytes:
+            self._rotate()
+
+    # server.log -> server.log.1 -> ... -> server.log.<backups>, the oldest is dropped
+    def _rotate(self):
+        self.file.close()
+        for n in range(self.backups - 1, 0, -1):
+            older = f"{self.path}.{n}"
+            if os.path.exists(older):
+                os.replace(older, f"{self.path}.{n + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        self.file = open(self.path, "w", encoding="utf-8")
+        self.file_size = 0
+
+    # ---------------- SAMPLED VIEW ----------------
+    def recent_since(self, seen, limit=None):
+        """
+        What a view that has shown `seen` lines so far should add:
+        ([(ts, level, text)], skipped, new seen). At most `limit` of the newest
+        lines are returned; skipped counts the ones it will never see.
+        """
+        with self.recent_lock:
+            written = self.written
+            new = written - seen
+            available = min(new, len(self.recent), limit if limit is not None else new)
+            records = list(self.recent)[len(self.recent) - available:] if available else []
+        return records, new - available, written
+
+
+def _ignore(text, *args):
+    pass
+
+
+def format_time(ts):
+    return datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
@@ -0,0 +1,125 @@
+import hmac
+import base64
+import struct
+import hashlib
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+
+KEY_INFO = b"secure-lan-chat session keys v1"
+KEY_SIZE = 32
+TAG_SIZE = 16                   # AEAD tag, the only per-frame overhead of the binary codecs
+NONCE = struct.Struct("!4xQ")   # 96-bit nonce: 4 zero bytes + a 64-bit frame counter
+
+
+class CryptoError(Exception):
+    """Raised when a frame fails authentication or a key cannot be used."""
+
+
+# ---------------- CODECS ----------------
+# A codec turns a plaintext payload into the bytes of one frame and back.
+# Both ends pick one in the handshake; everything else only ever calls
+# codec.encrypt()/codec.decrypt(). Codecs are not thread safe: each
+# direction must have a single user at a time.
+class AEADCodec:
+    """
+    Raw binary AEAD frames with one key per direction. Nonces are frame
+    counters that both ends advance in step (TCP keeps frames in order), so
+    nothing but the 16-byte tag is added to a frame and a replayed or
+    reordered frame fails to decrypt.
+    """
+    def __init__(self, name, aead, send_key, recv_key):
+        self.name = name
+        self.sender = aead(send_key)
+        self.receiver = aead(recv_key)
+        self.sent = 0
+        self.received = 0
+
+    def encrypt(self, data):
+        nonce = NONCE.pack(self.sent)
+        self.sent += 1
+        return self.sender.encrypt(nonce, data, None)
+
+    def decrypt(self, data):
+        nonce = NONCE.pack(self.received)
+        try:
+            plain = self.receiver.decrypt(nonce, data, None)
+        except InvalidTag:
+            raise CryptoError("Frame failed authentication")
+        self.received += 1
+        return plain
+
+
+class FernetCodec:
+    """
+    The original format (base64 token with a timestamp, IV and HMAC), now
+    with per-connection keys. Kept for comparison and for peers that ask for it.
+    """
+    def __init__(self, name, send_key, recv_key):
+        self.name = name
+        self.sender = Fernet(base64.urlsafe_b64encode(send_key))
+        self.receiver = Fernet(base64.urlsafe_b64encode(recv_key))
+
+    def encrypt(self, data):
+        return self.sender.encrypt(data)
+
+    def decrypt(self, data):
+        try:
+            return self.receiver.decrypt(data)
+        except InvalidToken:
+            raise CryptoError("Frame failed authentication")
+
+
+# Name -> factory(send_key, recv_key). AES-GCM wins on CPUs with AES
+# instructions, ChaCha20-Poly1305 everywhere else (see benchmarks/).
+CODECS = {
+    "aes-256-gcm": lambda send, recv: AEADCodec("aes-256-gcm", AESGCM, send, recv),
+    "chacha20-poly1305": lambda send, recv: AEADCodec("chacha20-poly1305", ChaCha20Poly1305, send, recv),
+    "fernet": lambda send, recv: FernetCodec("fernet", send, recv),
+}
+DEFAULT_CODECS = ("aes-256-gcm", "chacha20-poly1305")   # What a client offers, best first
+
+
+def choose_codec(offered, allowed=tuple(CODECS)):
+    """First codec in the client's list that we allow, or None."""
+    if isinstance(offered, list):
+        for name in offered:
+            if isinstance(name, str) and name in allowed and name in CODECS:
+                return name
+    return None
+
+
+# ---------------- KEY EXCHANGE ----------------
+class KeyExchange:
+    """
+    One side of an ephemeral X25519 agreement. Both ends feed the shared
+    secret through HKDF salted with an HMAC of the handshake nonce keyed by
+    the chat password, so only peers that know the password get the same keys.
+    """
+    def __init__(self):
+        self.private = X25519PrivateKey.generate()
+
+    def public_key(self):
+        raw = self.private.public_key().public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+        return base64.b64encode(raw).decode('ascii')
+
+    def derive(self, peer_public_key, password, nonce, initiator, codec=DEFAULT_CODECS[0]):
+        """Returns the codec for this end; `initiator` is True on the client."""
+        if not isinstance(codec, str) or codec not in CODECS:
+            raise CryptoError(f"Unknown codec '{codec}'")
+        try:
+            peer = X25519PublicKey.from_public_bytes(base64.b64decode(peer_public_key))
+            shared = self.private.exchange(peer)
+        except (ValueError, TypeError) as e:
+            raise CryptoError(f"Unusable public key: {e}")
+        salt = hmac.new(password.encode('utf-8'), nonce.encode('utf-8'), hashlib.sha256).digest()
+        info = KEY_INFO + codec.encode('ascii') # Keys are bound to the negotiated codec
+        keys = HKDF(algorithm=hashes.SHA256(), length=2 * KEY_SIZE, salt=salt, info=info).derive(shared)
+        client_key, server_key = keys[:KEY_SIZE], keys[KEY_SIZE:]
+        if initiator:
+            return CODECS[codec](client_key, server_key)
+        return CODECS[codec](server_key, client_key)
@@ -0,0 +1,175 @@
+import threading
+from collections import deque
+
+
+# Handshake stages of a connection
+STAGE_HELLO = "hello"       # Waiting for HELLO (password proof, username, capabilities)
+STAGE_CHAT = "chat"
+
+REPLAY_FRAMES = 512   # Frames kept per session for replay after a reconnect
+
+
+class Session:
+    """
+    One logged-in user, from the first byte of the handshake until it is
+    removed. A session outlives a dropped connection for a grace period and
+    can be resumed on a new one with its token.
+    """
+    remote = False                   # See RemoteUser
+
+    def __init__(self, conn, addr, replay_frames=REPLAY_FRAMES):
+        self.conn = conn
+        self.addr = addr
+        self.stage = STAGE_HELLO
+        self.username = None
+        self.token = None
+        self.caps = ()               # Capabilities granted in the handshake
+        self.codec = None            # session_crypto codec (keys) of the current connection
+        self.compressor = None       # FrameCompressor of the current connection, None if not negotiated
+        self.send_queue = None       # fanout.SendQueue while a connection is attached
+        self.logged_out = False      # Said BYE: no point holding the session for a resume
+        self.detached_at = None      # Set while waiting for the client to come back
+        self.throttle = None         # rate_limit.Throttle on the user's messages, set at login
+        self.shed = 0                # Messages dropped by the rate limits since the user was last told
+        self.warned_at = 0.0         # When that was
+
+        # Every numbered payload sent to this user (plaintext, shared with the other
+        # recipients), so a resume can replay what was missed under the new keys
+        self.lock = threading.Lock()
+        self.replay = deque(maxlen=replay_frames)
+        self.evicted_through = 0     # Highest seq pushed out of the replay buffer
+
+    def deliver(self, seq, payload):
+        """Records a payload for replay and queues it if connected. False means disconnect."""
+        with self.lock:
+            if len(self.replay) == self.replay.maxlen:
+                self.evicted_through = self.replay[0][0]
+            self.replay.append((seq, payload))
+            if self.send_queue is None:
+                return True # Detached: the replay buffer is all we can do
+            return self.send_queue.put(payload)
+
+    def send_direct(self, payload, bulk=False):
+        """Queues a payload that is neither numbered nor kept for replay (file chunks
+        and their acks). False if it could not be queued, e.g. while detached."""
+        with self.lock:
+            if self.send_queue is None:
+                return False
+            return self.send_queue.put_bulk(payload) if bulk else self.send_queue.put(payload)
+
+    def acknowledge(self, seq):
+        """The client has everything up to `seq`, so it never needs it replayed."""
+        with self.lock:
+            while self.replay and self.replay[0][0] <= seq:
+                self.replay.popleft()
+
+    def missed_since(self, seq):
+        """Payloads after `seq`, or None if some of them were already evicted. Call with lock held."""
+        if seq < self.evicted_through:
+            return None
+        return [payload for payload_seq, payload in self.replay if payload_seq > seq]
+
+
+class RemoteUser:
+    """
+    Stands in for a user logged in on another shard (or federation node), as
+    a room member and in the roster. Their own server delivers their frames,
+    so fan-out skips them.
+    """
+    remote = True
+
+    def __init__(self, username):
+        self.username = username
+
+    def deliver(self, seq, payload):
+        return True
+
+    def send_direct(self, payload, bulk=False):
+        return False
+
+
+class SessionRegistry:
+    """
+    Logged-in sessions indexed by connection, username and address.
+
+    Writers (add/remove) take a lock and publish a fresh immutable snapshot,
+    readers (broadcasts) just grab the current snapshot without locking or
+    copying. Churn costs O(N) per change, every fan-out is copy free.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_conn = {}
+        self.by_username = {}
+        self.by_addr = {}
+        self._snapshot = ()
+        self._usernames = ()
+
+    # ---------------- WRITERS ----------------
+    def add(self, session):
+        """Registers a session. Returns False if its username is already taken."""
+        with self.lock:
+            if session.username in self.by_username:
+                return False
+            self.by_conn[session.conn] = session
+            self.by_username[session.username] = session
+            self.by_addr[session.addr] = session
+            self._publish()
+        return True
+
+    def remove(self, session):
+        """
+        Unregisters a session. Only the first caller gets True back, so the
+        leave event is emitted exactly once.
+        """
+        with self.lock:
+            if self.by_username.get(session.username) is not session:
+                return False
+            del self.by_username[session.username]
+            self._unindex_connection(session, session.conn, session.addr)
+            self._publish()
+        return True
+
+    def detach(self, session):
+        """Forgets the session's connection but keeps the user online, awaiting a resume."""
+        with self.lock:
+            self._unindex_connection(session, session.conn, session.addr)
+
+    def reattach(self, session, old_conn, old_addr):
+        """Indexes a resumed session under its new connection and address."""
+        with self.lock:
+            self._unindex_connection(session, old_conn, old_addr)
+            self.by_conn[session.conn] = session
+            self.by_addr[session.addr] = session
+
+    def _unindex_connection(self, session, conn, addr):
+        if self.by_conn.get(conn) is session:
+            del self.by_conn[conn]
+        if self.by_addr.get(addr) is session:
+            del self.by_addr[addr]
+
+    def _publish(self):
+        self._snapshot = tuple(self.by_username.values())
+        self._usernames = tuple(self.by_username)
+
+    # ---------------- READERS ----------------
+    def get(self, conn):
+        return self.by_conn.get(conn)
+
+    def find(self, username):
+        return self.by_username.get(username)
+
+    def find_by_addr(self, addr):
+        return self.by_addr.get(addr)
+
+    def snapshot(self):
+        """Immutable tuple of every logged-in session (connected or awaiting a resume), safe to iterate while others join or leave."""
+        return self._snapshot
+
+    def usernames(self):
+        return self._usernames
+
+    def __len__(self):
+        return len(self._snapshot)
+
+    def __contains__(self, username):
+        return username in self.by_username
@@ -0,0 +1,313 @@
+import os
+import json
+import base64
+import shutil
+import socket
+import signal
+import tempfile
+import threading
+import time
+import multiprocessing
+import zlib
+from collections import deque
+from fanout import DRAIN_TIMEOUT
+from framing import FrameBuffer, FrameReader, FrameError, pack_frame, RECV_SIZE
+from handshake import HandshakeError, parse_message
+from server_log import ServerLog, MESSAGE, INFO, WARNING
+from rate_limit import check_rates
+
+
+HELLO_TIMEOUT = 10.0        # Seconds a new connection gets to send its HELLO before we hang up
+HELLO_MAX = 64 * 1024       # A HELLO is a few hundred bytes, refuse anything near a real frame
+START_TIMEOUT = 30.0        # Seconds for every worker process to come up and check in
+STOP_TIMEOUT = 5.0          # Seconds a worker gets to shut down after draining, before it is killed
+MAX_FDS = 64                # Descriptors taken per recvmsg() on the worker side
+
+# Bus events are JSON objects {"op": ..., ...} in length-prefixed frames. The
+# hub forwards an event with a "target" to the shard owning that user and
+# everything else to every other shard.
+#   worker -> hub:    hello, log, joined, left, broadcast, private, room_join, room_leave, room_msg
+#   hub -> worker:    conn (with the client socket attached), limits, stop, and the relayed events
+
+
+def shard_for(username, workers):
+    """The shard a user always lands on. crc32, not hash(), so every process agrees."""
+    return zlib.crc32(username.encode('utf-8')) % workers
+
+
+# ---------------- WORKER SIDE ----------------
+class ShardLink:
+    """
+    A worker's connection to the hub: publishes this shard's events and feeds
+    the ChatServer the client connections and events of the other shards.
+    """
+    def __init__(self, path, shard, workers):
+        self.shard = shard
+        self.workers = workers
+        self.server = None
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.drain_timeout = DRAIN_TIMEOUT # The hub's stop() sends its own
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.publish({"op": "hello", "shard": shard})
+
+    def start(self, server):
+        self.server = server
+        threading.Thread(target=self.read_events, daemon=True).start()
+
+    def publish(self, event):
+        frame = pack_frame(json.dumps(event, ensure_ascii=False))
+        with self.lock:
+            try:
+                self.sock.sendall(frame)
+            except OSError:
+                self.closed.set() # Hub is gone, the worker shuts down
+
+    # A sink of the shard's ServerLog: lines go to the hub's log, which files them
+    def log(self, level, text):
+        self.publish({"op": "log", "level": level, "text": text})
+
+    def read_events(self):
+        buffer, fds = FrameBuffer(), deque()
+        try:
+            while True:
+                # A handed over socket arrives with the bytes of its "conn" event, never after them
+                data, received, _, _ = socket.recv_fds(self.sock, RECV_SIZE, MAX_FDS)
+                fds.extend(received)
+                if not data:
+                    return
+                for frame in buffer.feed(data):
+                    event = json.loads(frame)
+                    op = event.get("op")
+                    if op == "conn":
+                        conn = socket.socket(fileno=fds.popleft())
+                        self.server.adopt_connection(conn, tuple(event["addr"]), base64.b64decode(event["data"]))
+                    elif op == "limits":
+                        self.server.set_limits(**event["rates"])
+                    elif op == "stop":
+                        self.drain_timeout = event.get("drain", self.drain_timeout)
+                        return
+                    else:
+                        self.server.on_bus_event(event)
+        except (OSError, ValueError, FrameError) as e:
+            if not self.closed.is_set():
+                self.log(WARNING, f"⚠️ Bus error on shard {self.shard}: {e}")
+        finally:
+            for fd in fds:
+                os.close(fd)
+            self.closed.set()
+
+    def close(self):
+        self.closed.set()
+        self.sock.close()
+
+
+def run_worker(shard, workers, path, engine, kwargs):
+    """Entry point of a worker process: one ChatServer fed by the hub until told to stop."""
+    from server_core import create_server # Imported in the child, after spawn
+    link = ShardLink(path, shard, workers)
+    server = create_server(engine, bus=link, **kwargs)
+    server.log.add_sink(link.log)
+    server.start()
+    # A service manager may signal every process at once: drain like the hub would ask us to
+    signal.signal(signal.SIGTERM, lambda signum, frame: link.closed.set())
+    try:
+        link.closed.wait()
+    except KeyboardInterrupt:
+        pass # Ctrl+C reaches the whole process group, the hub stops us anyway
+    server.stop(link.drain_timeout)
+    link.close()
+
+
+# ---------------- HUB SIDE ----------------
+class WorkerLink:
+    def __init__(self, shard, conn, reader, process):
+        self.shard = shard
+        self.conn = conn
+        self.reader = reader
+        self.process = process
+        self.lock = threading.Lock()
+
+    def send(self, payload, fd=None):
+        frame = pack_frame(payload)
+        with self.lock:
+            try:
+                if fd is None:
+                    self.conn.sendall(frame)
+                else:
+                    sent = socket.send_fds(self.conn, [frame], [fd])
+                    if sent < len(frame):
+                        self.conn.sendall(frame[sent:])
+            except OSError:
+                pass # Worker died, its relay thread reports it
+
+
+class ShardedChatServer:
+    """
+    Same protocol and the same start()/stop() as ChatServer, spread over
+    `workers` processes. This process owns the listening socket: it reads
+    each connection's HELLO, hands the socket to the shard that owns the
+    username (so a reconnect or resume lands where the session lives) and
+    relays events between shards over Unix sockets. Every shard keeps the
+    other shards' users in its roster and rooms, so broadcasts, private
+    messages, presence and room traffic look the same on every shard.
+    """
+    def __init__(self, engine="thread", workers=2, host='0.0.0.0', port=5555, password='admin123',
+                 backlog=1024, history_dir="chat_history", log_file=None, log_level=MESSAGE, **kwargs):
+        self.engine = engine
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.history_dir = history_dir
+        # Shards filter at the same level; their lines come here and only the hub writes the file
+        self.kwargs = dict(kwargs, host=host, port=port, password=password, log_level=log_level)
+        self.log = ServerLog(log_file, log_level)
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.links = []
+        self.workdir = None
+        self.running = True
+
+    # ---------------- START SERVER ----------------
+    def start(self, on_log=None):
+        if on_log:
+            self.log.add_sink(lambda level, text: on_log(text))
+        self.log.start()
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind((self.host, self.port))
+        self.server_socket.listen(self.backlog)
+
+        self.workdir = tempfile.mkdtemp(prefix="chat-shards-")
+        path = os.path.join(self.workdir, "bus.sock")
+        bus = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        bus.bind(path)
+        bus.listen(self.workers)
+        bus.settimeout(START_TIMEOUT)
+        # Spawned, not forked: the parent may be a Tk app with threads running
+        context = multiprocessing.get_context("spawn")
+        processes = []
+        for shard in range(self.workers):
+            process = context.Process(target=run_worker, daemon=True,
+                                      args=(shard, self.workers, path, self.engine, self.worker_kwargs(shard)))
+            process.start()
+            processes.append(process)
+
+        links = [None] * self.workers
+        try:
+            for _ in range(self.workers):
+                conn, _ = bus.accept()
+                conn.settimeout(None)
+                reader = FrameReader(conn)
+                hello = json.loads(reader.read_frame())
+                shard = hello["shard"]
+                links[shard] = WorkerLink(shard, conn, reader, processes[shard])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            for process in processes:
+                process.terminate()
+            self.server_socket.close()
+            shutil.rmtree(self.workdir, ignore_errors=True)
+            raise RuntimeError(f"Shard workers did not start: {e}") from e
+        finally:
+            bus.close()
+        self.links = links
+        for link in links:
+            threading.Thread(target=self.relay_events, args=(link,), daemon=True).start()
+        threading.Thread(target=self.accept_clients, daemon=True).start()
+        self.log.info(f"🟢 Server started on {self.host}:{self.port} ({self.workers} shards, {self.engine} engine)")
+
+    def worker_kwargs(self, shard):
+        kwargs = dict(self.kwargs)
+        # One history log per process; every shard records what its own users saw
+        kwargs["history_dir"] = os.path.join(self.history_dir, f"shard{shard}") if self.history_dir else None
+        # Each shard serves its own numbers, on consecutive ports
+        if kwargs.get("metrics_port"):
+            kwargs["metrics_port"] += shard
+        return kwargs
+
+    # ---------------- HAND OVER CLIENTS ----------------
+    def accept_clients(self):
+        while self.running:
+            try:
+                conn, addr = self.server_socket.accept()
+                threading.Thread(target=self.hand_over, args=(conn, addr), daemon=True).start()
+            except OSError: # Server socket closed by stop()
+                break
+
+    def hand_over(self, conn, addr):
+        try:
+            conn.settimeout(HELLO_TIMEOUT)
+            buffer, received, frames = FrameBuffer(HELLO_MAX), bytearray(), []
+            while not frames:
+                data = conn.recv(RECV_SIZE)
+                if not data:
+                    return
+                received += data
+                frames = buffer.feed(data)
+            conn.settimeout(None) # Back to blocking: the flag is shared with the shard's copy
+            event = {"op": "conn", "addr": list(addr[:2]), "data": base64.b64encode(received).decode('ascii')}
+            self.links[self.shard_of_hello(frames[0])].send(json.dumps(event), conn.fileno())
+        except (OSError, FrameError):
+            pass # Timed out or garbage before HELLO
+        finally:
+            conn.close() # The shard has its own descriptor now
+
+    def shard_of_hello(self, frame):
+        try:
+            _, hello = parse_message(frame)
+            username = hello.get("username")
+        except (HandshakeError, AttributeError):
+            username = None
+        # A broken HELLO goes anywhere, that shard sends the REJECT
+        return shard_for(username, self.workers) if isinstance(username, str) else 0
+
+    # ---------------- EVENT BUS ----------------
+    def relay_events(self, link):
+        try:
+            while True:
+                frame = link.reader.read_frame()
+                if frame is None:
+                    break
+                event = json.loads(frame)
+                if event.get("op") == "log":
+                    self.log.log(event.get("level", INFO), "[{}] {}", link.shard, event.get("text"))
+                elif "target" in event:
+                    self.links[shard_for(event["target"], self.workers)].send(frame)
+                else:
+                    for other in self.links:
+                        if other is not link:
+                            other.send(frame)
+        except (OSError, ValueError, FrameError):
+            pass
+        if self.running:
+            self.log.warning(f"⚠️ Shard {link.shard} exited, its users are disconnected")
+
+    # ---------------- RATE LIMITS ----------------
+    def set_limits(self, **rates):
+        """Like ChatServer.set_limits(), on every shard; each applies the limits to its own users."""
+        check_rates(rates)
+        for link in self.links:
+            link.send(json.dumps({"op": "limits", "rates": rates}))
+
+    # ---------------- STOP SERVER ----------------
+    # The shards drain their own clients; the hub keeps relaying between them meanwhile
+    def stop(self, drain_timeout=DRAIN_TIMEOUT):
+        self.running = False
+        try:
+            self.server_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        finally:
+            self.server_socket.close()
+        for link in self.links:
+            link.send(json.dumps({"op": "stop", "drain": drain_timeout}))
+        deadline = time.monotonic() + drain_timeout + STOP_TIMEOUT
+        for link in self.links:
+            link.process.join(max(0, deadline - time.monotonic()))
+            if link.process.is_alive():
+                link.process.terminate()
+            link.conn.close()
+        if self.workdir:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+        self.log.info("🛑 Server stopped.")
+        self.log.close()